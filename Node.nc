@@ -7,6 +7,8 @@
 #include "includes/channels.h"
 #include "includes/socket.h"
 #include "includes/Transport.h"
+#include "includes/chat.h"
+#include "includes/ping.h"
 
 module Node{
    uses interface Boot;             // Boot interface      
@@ -22,11 +24,11 @@ module Node{
    uses interface NeighborDiscovery as ND;
 
    uses interface Timer<TMilli> as NDTimer;  // Timer for ND module
-   uses interface Timer<TMilli> as ServerTimer;
-   uses interface Timer<TMilli> as ClientTimer;
 
    uses interface Flooding as Flood;
    uses interface LinkState as LS;
+   uses interface Multicast as Mcast;
+   uses interface Fragment as Frag;
    uses interface Transport;
    
    // Chat application
@@ -37,9 +39,10 @@ module Node{
 implementation {
    pack sendPackage;          
    uint16_t floodSeq = 0;
+   uint16_t pingSeq = 0;
 
    // Transport testing globals
-   enum { MAX_SERVER_CONNECTIONS = 8 };
+   enum { MAX_SERVER_CONNECTIONS = 8, FRAG_TEST_MAX = 192 };
    socket_t serverFd = NULL_SOCKET;
    socket_t serverAccepted[MAX_SERVER_CONNECTIONS];
    uint8_t serverReadBuf[64];
@@ -63,6 +66,7 @@ implementation {
 
    // Helper functions to create packets
    void makePack(pack *Package, uint16_t src, uint16_t dest, uint16_t TTL, uint16_t Protocol, uint16_t seq, uint8_t *payload, uint8_t length);
+   void handlePing(pack* msg);
 
    // On boot: start radio, ND, and Flooding
    event void Boot.booted(){
@@ -71,9 +75,15 @@ implementation {
       clientFd = NULL_SOCKET;
       call AMControl.start();
       
-      // Start chat server on node 1
-      if (TOS_NODE_ID == 1) {
-         call ChatServer.start();
+      // Start a chat server on every node in CHAT_SERVER_LIST
+      {
+         uint8_t k;
+         for (k = 0; k < CHAT_SERVER_COUNT; k++) {
+            if (chatServers[k] == TOS_NODE_ID) {
+               call ChatServer.start();
+               break;
+            }
+         }
       }
    }
 
@@ -82,6 +92,7 @@ implementation {
          call ND.start();
          call Flood.start();
          call LS.start();
+         call Mcast.start();
       }else{
          // Retry until successful
          call AMControl.start();
@@ -95,21 +106,36 @@ implementation {
       pack* myMsg = (pack*) payload;
       uint16_t inbound = call AMPacket.source(msg);
 
-      if(myMsg->protocol == 1 || myMsg->protocol == 2) {    // ND REQ/ND REP
+      if(myMsg->protocol == PROTOCOL_ND_REQ || myMsg->protocol == PROTOCOL_ND_REP) {
          call ND.onReceive(myMsg, inbound);
       } else if(myMsg->protocol == 3) {               // FLOOD
          call Flood.onReceive(myMsg, inbound);
-      } else if(myMsg->protocol == PROTOCOL_TCP) {   // TCP
+      } else if(myMsg->protocol == PROTOCOL_TCP ||
+                myMsg->protocol == PROTOCOL_TCP_COMPACT) {   // TCP (full or compact header)
             if(myMsg->dest == TOS_NODE_ID) {
                // Deliver to transport layer
                call Transport.receive(myMsg);
             } else {
-               // Route to next hop
+               // Route to next hop; the flow hash keeps each connection on one equal-cost path
+               uint16_t next_hop = call LS.nextHopFor(myMsg->dest, tcpPacketFlowHash(myMsg));
+               if (next_hop != 0xFFFF) {
+                  call SS.send(*myMsg, next_hop);
+               }
+            }
+      } else if(myMsg->protocol == PROTOCOL_FRAGMENT) {   // Fragment of a larger datagram
+            if(myMsg->dest == TOS_NODE_ID) {
+               call Frag.onReceive(myMsg);
+            } else {
                uint16_t next_hop = call LS.nextHop(myMsg->dest);
                if (next_hop != 0xFFFF) {
                   call SS.send(*myMsg, next_hop);
                }
             }
+      } else if(myMsg->protocol == PROTOCOL_MULTICAST) {   // Multicast: one copy per tree branch
+         call Mcast.onReceive(myMsg, inbound);
+      } else if((myMsg->protocol == PROTOCOL_PING || myMsg->protocol == PROTOCOL_PINGREPLY) &&
+                myMsg->dest == TOS_NODE_ID) {
+         handlePing(myMsg);
       } else if(myMsg->protocol == 4) {               // Link-State
          call Flood.onReceive(myMsg, inbound);
       } else {
@@ -137,18 +163,43 @@ implementation {
       return msg;
    }
 
+   // Answer a ping with its header echoed back, or time a reply to our own ping
+   void handlePing(pack* msg) {
+      ping_header_t* hdr = (ping_header_t*) msg->payload;
+
+      if (msg->protocol == PROTOCOL_PING) {
+         pack reply;
+         uint16_t nh;
+         dbg(GENERAL_CHANNEL, "Ping received from %d\n", msg->src);
+         makePack(&reply, TOS_NODE_ID, msg->src, MAX_TTL, PROTOCOL_PINGREPLY, floodSeq++, msg->payload, PACKET_MAX_PAYLOAD_SIZE);
+         nh = call LS.nextHop(msg->src);
+         if (nh == 0xFFFF || call SS.send(reply, nh) != SUCCESS) {
+            dbg(PING_CHANNEL, "PINGDROP from=%d seq=%d\n", msg->src, hdr->seq);
+         }
+      } else {
+         dbg(PING_CHANNEL, "PINGRTT from=%d seq=%d rtt=%lu\n", msg->src, hdr->seq,
+             (unsigned long)(call NDTimer.getNow() - hdr->sentAt));
+      }
+   }
+
    // Timer for periodic operations
    event void NDTimer.fired(){
       call NDTimer.startOneShot(5000);  // 5 second intervals
    }
 
-   // Handle ping command - send via flooding
+   // Handle ping command - send along the LS route with a timestamp the reply echoes back
    event void Cmd.ping(uint16_t destination, uint8_t *payload){
+      uint8_t data[PACKET_MAX_PAYLOAD_SIZE];
+      ping_header_t* hdr = (ping_header_t*) data;
       dbg(COMMAND_CHANNEL, "Cmd.ping received: dest %d\n", destination);
-      
-      // Create flood packet
-      makePack(&sendPackage, TOS_NODE_ID, destination, MAX_TTL, 0, floodSeq++, payload, PACKET_MAX_PAYLOAD_SIZE);
-      
+
+      hdr->seq = pingSeq++;
+      hdr->sentAt = call NDTimer.getNow();
+      memcpy(data + PING_HDR_LEN, payload, PING_MSG_MAX);
+      makePack(&sendPackage, TOS_NODE_ID, destination, MAX_TTL, PROTOCOL_PING, floodSeq++, data, PACKET_MAX_PAYLOAD_SIZE);
+      // Logged before routing so pings without a route count as lost
+      dbg(PING_CHANNEL, "PINGSEND dest=%d seq=%d\n", destination, hdr->seq);
+
       // Try LS routing first
       {
          uint16_t nh = call LS.nextHop(destination);
@@ -168,6 +219,35 @@ implementation {
       }
    }
 
+   event void Mcast.receive(uint8_t group, uint16_t src, uint8_t* payload) {
+      dbg(GENERAL_CHANNEL, "Multicast received for group %d from %d\n", group, src);
+   }
+
+   // Test datagrams carry byte i = i & 0xFF so the receiver can check reassembly
+   event void Frag.receive(uint16_t src, uint8_t protocol, uint8_t* data, uint16_t len) {
+      uint16_t i;
+      for (i = 0; i < len; i++) {
+         if (data[i] != (uint8_t)i) break;
+      }
+      dbg(GENERAL_CHANNEL, "Datagram received from %d len=%d (%s)\n", src, len, (i == len) ? "intact" : "corrupt");
+   }
+
+   event void Frag.lost(uint16_t src, uint16_t id, uint8_t received, uint8_t total) {}
+
+   // LinkState switches routes through the lost neighbor to their backups
+   event void ND.neighborLost(uint16_t addr) {}
+
+   event void Cmd.fragTest(uint16_t destination, uint16_t len){
+      uint8_t data[FRAG_TEST_MAX];
+      uint16_t i;
+      dbg(COMMAND_CHANNEL, "Cmd.fragTest received: dest %d len %d\n", destination, len);
+      if (len > FRAG_TEST_MAX) len = FRAG_TEST_MAX;
+      for (i = 0; i < len; i++) {
+         data[i] = (uint8_t)i;
+      }
+      call Frag.send(destination, PROTOCOL_PING, data, len);
+   }
+
    event void Cmd.printNeighbors(){
       call ND.printNeighbors();
    }
@@ -183,6 +263,31 @@ implementation {
    }
    
    event void Cmd.printDistanceVector(){}
+
+   // Every module dumps its counters as "STAT <module> key=value ..." lines on STATS_CHANNEL
+   event void Cmd.printStats(){
+      call ND.printStats();
+      call Flood.printStats();
+      call LS.printStats();
+      call Mcast.printStats();
+      call Frag.printStats();
+      call Transport.printStats();
+      call ChatServer.printStats();
+      call SS.printStats("node_send");
+   }
+
+   event void Cmd.mcastJoin(uint8_t group){
+      call Mcast.join(group);
+   }
+
+   event void Cmd.mcastLeave(uint8_t group){
+      call Mcast.leave(group);
+   }
+
+   event void Cmd.mcastSend(uint8_t group, uint8_t *payload){
+      dbg(COMMAND_CHANNEL, "Cmd.mcastSend received: group %d\n", group);
+      call Mcast.send(group, payload);
+   }
    
    event void Cmd.setTestServer(){
       socket_addr_t addr;
@@ -234,16 +339,24 @@ implementation {
       resetServerConnections();
 
       dbg("TransportTest", "Server started node=%hu port=%hu\n", TOS_NODE_ID, serverPort);
-      call ServerTimer.startPeriodic(500);
    }
 
-   event void ServerTimer.fired() {
+   bool isServerConnection(socket_t fd) {
+      uint8_t i;
+      for (i = 0; i < MAX_SERVER_CONNECTIONS; i++) {
+         if (serverAccepted[i] != NULL_SOCKET && serverAccepted[i] == fd) {
+            return TRUE;
+         }
+      }
+      return FALSE;
+   }
+
+   event void Transport.acceptable(socket_t fd) {
       socket_t newFd;
       uint8_t i;
       bool stored;
 
-      if (serverFd == NULL_SOCKET) {
-         call ServerTimer.stop();
+      if (serverFd == NULL_SOCKET || fd != serverFd) {
          return;
       }
 
@@ -269,27 +382,49 @@ implementation {
             break;
          }
       }
+   }
 
-      for (i = 0; i < MAX_SERVER_CONNECTIONS; i++) {
-            socket_t fd = serverAccepted[i];
-            if (fd == NULL_SOCKET) {
-               continue;
-            }
-            {
-               uint16_t n = call Transport.read(fd, serverReadBuf, sizeof(serverReadBuf));
-               if (n > 1) {
-                  uint16_t idx = 0;
-                  dbg("TransportTest", "Reading Data (fd=%hhu):", fd);
-                  while (idx + 1 < n) {
-                     uint16_t value =
-                        ((uint16_t)serverReadBuf[idx] << 8) |
-                        ((uint16_t)serverReadBuf[idx + 1]);
-                     dbg("TransportTest", "%hu,", value);
-                     idx += 2;
-                  }
-                  dbg("TransportTest", "\n");
-               }
+   // Drain an accepted connection; readable() only fires on the empty -> non-empty edge
+   event void Transport.readable(socket_t fd) {
+      uint16_t n;
+
+      if (!isServerConnection(fd)) {
+         return;
+      }
+
+      while ((n = call Transport.read(fd, serverReadBuf, sizeof(serverReadBuf))) > 0) {
+         if (n > 1) {
+            uint16_t idx = 0;
+            dbg("TransportTest", "Reading Data (fd=%hhu):", fd);
+            while (idx + 1 < n) {
+               uint16_t value =
+                  ((uint16_t)serverReadBuf[idx] << 8) |
+                  ((uint16_t)serverReadBuf[idx + 1]);
+               dbg("TransportTest", "%hu,", value);
+               idx += 2;
             }
+            dbg("TransportTest", "\n");
+         }
+      }
+   }
+
+   // Peer closed or reset: release the accepted connection slot or the test client
+   event void Transport.closed(socket_t fd) {
+      uint8_t i;
+      if (clientFd != NULL_SOCKET && fd == clientFd) {
+         dbg("TransportTest", "Client connection closed on node %hu\n", TOS_NODE_ID);
+         call Transport.close(fd);
+         clientFd = NULL_SOCKET;
+         clientActive = FALSE;
+         return;
+      }
+      for (i = 0; i < MAX_SERVER_CONNECTIONS; i++) {
+         if (serverAccepted[i] != NULL_SOCKET && serverAccepted[i] == fd) {
+            dbg("TransportTest", "Server closing fd=%hhu on node %hu\n", fd, TOS_NODE_ID);
+            serverAccepted[i] = NULL_SOCKET;
+            call Transport.close(fd);
+            return;
+         }
       }
    }
 
@@ -350,18 +485,17 @@ implementation {
       clientActive = TRUE;
       dbg("TransportTest", "Client started node=%hu -> %hu:%hu transfer=%hu\n",
           TOS_NODE_ID, clientDestAddr, clientDestPort, clientTransferLimit);
-      call ClientTimer.startPeriodic(500);
    }
 
-   event void ClientTimer.fired() {
+   // Write one buffer of counters; returns FALSE once the send buffer is full or we are done
+   bool clientWriteOnce() {
       uint16_t valuesPrepared = 0;
       uint16_t maxValues = sizeof(clientWriteBuf) / 2;
       uint16_t bufLen = 0;
       uint16_t written;
 
       if (!clientActive || clientFd == NULL_SOCKET) {
-          call ClientTimer.stop();
-          return;
+          return FALSE;
       }
 
       while (valuesPrepared < maxValues && clientNextValue <= clientTransferLimit) {
@@ -374,13 +508,13 @@ implementation {
       }
 
       if (bufLen == 0) {
-         return;
+         return FALSE;
       }
 
       written = call Transport.write(clientFd, clientWriteBuf, bufLen);
       if (written == 0) {
          clientNextValue -= valuesPrepared;
-         return;
+         return FALSE;
       }
 
       if (written < bufLen) {
@@ -392,6 +526,16 @@ implementation {
       }
 
       dbg("TransportTest", "Client wrote %hu bytes from node %hu\n", written, TOS_NODE_ID);
+      return written == bufLen;
+   }
+
+   // Connection up or send space freed: write until the buffer fills again
+   event void Transport.writable(socket_t fd) {
+      if (fd != clientFd) {
+         return;
+      }
+      while (clientWriteOnce()) {
+      }
    }
 
    event void Cmd.setTestClose(){
@@ -411,7 +555,6 @@ implementation {
             call Transport.close(clientFd);
             clientFd = NULL_SOCKET;
             clientActive = FALSE;
-            call ClientTimer.stop();
          }
       }
    }
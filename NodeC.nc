@@ -26,10 +26,6 @@ implementation {
     components new TimerMilliC();
     Node.NDTimer -> TimerMilliC;
 
-    components new TimerMilliC() as ServerTimerC;
-    components new TimerMilliC() as ClientTimerC;
-    Node.ServerTimer -> ServerTimerC;
-    Node.ClientTimer -> ClientTimerC;
 
     // Neighbor Discovery module
     components new NeighborDiscoveryC(6) as NeighborDiscoveryC;
@@ -45,6 +41,16 @@ implementation {
     Node.LS -> LinkStateC.LinkState;
     LinkStateC.NeighborDiscovery -> NeighborDiscoveryC.NeighborDiscovery;
 
+    // Multicast along shortest-path trees
+    components MulticastC;
+    Node.Mcast -> MulticastC.Multicast;
+    MulticastC.LinkState -> LinkStateC.LinkState;
+
+    // Fragmentation for datagrams larger than one packet
+    components FragmentC;
+    Node.Frag -> FragmentC.Fragment;
+    FragmentC.LinkState -> LinkStateC.LinkState;
+
     // Transport module
     components TransportC;
     TransportC.LinkState -> LinkStateC.LinkState;
@@ -55,6 +61,7 @@ implementation {
     components ChatServerC;
     Node.ChatClient -> ChatClientC;
     ChatClientC.Transport -> TransportC;
+    ChatClientC.LinkState -> LinkStateC.LinkState;
     Node.ChatServer -> ChatServerC;
     ChatServerC.Transport -> TransportC;
 }
\ No newline at end of file
@@ -1,7 +1,28 @@
 #! /usr/bin/python
 import sys
+import os
+import re
+import json
+import random
+import binascii
+import hashlib
+import tempfile
+import time
 from TOSSIM import *
 from CommandMsg import *
+from logsink import LogSink
+
+# Time a TestSim method as a profiler phase (no-op unless profiling is on)
+def profiled(name):
+    def wrap(fn):
+        def inner(self, *args, **kwargs):
+            self.phaseBegin(name)
+            try:
+                return fn(self, *args, **kwargs)
+            finally:
+                self.phaseEnd()
+        return inner
+    return wrap
 
 class TestSim:
     moteids=[]
@@ -17,6 +38,20 @@ class TestSim:
     CMD_CHAT_MSG = 11
     CMD_CHAT_WHISPER = 12
     CMD_CHAT_LISTUSR = 13
+    CMD_MCAST_JOIN = 14
+    CMD_MCAST_LEAVE = 15
+    CMD_MCAST_SEND = 16
+    CMD_FRAG_TEST = 17
+    CMD_FRAME = 18
+    CMD_BATCH = 19
+    CMD_STATS_DUMP = 20
+
+    # Multi-frame commands - see includes/command.h
+    CMD_MAX_PAYLOAD = 24        # 25-byte payload, last byte left for setString_payload's NUL
+    CMD_FRAME_HDR_LEN = 5
+    CMD_FRAME_DATA = CMD_MAX_PAYLOAD - CMD_FRAME_HDR_LEN
+    CMD_MAX_FRAMES = 12
+    CHAT_LINE_MAX = 80
 
     # CHANNELS - see includes/channels.h
     COMMAND_CHANNEL="command"
@@ -26,50 +61,116 @@ class TestSim:
     FLOODING_CHANNEL="flooding"
 
     ROUTING_CHANNEL="routing"
+    MULTICAST_CHANNEL="multicast"
 
     TRANSPORT_CHANNEL="transport"
     TRANSPORT_TEST_CHANNEL="TransportTest"
 
     CHAT_CHANNEL="Chat"
+    STATS_CHANNEL="stats"
+    PING_CHANNEL="ping"
 
     # Initialize Vars
     numMote=0
+    frameTag=0
 
-    def __init__(self):
+    # seed fixes TOSSIM's RNG (noise model and radio); a random one is picked and
+    # printed when omitted. record names a JSON file that saveRecording() writes
+    # the seed, input file hashes and every injected operation to; replay() reruns it.
+    def __init__(self, profile=False, seed=None, record=None):
         self.t = Tossim([])
         self.r = self.t.radio()
 
+        if seed is None:
+            seed = random.SystemRandom().randint(1, 0x7FFFFFFF)
+        self.setSeed(seed)
+        self.recordPath = record
+        self.recording = {"version": 1, "seed": seed, "build": buildHash(),
+                          "files": {}, "ops": []}
+        self.replaying = False
+        self.divergences = 0
+
+        # Profiler state: phases are keyed by their stack of names
+        self.profiling = profile
+        self.phaseStack = []
+        self.phaseStats = {}        # stack tuple -> [calls, wall s, sim ticks, events]
+        self.runLog = []            # one (ticks asked, events, wall s, sim ticks) per run()
+        self.channelOutputs = []    # [name, capture file, real output, read position]
+        self.channelBytes = {}
+        self.channelLines = {}
+        self.profileStart = time.time()
+
+        self.logSinks = []          # LogSinks passed to addChannel, drained after every run()
+
         #Create a Command Packet
         self.msg = CommandMsg()
-        self.pkt = self.t.newPacket()
-        self.pkt.setType(self.msg.get_amType())
+        self.captures = {}          # channel -> temporary file read by collectStats/pingSweep
 
     # Load a topo file and use it.
+    @profiled("loadTopo")
     def loadTopo(self, topoFile):
         print("Creating Topo!")
+        self.recordOp("topo", topoFile)
         # Read topology file.
         topoFile = 'topo/'+topoFile
+        self.recordFile(topoFile)
         f = open(topoFile, "r")
         self.numMote = int(f.readline());
         print("Number of Motes"), self.numMote
+        # A set for membership; the list keeps first-seen order for bootAll
+        self.moteids = list(self.moteids)
+        seen = set(self.moteids)
         for line in f:
             s = line.split()
             if s:
                 print(""), s[0], " ", s[1], " ", s[2];
                 self.r.add(int(s[0]), int(s[1]), float(s[2]))
-                if not int(s[0]) in self.moteids:
-                    self.moteids=self.moteids+[int(s[0])]
-                if not int(s[1]) in self.moteids:
-                    self.moteids=self.moteids+[int(s[1])]
+                for mote in (int(s[0]), int(s[1])):
+                    if mote not in seen:
+                        seen.add(mote)
+                        self.moteids.append(mote)
+
+    # Generate a synthetic topology with topogen.py (needs NumPy) and feed it
+    # straight to the radio. seed defaults to the simulation seed.
+    @profiled("generateTopo")
+    def generateTopo(self, numMote, layout="random", seed=None, **options):
+        import topogen
+        if seed is None:
+            seed = self.seed
+        self.recordOp("generate", numMote, layout, seed, options)
+        pos, src, dst, gain = topogen.generate(numMote, layout, seed, **options)
+        self.addLinks(numMote, src, dst, gain)
+
+    # Load links given as parallel (src, dst, gain) sequences
+    def loadLinks(self, numMote, src, dst, gain):
+        if self.recordPath is not None:
+            self.recordOp("links", numMote, [[int(a), int(b), float(g)] for a, b, g in zip(src, dst, gain)])
+        self.addLinks(numMote, src, dst, gain)
+
+    def addLinks(self, numMote, src, dst, gain):
+        print("Creating Topo with %d motes and %d links" % (numMote, len(src)))
+        self.numMote = numMote
+        self.moteids = list(self.moteids)
+        seen = set(self.moteids)
+        add = self.r.add
+        for a, b, g in zip(src, dst, gain):
+            add(int(a), int(b), float(g))
+        for mote in sorted(set(int(a) for a in src) | set(int(b) for b in dst)):
+            if mote not in seen:
+                seen.add(mote)
+                self.moteids.append(mote)
 
     # Load a noise file and apply it.
+    @profiled("loadNoise")
     def loadNoise(self, noiseFile):
         if self.numMote == 0:
             print("Create a topo first")
             return
 
         # Get and Create a Noise Model
+        self.recordOp("noise", noiseFile)
         noiseFile = 'noise/'+noiseFile
+        self.recordFile(noiseFile)
         noise = open(noiseFile, "r")
         for line in noise:
             str1 = line.strip()
@@ -86,36 +187,102 @@ class TestSim:
         if self.numMote == 0:
             print("Create a topo first")
             return
+        self.recordOp("boot", nodeID)
         self.t.getNode(nodeID).bootAtTime(1333*nodeID)
 
+    @profiled("boot")
     def bootAll(self):
         i=0
         for i in self.moteids:
             self.bootNode(i)
 
     def moteOff(self, nodeID):
+        self.recordOp("off", nodeID)
         self.t.getNode(nodeID).turnOff()
 
     def moteOn(self, nodeID):
+        self.recordOp("on", nodeID)
         self.t.getNode(nodeID).turnOn()
 
     def run(self, ticks):
+        self.runEvents(ticks)
+        # Sim time after the run lets a replay spot the first point it diverged
+        self.recordOp("run", ticks, self.t.time())
+
+    def runEvents(self, ticks):
+        if not self.profiling:
+            for i in range(ticks):
+                self.t.runNextEvent()
+            for sink in self.logSinks:
+                sink.drain()
+            return
+
+        # Split the time between the event loop and copying channel output
+        self.phaseBegin("simulate")
+        wall0 = time.time()
+        sim0 = self.t.time()
+        events = 0
         for i in range(ticks):
-            self.t.runNextEvent()
+            if self.t.runNextEvent():
+                events += 1
+        self.runLog.append((ticks, events, time.time() - wall0, self.t.time() - sim0))
+        self.phaseEnd(events)
+
+        self.phaseBegin("channelOutput")
+        self.drainChannels()
+        self.phaseEnd()
 
     # Rough run time. tickPerSecond does not work.
+    @profiled("runTime")
     def runTime(self, amount):
         self.run(amount*1000)
 
     # Generic Command
+    @profiled("command")
     def sendCMD(self, ID, dest, payloadStr):
+        self.deliverCMD(ID, dest, payloadStr, self.t.time()+5)
+
+    def deliverCMD(self, ID, dest, payloadStr, at):
+        self.recordOp("cmd", ID, dest, toHex(payloadStr), at)
         self.msg.set_dest(dest)
         self.msg.set_id(ID)
         self.msg.setString_payload(payloadStr)
 
-        self.pkt.setData(self.msg.data)
-        self.pkt.setDestination(dest)
-        self.pkt.deliver(dest, self.t.time()+5)
+        # TOSSIM keeps a pointer to the packet until it is delivered, so commands
+        # queued for the same instant each need their own packet
+        pkt = self.t.newPacket()
+        pkt.setType(self.msg.get_amType())
+        pkt.setData(self.msg.data)
+        pkt.setDestination(dest)
+        pkt.deliver(dest, at)
+
+    # Send a command of any size. Payloads that fit one CommandMsg go out as is;
+    # larger ones are split into CMD_FRAME messages that the node reassembles.
+    def sendLargeCMD(self, ID, dest, payloadStr):
+        if len(payloadStr) <= self.CMD_MAX_PAYLOAD:
+            self.sendCMD(ID, dest, payloadStr)
+            return
+        chunks = [payloadStr[i:i + self.CMD_FRAME_DATA]
+                  for i in range(0, len(payloadStr), self.CMD_FRAME_DATA)]
+        if len(chunks) > self.CMD_MAX_FRAMES:
+            print("Command too large: %d bytes" % len(payloadStr))
+            return
+        self.frameTag = (self.frameTag + 1) & 0xFF
+        for index, chunk in enumerate(chunks):
+            header = chr(ID) + chr(self.frameTag) + chr(index) + chr(len(chunks)) + chr(len(chunk))
+            self.sendCMD(self.CMD_FRAME, dest, header + chunk)
+
+    # Run several commands on one node as a single logical operation.
+    # commands is a list of (command id, payload string) pairs.
+    def batch(self, dest, commands):
+        if len(commands) > 255:
+            print("Batch too large: %d commands" % len(commands))
+            return
+        # Leading record count: a batch that fits one CommandMsg arrives zero-padded
+        payload = chr(len(commands))
+        for ID, body in commands:
+            payload += chr(ID) + chr(len(body)) + body
+        self.sendLargeCMD(self.CMD_BATCH, dest, payload)
 
     def ping(self, source, dest, msg):
         self.sendCMD(self.CMD_PING, source, "{0}{1}".format(chr(dest),msg))
@@ -156,15 +323,29 @@ class TestSim:
         self.sendCMD(self.CMD_CHAT_HELLO, client_addr, payload)
 
     def chatMsg(self, client_addr, msg):
-        self.sendCMD(self.CMD_CHAT_MSG, client_addr, msg[:25])
+        self.sendLargeCMD(self.CMD_CHAT_MSG, client_addr, msg[:self.CHAT_LINE_MAX])
 
     def chatWhisper(self, client_addr, target_user, msg):
         uname = self.padUsername(target_user)
-        self.sendCMD(self.CMD_CHAT_WHISPER, client_addr, uname + msg[:13])
+        self.sendLargeCMD(self.CMD_CHAT_WHISPER, client_addr, uname + msg[:self.CHAT_LINE_MAX])
 
     def chatListUsr(self, client_addr):
         self.sendCMD(self.CMD_CHAT_LISTUSR, client_addr, "")
 
+    # Multicast helper functions
+    def mcastJoin(self, node, group):
+        self.sendCMD(self.CMD_MCAST_JOIN, node, chr(group))
+
+    def mcastLeave(self, node, group):
+        self.sendCMD(self.CMD_MCAST_LEAVE, node, chr(group))
+
+    def mcastSend(self, source, group, msg):
+        self.sendCMD(self.CMD_MCAST_SEND, source, "{0}{1}".format(chr(group), msg))
+
+    # Send a len-byte test datagram that is fragmented on the way
+    def fragTest(self, source, dest, length):
+        self.sendCMD(self.CMD_FRAG_TEST, source, self.buildPayload([dest, length]))
+
     # Convenience wrappers used by testA/testB
     def testServer(self, address):
         # Use default port 123 for server tests
@@ -178,13 +359,380 @@ class TestSim:
         transfer = 1000
         self.cmdTestClient(client_addr, dest_addr, src_port, dest_port, transfer)
 
+    # Ask every node (or just the given ones) to dump its counters and gather the
+    # "STAT <module> key=value ..." lines into {node: {column: value}}.
+    # Per-socket lines are keyed by fd, e.g. "tcp_sock3.retrans".
+    def collectStats(self, nodes=None, settle=50):
+        if nodes is None:
+            nodes = self.moteids
+        start = self.captureStart(self.STATS_CHANNEL)
+
+        for node in nodes:
+            self.sendCMD(self.CMD_STATS_DUMP, node, "stats command")
+        self.runTime(settle)
+
+        table = {}
+        pattern = re.compile(r"DEBUG \((\d+)\): STAT (\S+) (.*)")
+        for line in self.captureLines(self.STATS_CHANNEL, start):
+            m = pattern.match(line.strip())
+            if not m:
+                continue
+            node = int(m.group(1))
+            fields = dict(kv.split("=", 1) for kv in m.group(3).split() if "=" in kv)
+            module = m.group(2)
+            if "fd" in fields:
+                module += fields.pop("fd")
+            row = table.setdefault(node, {})
+            for key, value in fields.items():
+                row[module + "." + key] = value
+        return table
+
+    # Capture a channel into a temporary file (once) and return the current end,
+    # so captureLines can read just the output produced after this point
+    def captureStart(self, channelName):
+        if channelName not in self.captures:
+            self.captures[channelName] = tempfile.TemporaryFile(mode="w+")
+            self.t.addChannel(channelName, self.captures[channelName])
+        capture = self.captures[channelName]
+        capture.flush()
+        capture.seek(0, 2)
+        return capture.tell()
+
+    def captureLines(self, channelName, start):
+        capture = self.captures[channelName]
+        capture.flush()
+        capture.seek(start)
+        lines = capture.readlines()
+        capture.seek(0, 2)
+        return lines
+
+    # Print collectStats() output as one row per node and one column per counter
+    def printStatsTable(self, table, columns=None):
+        if columns is None:
+            columns = sorted(set(c for row in table.values() for c in row))
+        print("node," + ",".join(columns))
+        for node in sorted(table):
+            row = table[node]
+            print(str(node) + "," + ",".join(row.get(c, "") for c in columns))
+
+    # Ping each (src, dst) pair count times and collect the replies from the ping
+    # channel. pairs defaults to every ordered pair of motes; sample picks that
+    # many of them at random (reproducible with the simulation seed). burst pings
+    # are injected together, then the network runs for interval.
+    # Returns {(src, dst): {"sent": n, "rtts": [ms, ...]}}.
+    def pingSweep(self, pairs=None, sample=None, count=5, burst=4, interval=20, settle=500):
+        if pairs is None:
+            pairs = [(a, b) for a in self.moteids for b in self.moteids if a != b]
+        if sample is not None and sample < len(pairs):
+            pairs = random.Random(self.seed).sample(pairs, sample)
+        start = self.captureStart(self.PING_CHANNEL)
+
+        injected = 0
+        for i in range(count):
+            for src, dst in pairs:
+                self.ping(src, dst, "sweep")
+                injected += 1
+                if injected % burst == 0:
+                    self.runTime(interval)
+        self.runTime(settle)
+
+        results = dict((pair, {"sent": 0, "rtts": []}) for pair in pairs)
+        pending = {}                # (src, dst, seq) -> pair still waiting for a reply
+        pattern = re.compile(r"DEBUG \((\d+)\): PING(SEND dest|RTT from)=(\d+) seq=(\d+)(?: rtt=(\d+))?")
+        for line in self.captureLines(self.PING_CHANNEL, start):
+            m = pattern.match(line.strip())
+            if not m:
+                continue
+            pair = (int(m.group(1)), int(m.group(3)))
+            if pair not in results:
+                continue
+            key = pair + (int(m.group(4)),)
+            if m.group(2) == "SEND dest":
+                results[pair]["sent"] += 1
+                pending[key] = True
+            elif pending.pop(key, False):
+                results[pair]["rtts"].append(int(m.group(5)))
+        return results
+
+    # Reduce pingSweep() results to one value per pair: "loss" (fraction of pings
+    # without a reply), "mean", or a percentile such as "p50" / "p99" (ms)
+    def pingMatrix(self, results, stat="p50"):
+        matrix = {}
+        for pair, r in results.items():
+            if stat == "loss":
+                matrix[pair] = 1.0 - len(r["rtts"]) / float(r["sent"]) if r["sent"] else None
+            elif not r["rtts"]:
+                matrix[pair] = None
+            elif stat == "mean":
+                matrix[pair] = sum(r["rtts"]) / float(len(r["rtts"]))
+            else:
+                matrix[pair] = percentile(r["rtts"], float(stat[1:]))
+        return matrix
+
+    # Print a pingMatrix() as CSV, one row per source and one column per destination
+    def printPingMatrix(self, results, stat="p50"):
+        matrix = self.pingMatrix(results, stat)
+        nodes = sorted(set(p[0] for p in matrix) | set(p[1] for p in matrix))
+        print(stat + "," + ",".join(str(n) for n in nodes))
+        for src in nodes:
+            cells = []
+            for dst in nodes:
+                value = matrix.get((src, dst))
+                cells.append("" if value is None else "%.3g" % value)
+            print(str(src) + "," + ",".join(cells))
+
+    # One line over all pairs: pings sent, loss and RTT percentiles
+    def printPingSummary(self, results):
+        sent = sum(r["sent"] for r in results.values())
+        rtts = [rtt for r in results.values() for rtt in r["rtts"]]
+        loss = 1.0 - len(rtts) / float(sent) if sent else 0.0
+        if not rtts:
+            print("ping: %d pairs, %d sent, no replies" % (len(results), sent))
+            return
+        print("ping: %d pairs, %d sent, loss %.1f%%, rtt p50 %d p90 %d p99 %d max %d ms" %
+              (len(results), sent, 100 * loss, percentile(rtts, 50), percentile(rtts, 90),
+               percentile(rtts, 99), max(rtts)))
+
+    # out may be a file or a LogSink (buffered, compressed, rotated or ring-only output)
     def addChannel(self, channelName, out=sys.stdout):
         print("Adding Channel")
         channelName
-        self.t.addChannel(channelName, out)
+        if isinstance(out, LogSink):
+            self.t.addChannel(channelName, out.spoolFor(channelName))
+            if out not in self.logSinks:
+                self.logSinks.append(out)
+            self.channelBytes.setdefault(channelName, 0)
+            return
+        if not self.profiling:
+            self.t.addChannel(channelName, out)
+            return
+        # Capture the channel so its bytes can be counted, then pass them on after each run()
+        capture = tempfile.TemporaryFile(mode="w+")
+        self.t.addChannel(channelName, capture)
+        self.channelOutputs.append([channelName, capture, out, 0])
+        self.channelBytes.setdefault(channelName, 0)
+        self.channelLines.setdefault(channelName, 0)
+
+    # ---- Record / replay ----
+    # Only the operations that change the simulation are logged: input files,
+    # boots, motes switched on or off, run() calls and commands with their exact
+    # delivery time. Helpers such as chatMsg or batch end up as "cmd" entries.
+    def setSeed(self, seed):
+        self.seed = seed
+        self.t.randomSeed(seed)
+        print("Random seed %d" % seed)
+
+    # Without a record path nothing is kept, so long runs do not grow the log
+    def recordOp(self, *op):
+        if self.recordPath is not None and not self.replaying:
+            self.recording["ops"].append(list(op))
+
+    def recordFile(self, path):
+        if self.recordPath is None and not self.replaying:
+            return
+        digest = fileHash(path)
+        if self.replaying:
+            expected = self.recording["files"].get(path)
+            if expected is not None and expected != digest:
+                print("Replay: %s differs from the recorded run" % path)
+        else:
+            self.recording["files"][path] = digest
+
+    def saveRecording(self, path=None):
+        if self.recordPath is None:
+            return
+        path = path or self.recordPath
+        f = open(path, "w")
+        json.dump(self.recording, f, indent=1)
+        f.close()
+        print("Recorded %d operations to %s" % (len(self.recording["ops"]), path))
+
+    # Re-execute a recorded run on this (freshly created) TestSim. Add channels
+    # first; returns the number of points where the replay left the recording.
+    def replay(self, path):
+        f = open(path, "r")
+        log = json.load(f)
+        f.close()
+        if log.get("version") != 1:
+            raise ValueError("unknown recording version %r" % log.get("version"))
+        self.recording = log
+        self.replaying = True
+        self.divergences = 0
+        self.setSeed(log["seed"])
+        if log.get("build") and log["build"] != buildHash():
+            print("Replay: TOSSIM build differs from the recorded run")
+
+        for op in log["ops"]:
+            kind = op[0]
+            if kind == "topo":
+                self.loadTopo(op[1])
+            elif kind == "generate":
+                self.generateTopo(op[1], op[2], op[3], **op[4])
+            elif kind == "links":
+                self.loadLinks(op[1], *(list(zip(*op[2])) or ([], [], [])))
+            elif kind == "noise":
+                self.loadNoise(op[1])
+            elif kind == "boot":
+                self.bootNode(op[1])
+            elif kind == "off":
+                self.moteOff(op[1])
+            elif kind == "on":
+                self.moteOn(op[1])
+            elif kind == "run":
+                self.runEvents(op[1])
+                self.checkTime(op, op[2])
+            elif kind == "cmd":
+                ID, dest, payload, at = op[1:]
+                # Commands keep their recorded time, even if the replay has drifted
+                self.checkTime(op, at - 5)
+                self.deliverCMD(ID, dest, fromHex(payload), max(at, self.t.time() + 5))
+            else:
+                raise ValueError("unknown recorded operation %r" % kind)
+
+        self.replaying = False
+        print("Replayed %d operations, %d divergences" % (len(log["ops"]), self.divergences))
+        return self.divergences
+
+    def checkTime(self, op, expected):
+        if self.t.time() == expected:
+            return
+        if self.divergences == 0:
+            print("Replay: diverged at %r (sim time %d, recorded %d)" % (op, self.t.time(), expected))
+        self.divergences += 1
+
+    # ---- Profiler ----
+    # Phases nest: runTime -> simulate / channelOutput. Each records wall time,
+    # sim time and (for simulate) TOSSIM events processed.
+    def phaseBegin(self, name):
+        if self.profiling:
+            self.phaseStack.append((name, time.time(), self.t.time()))
+
+    def phaseEnd(self, events=0):
+        if not self.profiling or not self.phaseStack:
+            return
+        name, wall0, sim0 = self.phaseStack.pop()
+        key = tuple([p[0] for p in self.phaseStack] + [name])
+        stats = self.phaseStats.setdefault(key, [0, 0.0, 0, 0])
+        stats[0] += 1
+        stats[1] += time.time() - wall0
+        stats[2] += self.t.time() - sim0
+        stats[3] += events
+
+    # Forward newly captured channel output to its real destination, counting bytes
+    def drainChannels(self):
+        for entry in self.channelOutputs:
+            name, capture, out, pos = entry
+            capture.flush()
+            capture.seek(pos)
+            data = capture.read()
+            entry[3] = capture.tell()
+            if data:
+                self.channelBytes[name] += len(data)
+                self.channelLines[name] += data.count("\n")
+                out.write(data)
+        for sink in self.logSinks:
+            for name, size in sink.drain().items():
+                self.channelBytes[name] = self.channelBytes.get(name, 0) + size
+
+    # Flush and close every LogSink; call once the simulation is finished
+    def closeLogs(self):
+        for sink in self.logSinks:
+            sink.close()
+        self.logSinks = []
+
+    def printProfile(self):
+        tps = float(self.t.ticksPerSecond())
+        total = time.time() - self.profileStart
+        print("==== Profile: %.3f s wall, %.3f s simulated ====" % (total, self.t.time() / tps))
+        print("%-36s %6s %10s %10s %9s %10s %10s" % ("phase", "calls", "wall s", "sim s", "sim/wall", "events", "events/s"))
+        for key in sorted(self.phaseStats):
+            calls, wall, sim, events = self.phaseStats[key]
+            ratio = (sim / tps) / wall if wall > 0 else 0.0
+            rate = events / wall if wall > 0 else 0.0
+            print("%-36s %6d %10.3f %10.3f %9.2f %10d %10.0f" %
+                  ("  " * (len(key) - 1) + key[-1], calls, wall, sim / tps, ratio, events, rate))
+
+        if self.runLog:
+            slowest = sorted(self.runLog, key=lambda r: r[2], reverse=True)[:5]
+            print("slowest run() calls: ticks, events, wall s, sim s")
+            for ticks, events, wall, sim in slowest:
+                print("  %d %d %.3f %.3f" % (ticks, events, wall, sim / tps))
+
+        if self.channelBytes:
+            print("%-20s %12s %10s" % ("channel", "bytes", "lines"))
+            for name in sorted(self.channelBytes):
+                print("%-20s %12d %10d" % (name, self.channelBytes[name], self.channelLines.get(name, 0)))
+
+        # Event loop time is the stack; everything else is the harness
+        simWall = sum(s[1] for k, s in self.phaseStats.items() if k[-1] == "simulate")
+        outWall = sum(s[1] for k, s in self.phaseStats.items() if k[-1] == "channelOutput")
+        if total > 0:
+            print("event loop %.1f%%, channel output %.1f%%, other harness %.1f%%" %
+                  (100 * simWall / total, 100 * outWall / total, 100 * (total - simWall - outWall) / total))
+
+    # Write exclusive wall time per phase stack as "TestSim;a;b <microseconds>"
+    # lines, the folded format flamegraph.pl and speedscope read.
+    def writeFoldedStacks(self, path):
+        inclusive = dict((k, s[1]) for k, s in self.phaseStats.items())
+        f = open(path, "w")
+        for key in sorted(inclusive):
+            children = sum(w for k, w in inclusive.items() if len(k) == len(key) + 1 and k[:len(key)] == key)
+            exclusive = max(inclusive[key] - children, 0.0)
+            f.write("TestSim;%s %d\n" % (";".join(key), int(exclusive * 1e6)))
+        f.close()
+
+# Nearest-rank percentile of a non-empty list
+def percentile(values, p):
+    ordered = sorted(values)
+    rank = int(-(-p * len(ordered) // 100))    # ceil(p/100 * n)
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+# Hash of an input file, so a replay can tell it is running on the same inputs
+def fileHash(path):
+    f = open(path, "rb")
+    digest = hashlib.sha1(f.read()).hexdigest()
+    f.close()
+    return digest
+
+# Hash of the compiled TOSSIM module, recorded so two builds can be told apart
+def buildHash():
+    base = os.path.dirname(os.path.abspath(sys.modules[Tossim.__module__].__file__))
+    for name in ("_TOSSIMmodule.so", "_TOSSIM.so"):
+        if os.path.exists(os.path.join(base, name)):
+            return fileHash(os.path.join(base, name))
+    return None
+
+# Command payloads can hold any byte, so they are stored as hex in recordings
+def toHex(payloadStr):
+    if not isinstance(payloadStr, bytes):
+        payloadStr = payloadStr.encode("latin-1")
+    return binascii.hexlify(payloadStr).decode("ascii")
+
+def fromHex(text):
+    data = binascii.unhexlify(text)
+    if not isinstance(data, str):
+        data = data.decode("latin-1")
+    return data
+
+def argValue(flag):
+    if flag in sys.argv and sys.argv.index(flag) + 1 < len(sys.argv):
+        return sys.argv[sys.argv.index(flag) + 1]
+    return None
 
 def main():
-    s = TestSim()
+    # --profile prints wall/sim time per phase at the end and writes profile.folded
+    # --seed N fixes the RNG, --record FILE saves the run, --replay FILE reruns one
+    seed = argValue("--seed")
+    s = TestSim(profile="--profile" in sys.argv, seed=int(seed) if seed else None,
+                record=argValue("--record"))
+    if argValue("--replay"):
+        s.addChannel(s.CHAT_CHANNEL)
+        s.replay(argValue("--replay"))
+        if s.profiling:
+            s.printProfile()
+            s.writeFoldedStacks("profile.folded")
+        return
+
     s.runTime(10)
     s.loadTopo("long_line.topo")
     s.loadNoise("no_noise.txt")
@@ -204,6 +752,9 @@ def main():
     s.chatHello(2, "alice", 2002)
     s.runTime(400)
     s.chatHello(3, "bob", 2003)
+    s.runTime(400)
+    # carol is nearest to the second chat server (node 10); messages reach her via relay
+    s.chatHello(12, "carol", 2012)
     s.runTime(8000)
 
     # Early listusr to verify early in the session
@@ -219,6 +770,10 @@ def main():
     s.chatListUsr(2)
     s.runTime(2000)
 
+    s.saveRecording()
+    if s.profiling:
+        s.printProfile()
+        s.writeFoldedStacks("profile.folded")
 
 if __name__ == '__main__':
     main()
@@ -9,7 +9,10 @@
 enum {
    TCP_FLAG_SYN = 1,
    TCP_FLAG_ACK = 2,
-   TCP_FLAG_FIN = 4
+   TCP_FLAG_FIN = 4,
+   TCP_FLAG_COMPACT = 8,     // SYN / SYN+ACK option: sender can use the compact header
+   TCP_FLAG_FASTOPEN = 16,   // SYN: cookie in ack (0 asks for one); SYN+ACK: cookie in data
+   TCP_FLAG_RST = 32         // reset: the server dropped a handshake it had answered (full header only)
 };
 
 // Maximum data payload in a TCP segment
@@ -34,8 +37,61 @@ typedef nx_struct tcp_segment_t {
    nx_uint8_t   data[TCP_MAX_DATA];
 } tcp_segment_t;
 
+// Compact header, negotiated in the SYN and carried as PROTOCOL_TCP_COMPACT.
+// seq/ack carry the low 16 bits and are unwrapped against the receiver's state.
+typedef nx_struct tcp_compact_header_t {
+   nx_uint8_t  srcPort;      // Source port (connection only negotiates compact if both ports fit)
+   nx_uint8_t  dstPort;      // Destination port
+   nx_uint16_t seq;          // Low 16 bits of the first byte sequence number
+   nx_uint16_t ack;          // Low 16 bits of the next expected byte from peer
+   nx_uint8_t  flagsLen;     // Flags in the high nibble (bit 3 = FASTOPEN), dataLen in the low nibble
+   nx_uint8_t  advWindow;    // Advertised window >> TCP_COMPACT_WND_SHIFT
+} tcp_compact_header_t;
+
+typedef nx_struct tcp_compact_segment_t {
+   tcp_compact_header_t header;
+   nx_uint8_t           data[TCP_MAX_DATA];
+} tcp_compact_segment_t;
+
+enum {
+   TCP_COMPACT_WND_SHIFT = 2,      // advertised window granularity (4 bytes, up to 1020)
+   TCP_COMPACT_LEN_MASK = 0x0F,
+   TCP_COMPACT_FLAGS_SHIFT = 4,
+   TCP_COMPACT_MAX_PORT = 255
+};
+
+// Flow hash over (src, dest, ports) for equal-cost multipath. Every hop computes the
+// same value, so a connection stays on one path and its segments are not reordered.
+static inline uint16_t tcpFlowHash(uint16_t src, uint16_t dest, uint16_t srcPort, uint16_t dstPort) {
+   uint32_t h = 2166136261UL;
+   h = (h ^ src) * 16777619UL;
+   h = (h ^ dest) * 16777619UL;
+   h = (h ^ srcPort) * 16777619UL;
+   h = (h ^ dstPort) * 16777619UL;
+   return (uint16_t)(h ^ (h >> 16));
+}
+
+// Same hash read straight from a routed TCP packet (full or compact header)
+static inline uint16_t tcpPacketFlowHash(pack *p) {
+   uint16_t srcPort;
+   uint16_t dstPort;
+   if (p->protocol == PROTOCOL_TCP_COMPACT) {
+      srcPort = p->payload[0];
+      dstPort = p->payload[1];
+   } else {
+      srcPort = ((uint16_t)p->payload[0] << 8) | p->payload[1];
+      dstPort = ((uint16_t)p->payload[2] << 8) | p->payload[3];
+   }
+   return tcpFlowHash(p->src, p->dest, srcPort, dstPort);
+}
+
 // MSS based on packet payload and header size
 #ifndef TCP_MSS
 #define TCP_MSS (PACKET_MAX_PAYLOAD_SIZE - sizeof(tcp_header_t))
 #endif
-#endif
\ No newline at end of file
+
+// MSS of a connection that negotiated the compact header (12 bytes vs 4)
+#ifndef TCP_COMPACT_MSS
+#define TCP_COMPACT_MSS (PACKET_MAX_PAYLOAD_SIZE - sizeof(tcp_compact_header_t))
+#endif
+#endif
@@ -9,10 +9,15 @@ char NEIGHBOR_CHANNEL[]="neighbor";
 char FLOODING_CHANNEL[]="flooding";
 
 char ROUTING_CHANNEL[]="routing";
+char MULTICAST_CHANNEL[]="multicast";
+char PING_CHANNEL[]="ping";
 
 char TRANSPORT_CHANNEL[]="transport";
 char TRANSPORT_TEST_CHANNEL[]="TransportTest";
 
 char CHAT_CHANNEL[]="Chat";
 
+// Counter dumps: one "STAT <module> key=value ..." line per module
+char STATS_CHANNEL[]="stats";
+
 #endif
\ No newline at end of file
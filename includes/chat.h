@@ -0,0 +1,23 @@
+// Chat application constants shared by the chat server, chat client and Node
+
+#ifndef CHAT_H
+#define CHAT_H
+
+enum {
+   CHAT_PORT = 41,              // client <-> server port
+   CHAT_RELAY_PORT = 42,        // server <-> server relay port (listening side)
+   CHAT_RELAY_LOCAL_PORT = 60,  // + server index: local port of an outgoing relay connection
+   CHAT_RELAY_RETRY = 5000,     // ms between relay (re)connect attempts
+   MAX_CHAT_SERVERS = 4
+};
+
+// Nodes that run a chat server. Override at build time, at most MAX_CHAT_SERVERS
+// entries, e.g. CFLAGS += -DCHAT_SERVER_LIST="{1,7,14}"
+#ifndef CHAT_SERVER_LIST
+#define CHAT_SERVER_LIST {1, 10}
+#endif
+
+static const uint16_t chatServers[] = CHAT_SERVER_LIST;
+#define CHAT_SERVER_COUNT (sizeof(chatServers) / sizeof(chatServers[0]))
+
+#endif
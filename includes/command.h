@@ -17,7 +17,14 @@ enum{
 	CMD_CHAT_HELLO=10,
 	CMD_CHAT_MSG=11,
 	CMD_CHAT_WHISPER=12,
-	CMD_CHAT_LISTUSR=13
+	CMD_CHAT_LISTUSR=13,
+	CMD_MCAST_JOIN=14,
+	CMD_MCAST_LEAVE=15,
+	CMD_MCAST_SEND=16,
+	CMD_FRAG_TEST=17,
+	CMD_FRAME=18,
+	CMD_BATCH=19,
+	CMD_STATS_DUMP=20
 };
 
 enum{
@@ -46,4 +53,28 @@ typedef nx_struct {
 	nx_uint8_t msg[CMD_CHAT_WHISPER_MSG_MAX];
 } cmd_chat_whisper_t;
 
+// Multi-frame commands: a command too big for one CommandMsg is split by the
+// harness into CMD_FRAME messages, each starting with this header.
+// CommandHandlerP reassembles them and dispatches the inner command as usual.
+typedef nx_struct {
+	nx_uint8_t id;       // command carried by the frames
+	nx_uint8_t tag;      // same for every frame of one command
+	nx_uint8_t index;    // 0-based frame number
+	nx_uint8_t count;    // frames in the command
+	nx_uint8_t len;      // data bytes in this frame
+} cmd_frame_header_t;
+
+enum {
+	CMD_FRAME_HDR_LEN = 5,
+	CMD_FRAME_DATA = CMD_PACKET_MAX_PAYLOAD_SIZE - CMD_FRAME_HDR_LEN - 1, // harness NUL-terminates each frame
+	CMD_MAX_FRAMES = 12,
+	CMD_MULTI_MAX_PAYLOAD = CMD_MAX_FRAMES * CMD_FRAME_DATA,  // 228 bytes
+	CMD_CHAT_LINE_MAX = 80  // longest chat text accepted through frames; fits the 128-byte chat line buffers
+};
+
+// CMD_BATCH payload: a record count (1), then that many back-to-back
+// [id (1), len (1), payload (len)] records, dispatched in order as if each had
+// been sent on its own. The count matters for single-message batches, which
+// arrive with the full zero-padded CommandMsg payload rather than their length.
+
 #endif
@@ -0,0 +1,20 @@
+// Timestamped ping shared by Node and the TestSim ping sweep
+
+#ifndef PING_H
+#define PING_H
+
+#include "packet.h"
+
+// Carried at the start of PROTOCOL_PING payloads and echoed unchanged in
+// PROTOCOL_PINGREPLY, so the origin can match the reply and compute the RTT
+typedef nx_struct ping_header_t {
+   nx_uint16_t seq;        // per-origin ping number
+   nx_uint32_t sentAt;     // origin clock (ms) when the ping was sent
+} ping_header_t;
+
+enum {
+   PING_HDR_LEN = sizeof(ping_header_t),
+   PING_MSG_MAX = PACKET_MAX_PAYLOAD_SIZE - PING_HDR_LEN
+};
+
+#endif
@@ -9,6 +9,11 @@ enum{
 	PROTOCOL_NAME = 3,
 	PROTOCOL_TCP= 4,
 	PROTOCOL_DV = 5,
+	PROTOCOL_TCP_COMPACT = 6,
+	PROTOCOL_MULTICAST = 7,
+	PROTOCOL_FRAGMENT = 8,
+	PROTOCOL_ND_REQ = 9,
+	PROTOCOL_ND_REP = 10,
    PROTOCOL_CMD = 99
 };
 
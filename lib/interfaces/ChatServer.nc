@@ -2,4 +2,5 @@
  
 interface ChatServer {
    command void start();      // start listening for messages
+   command void printStats();      // dump client and ring counters on the stats channel
 }
\ No newline at end of file
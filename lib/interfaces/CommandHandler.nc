@@ -14,6 +14,11 @@ interface CommandHandler{
    event void chatMsg(char *msg);
    event void chatWhisper(char *username, char *msg);
    event void chatListUsr();
+   event void mcastJoin(uint8_t group);
+   event void mcastLeave(uint8_t group);
+   event void mcastSend(uint8_t group, uint8_t *payload);
+   event void fragTest(uint16_t destination, uint16_t len);
+   event void printStats();
 
    // accessories
    command uint16_t getTestServerAddress();
@@ -5,5 +5,6 @@ interface Flooding{
    command void stop();   // stop the flooding protocol
    command error_t send(pack msg, uint16_t dest);          // send a packet to a destination
    command void onReceive(pack* pkt, uint16_t from);        // notify flooding of a received packet from neighbor discovery
+   command void printStats();                               // dump flooding counters on the stats channel
    event void receive(pack msg, uint16_t from);            // event to notify a node of a received flooding packet
 }
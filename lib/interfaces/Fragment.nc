@@ -0,0 +1,9 @@
+#include "../../includes/packet.h"
+
+interface Fragment{
+   command error_t send(uint16_t dest, uint8_t protocol, uint8_t* data, uint16_t len);   // route a datagram of up to FRAG_MAX_DATAGRAM bytes
+   command void onReceive(pack* pkt);      // a fragment addressed to this node arrived
+   command void printStats();              // dump fragment and reassembly counters on the stats channel
+   event void receive(uint16_t src, uint8_t protocol, uint8_t* data, uint16_t len);   // a whole datagram was reassembled
+   event void lost(uint16_t src, uint16_t id, uint8_t received, uint8_t total);        // a datagram timed out with fragments missing
+}
@@ -5,6 +5,10 @@ interface LinkState{
    command void stop();       // stop the shortest path computation
    command void recomputeRoutes();     // restart shortest path computation due to change in topology
    command uint16_t nextHop(uint16_t dest);     // find next hop of route
+   command uint16_t nextHopFor(uint16_t dest, uint16_t flowHash);   // one of the equal-cost next hops, chosen by flow
+   command uint16_t distance(uint16_t dest);    // path cost to dest (0 for ourselves, 0xFFFF if unreachable)
+   command uint16_t treeParent(uint16_t root, uint16_t node);   // node's parent on the shortest-path tree rooted at root (0xFFFF if none)
    command void printRouteTable();        // list the route paths (next hop + distance to each destination)
    command void printLinkStateDB();    // print topology data from each node
+   command void printStats();          // dump LSA and SPF counters on the stats channel
 }
\ No newline at end of file
@@ -0,0 +1,12 @@
+#include "../../includes/packet.h"
+
+interface Multicast{
+   command void start();      // start advertising group membership
+   command error_t join(uint8_t group);      // add this node to a group
+   command error_t leave(uint8_t group);     // remove this node from a group
+   command error_t send(uint8_t group, uint8_t* payload);   // send one payload to every member of a group
+   command void onReceive(pack* pkt, uint16_t from);        // hand a received multicast packet to the protocol
+   command void printGroups();    // print the membership table
+   command void printStats();     // dump multicast counters on the stats channel
+   event void receive(uint8_t group, uint16_t src, uint8_t* payload);   // a group we belong to got a packet
+}
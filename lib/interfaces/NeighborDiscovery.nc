@@ -10,4 +10,6 @@ interface NeighborDiscovery{
    command bool getNeighbor(uint8_t idx, uint16_t* addr, bool* active);          // Get the neighbor at the given index and its address and active status
 
    command void onReceive(pack* pkt, uint16_t from);      // Notify ND of a received packet from the node
+   command void printStats();      // Dump ND counters on the stats channel
+   event void neighborLost(uint16_t addr);      // A neighbor just aged out (missed more than ND_MISS_THRESHOLD periods)
 }
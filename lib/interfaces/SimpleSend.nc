@@ -2,4 +2,5 @@
 
 interface SimpleSend{
    command error_t send(pack msg, uint16_t dest ); // send to destination
+   command void printStats(char *name);            // dump queue counters under the given module name
 }
\ No newline at end of file
@@ -39,4 +39,31 @@ interface Transport{
 
    // Listen to the socket and wait for a connection
    command error_t listen(socket_t fd);
+
+   // Pace segments at gainPct% of cwnd/SRTT (0 sends each window back to back)
+   command error_t setPacing(socket_t fd, uint8_t gainPct);
+
+   // Fast open for a client socket, set before connect(). The SYN then leaves
+   // from a task, carrying bytes written in the same task if the server gave
+   // this node a cookie on an earlier connection.
+   command error_t setFastOpen(socket_t fd, bool enable);
+
+   // Dump stack-wide and per-socket counters on the stats channel
+   command void printStats();
+
+   // Readiness events. These are edge-triggered and signalled from a task,
+   // so handlers may call back into the commands above. Every user of the
+   // interface sees every event and should ignore fds it does not own.
+
+   // Receive buffer went from empty to non-empty; read() until it returns 0
+   event void readable(socket_t fd);
+
+   // Listening socket fd has a connection waiting; accept() until NULL_SOCKET
+   event void acceptable(socket_t fd);
+
+   // Connection established, or send space freed after a short write()
+   event void writable(socket_t fd);
+
+   // Peer closed its side of the connection (FIN received)
+   event void closed(socket_t fd);
 }
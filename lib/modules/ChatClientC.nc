@@ -3,13 +3,13 @@
 configuration ChatClientC {
    provides interface ChatClient;
    uses interface Transport;
+   uses interface LinkState;
 }
 
 implementation {
    components ChatClientP;
-   components new TimerMilliC() as ReadTimerC;
    
    ChatClient = ChatClientP;
    ChatClientP.Transport = Transport;
-   ChatClientP.ReadTimer -> ReadTimerC;
+   ChatClientP.LinkState = LinkState;
 }
\ No newline at end of file
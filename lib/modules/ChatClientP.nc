@@ -4,11 +4,12 @@
 #include "../../includes/channels.h"
 #include "../../includes/socket.h"
 #include "../../includes/Transport.h"
+#include "../../includes/chat.h"
 
 module ChatClientP {
    provides interface ChatClient;
    uses interface Transport;
-   uses interface Timer<TMilli> as ReadTimer;
+   uses interface LinkState;
 }
 
 implementation {
@@ -16,9 +17,7 @@ implementation {
       USERNAME_MAX = 12,      // username bytes
       USERNAME_BUF = USERNAME_MAX + 1,  // username storage with null terminating character
       LINE_BUF_SIZE = 128,       // per client assembled line buffer (commands + payload + clrf)
-      READ_BUF_SIZE = 64,     // temporary read buffer per socket read
-      CHAT_PORT = 41,      // tcp port
-      SERVER_NODE = 1      // server node
+      READ_BUF_SIZE = 64      // temporary read buffer per socket read
    };
 
    socket_t fd = NULL_SOCKET;
@@ -54,6 +53,23 @@ implementation {
       buf[idx] = '\0';
    }
 
+   // nearest chat server by link-state path cost; first listed server if none is reachable yet
+   uint16_t pickServer() {
+      uint8_t k;
+      uint16_t best = chatServers[0];
+      uint16_t bestDist = 0xFFFF;
+      uint16_t d;
+
+      for (k = 0; k < CHAT_SERVER_COUNT; k++) {
+         d = call LinkState.distance(chatServers[k]);
+         if (d < bestDist) {
+            bestDist = d;
+            best = chatServers[k];
+         }
+      }
+      return best;
+   }
+
    void processLine(char *line) {
       if (strncmp(line, "listUsrRply ", 12) == 0) {
          dbg(CHAT_CHANNEL, "ChatClient listUsrRply: %s\n", line + 12);
@@ -91,11 +107,14 @@ implementation {
          return;
       }
 
-      serverAddr.addr = SERVER_NODE;
+      // The hello below rides on the SYN once this node holds a cookie for the server
+      call Transport.setFastOpen(fd, TRUE);
+
+      serverAddr.addr = pickServer();
       serverAddr.port = CHAT_PORT;
       err = call Transport.connect(fd, &serverAddr);
       if (err != SUCCESS) {
-         dbg(CHAT_CHANNEL, "ChatClient: connect failed to %hu:%hu\n", SERVER_NODE, CHAT_PORT);
+         dbg(CHAT_CHANNEL, "ChatClient: connect failed to %hu:%hu\n", serverAddr.addr, CHAT_PORT);
          call Transport.close(fd);
          fd = NULL_SOCKET;
          return;
@@ -115,10 +134,9 @@ implementation {
       connected = TRUE;
       lineLen = 0;
       lineBuf[0] = '\0';
-      call ReadTimer.startPeriodic(200);
 
       dbg(CHAT_CHANNEL, "ChatClient: connected to server %hu:%hu as %s on port %hu\n",
-          SERVER_NODE, CHAT_PORT, username, clientPort);
+          serverAddr.addr, CHAT_PORT, username, clientPort);
    }
 
    // broadcast a message to connected clients
@@ -176,22 +194,19 @@ implementation {
       call Transport.write(fd, (uint8_t *)outBuf, strlen(outBuf));
    }
    
-   event void ReadTimer.fired() {
+   // consume one read() worth of data; returns bytes read
+   uint16_t readChunk() {
       uint16_t n;
-      if (!connected || fd == NULL_SOCKET) {
-         call ReadTimer.stop();
-         return;
-      }
 
       n = call Transport.read(fd, readBuf, READ_BUF_SIZE);
       if (n == 0) {
-         return;
+         return 0;
       }
 
       if (lineLen + n >= LINE_BUF_SIZE) {
          lineLen = 0;
          lineBuf[0] = '\0';
-         return;
+         return n;
       }
       {
          uint8_t i;
@@ -225,5 +240,30 @@ implementation {
             break;
          }
       }
+      return n;
+   }
+
+   // readable() is edge-triggered: drain everything buffered
+   event void Transport.readable(socket_t readyFd) {
+      if (!connected || readyFd != fd) {
+         return;
+      }
+      while (readChunk() > 0) {
+      }
+   }
+
+   event void Transport.acceptable(socket_t readyFd) {}
+
+   event void Transport.writable(socket_t readyFd) {}
+
+   // server went away; release our end
+   event void Transport.closed(socket_t readyFd) {
+      if (readyFd != fd) {
+         return;
+      }
+      dbg(CHAT_CHANNEL, "ChatClient: server closed connection fd=%hhu\n", fd);
+      call Transport.close(fd);
+      fd = NULL_SOCKET;
+      connected = FALSE;
    }
 }
\ No newline at end of file
@@ -7,11 +7,9 @@ configuration ChatServerC {
 
 implementation {
    components ChatServerP;
-   components new TimerMilliC() as AcceptTimerC;
-   components new TimerMilliC() as ReadTimerC;
+   components new TimerMilliC() as RelayTimerC;
    
    ChatServer = ChatServerP;
    ChatServerP.Transport = Transport;
-    ChatServerP.AcceptTimer -> AcceptTimerC;
-    ChatServerP.ReadTimer -> ReadTimerC;
+   ChatServerP.RelayTimer -> RelayTimerC;
 }
\ No newline at end of file
@@ -4,22 +4,27 @@
 #include "../../includes/channels.h"
 #include "../../includes/socket.h"
 #include "../../includes/Transport.h"
+#include "../../includes/chat.h"
 
 module ChatServerP {
    provides interface ChatServer;
    uses interface Transport;
-   uses interface Timer<TMilli> as AcceptTimer;
-   uses interface Timer<TMilli> as ReadTimer;
+   uses interface Timer<TMilli> as RelayTimer;
 }
 
 implementation {
    enum {
-      MAX_CLIENTS = 8,        // 8 concurrent chat clients
+      MAX_USERS = 8,          // 8 concurrent chat clients per server
+      MAX_CLIENTS = MAX_USERS + MAX_CHAT_SERVERS,   // plus one relay connection per peer server
+      MAX_REMOTE_USERS = 16,  // users known to be on other servers
       USERNAME_MAX = 12,      // Username bytes
       USERNAME_BUF = USERNAME_MAX + 1,       // Username storage with null character
       LINE_BUF_SIZE = 128,                   // Per-client assembled line buffer (commands + payload + CRLF)
       READ_BUF_SIZE = 64,                    // Temporary read buffer per socket read
-      CHAT_PORT = 41                         // TCP port
+      OUT_RING_SIZE = 1024,                  // Shared outbound ring, every line stored once
+      OUT_REC_HDR = 2,                       // Ring record header: [target][len]
+      OUT_TARGET_ALL = 0xFF,                 // Record target meaning every local user
+      OUT_TARGET_RELAY = 0xFE                // Record target meaning every peer server
    };
 
    typedef struct {
@@ -30,15 +35,53 @@ implementation {
       char username[USERNAME_BUF];
       char lineBuf[LINE_BUF_SIZE];
       uint8_t lineLen;
+      uint32_t outCursor;     // ring position of the next record this client has to consider
+      uint8_t outSent;        // bytes of that record already accepted by Transport.write
+      uint16_t stalls;        // drains that stopped on a full send window
+      uint16_t maxBacklog;    // largest ring backlog seen for this client (bytes)
+      bool isRelay;           // connection to another chat server, not a user
+      bool relayUp;           // relay connection established
+      uint16_t peer;          // relay: server node at the other end (0 until known)
    } client_entry_t;
 
+   typedef struct {
+      bool inUse;
+      uint16_t server;        // chat server the user is connected to
+      char username[USERNAME_BUF];
+   } remote_user_t;
+
    socket_t serverSocket = NULL_SOCKET;
+   socket_t relaySocket = NULL_SOCKET;
+   remote_user_t remoteUsers[MAX_REMOTE_USERS];
    client_entry_t clients[MAX_CLIENTS];
    uint8_t readBuf[READ_BUF_SIZE];
 
+   // Outbound ring. Lines are appended once as [target][len][bytes] records at
+   // monotonic positions; each client drains it through its own cursor.
+   uint8_t outRing[OUT_RING_SIZE];
+   uint32_t outHead = 0;       // position the next record is appended at
+   uint32_t outTail = 0;       // oldest position some client still needs
+   uint16_t outPeak = 0;       // high-water mark of outHead - outTail
+   uint16_t evictions = 0;     // clients dropped because the ring was full
+
+   void drainClient(client_entry_t *c);
+
    // helper functions
-   client_entry_t* allocClient(socket_t fd) {
+   client_entry_t* allocClient(socket_t fd, bool isRelay) {
       uint8_t i;
+      uint8_t users = 0;
+
+      if (!isRelay) {
+         for (i = 0; i < MAX_CLIENTS; i++) {
+            if (clients[i].inUse && !clients[i].isRelay) {
+               users++;
+            }
+         }
+         if (users >= MAX_USERS) {
+            return NULL;
+         }
+      }
+
       for (i = 0; i < MAX_CLIENTS; i++) {
          if (!clients[i].inUse) {
             clients[i].inUse = TRUE;
@@ -48,6 +91,13 @@ implementation {
             clients[i].username[0] = '\0';
             clients[i].lineBuf[0] = '\0';
             clients[i].lineLen = 0;
+            clients[i].outCursor = outHead;    // only lines queued from now on
+            clients[i].outSent = 0;
+            clients[i].stalls = 0;
+            clients[i].maxBacklog = 0;
+            clients[i].isRelay = isRelay;
+            clients[i].relayUp = FALSE;
+            clients[i].peer = 0;
             return &clients[i];
          }
       }
@@ -65,12 +115,246 @@ implementation {
       return NULL;
    }
 
-   void sendToClient(socket_t fd, char *msg) {
+   client_entry_t* findRelay(uint16_t peer) {
+      uint8_t i;
+      for (i = 0; i < MAX_CLIENTS; i++) {
+         if (clients[i].inUse && clients[i].isRelay && clients[i].peer == peer) {
+            return &clients[i];
+         }
+      }
+      return NULL;
+   }
+
+   remote_user_t* findRemoteUser(char *username) {
+      uint8_t i;
+      for (i = 0; i < MAX_REMOTE_USERS; i++) {
+         if (remoteUsers[i].inUse &&
+             strncmp(remoteUsers[i].username, username, USERNAME_MAX) == 0) {
+            return &remoteUsers[i];
+         }
+      }
+      return NULL;
+   }
+
+   void addRemoteUser(uint16_t server, char *username) {
+      remote_user_t *u = findRemoteUser(username);
+      uint8_t i;
+
+      if (u == NULL) {
+         for (i = 0; i < MAX_REMOTE_USERS; i++) {
+            if (!remoteUsers[i].inUse) {
+               u = &remoteUsers[i];
+               break;
+            }
+         }
+      }
+      if (u == NULL) {
+         dbg(CHAT_CHANNEL, "ChatServer: remote user table full, ignoring %s\n", username);
+         return;
+      }
+      u->inUse = TRUE;
+      u->server = server;
+      strncpy(u->username, username, USERNAME_MAX);
+      u->username[USERNAME_MAX] = '\0';
+   }
+
+   // Forget remote users of one server, or only the named one if username != NULL
+   void removeRemoteUsers(uint16_t server, char *username) {
+      uint8_t i;
+      for (i = 0; i < MAX_REMOTE_USERS; i++) {
+         if (remoteUsers[i].inUse && remoteUsers[i].server == server &&
+             (username == NULL ||
+              strncmp(remoteUsers[i].username, username, USERNAME_MAX) == 0)) {
+            remoteUsers[i].inUse = FALSE;
+         }
+      }
+   }
+
+   uint16_t parseNum(char *s) {
+      uint16_t v = 0;
+      while (*s >= '0' && *s <= '9') {
+         v = v * 10 + (*s - '0');
+         s++;
+      }
+      return v;
+   }
+
+   uint8_t outByte(uint32_t pos) {
+      return outRing[pos % OUT_RING_SIZE];
+   }
+
+   bool addressedTo(client_entry_t *c, uint8_t target) {
+      return target == (uint8_t)(c - clients) ||
+             (target == OUT_TARGET_ALL && !c->isRelay) ||
+             (target == OUT_TARGET_RELAY && c->isRelay);
+   }
+
+   // Move a client's cursor past records meant for other clients, so a client
+   // with nothing addressed to it never holds the ring back
+   void skipForeign(client_entry_t *c) {
+      uint8_t len;
+      if (c->outSent > 0) {
+         return;
+      }
+      while (c->outCursor < outHead && !addressedTo(c, outByte(c->outCursor))) {
+         len = outByte(c->outCursor + 1);
+         c->outCursor += OUT_REC_HDR + len;
+      }
+   }
+
+   // Oldest cursor over connected clients; everything before it can be reused
+   void advanceTail() {
+      uint8_t i;
+      uint32_t tail = outHead;
+      for (i = 0; i < MAX_CLIENTS; i++) {
+         if (!clients[i].inUse) {
+            continue;
+         }
+         skipForeign(&clients[i]);
+         if (clients[i].outCursor < tail) {
+            tail = clients[i].outCursor;
+         }
+      }
+      outTail = tail;
+   }
+
+   void relayUser(char *verb, char *username);
+
+   void dropClient(client_entry_t *c) {
+      dbg(CHAT_CHANNEL, "ChatServer: drop fd=%hhu stalls=%hu maxBacklog=%hu\n",
+          c->fd, c->stalls, c->maxBacklog);
+      if (c->isRelay) {
+         // Peer server gone: its users are unreachable until it reconnects
+         removeRemoteUsers(c->peer, NULL);
+      } else if (c->username[0] != '\0') {
+         relayUser("leave", c->username);
+      }
+      c->inUse = FALSE;
+      c->fd = NULL_SOCKET;
+      c->username[0] = '\0';
+      advanceTail();
+   }
+
+   // Ring is full: disconnect the client furthest behind so the others keep flowing.
+   // Called right after advanceTail(), so every cursor short of outHead sits on a record
+   // addressed to that client: only clients really stalled on their send window qualify.
+   bool evictSlowest() {
+      uint8_t i;
+      client_entry_t *slow = NULL;
+      socket_t fd;
+
+      for (i = 0; i < MAX_CLIENTS; i++) {
+         if (clients[i].inUse && clients[i].outCursor < outHead &&
+             (slow == NULL || clients[i].outCursor < slow->outCursor)) {
+            slow = &clients[i];
+         }
+      }
+      if (slow == NULL) {
+         return FALSE;
+      }
+
+      fd = slow->fd;
+      evictions++;
+      dbg(CHAT_CHANNEL, "ChatServer: evicting slow client fd=%hhu backlog=%lu evictions=%hu\n",
+          fd, (unsigned long)(outHead - slow->outCursor), evictions);
+      dropClient(slow);
+      call Transport.close(fd);
+      return TRUE;
+   }
+
+   // Append one line for target (a client slot or OUT_TARGET_ALL)
+   void enqueueLine(uint8_t target, char *msg) {
       uint16_t len = strlen(msg);
-      if (len == 0) {
+      uint16_t i;
+
+      if (len == 0 || len > 255) {
          return;
       }
-      call Transport.write(fd, (uint8_t *)msg, len);
+
+      while (outHead - outTail + OUT_REC_HDR + len > OUT_RING_SIZE) {
+         // Skipping records meant for other clients may free enough on its own
+         advanceTail();
+         if (outHead - outTail + OUT_REC_HDR + len <= OUT_RING_SIZE) {
+            break;
+         }
+         if (!evictSlowest()) {
+            // Nobody is behind on a record of their own; the whole ring is free
+            outTail = outHead;
+         }
+      }
+
+      outRing[outHead % OUT_RING_SIZE] = target;
+      outRing[(outHead + 1) % OUT_RING_SIZE] = (uint8_t)len;
+      for (i = 0; i < len; i++) {
+         outRing[(outHead + OUT_REC_HDR + i) % OUT_RING_SIZE] = (uint8_t)msg[i];
+      }
+      outHead += OUT_REC_HDR + len;
+
+      if (outHead - outTail > outPeak) {
+         outPeak = (uint16_t)(outHead - outTail);
+      }
+   }
+
+   // Push as much of this client's pending output into its socket as the window takes
+   void drainClient(client_entry_t *c) {
+      uint8_t target;
+      uint8_t len;
+      uint8_t chunk[LINE_BUF_SIZE];
+      uint16_t n;
+      uint16_t i;
+      uint32_t backlog;
+
+      if (!c->inUse || c->fd == NULL_SOCKET) {
+         return;
+      }
+
+      backlog = outHead - c->outCursor;
+      if (backlog > c->maxBacklog) {
+         c->maxBacklog = (backlog > 65535U) ? 65535U : (uint16_t)backlog;
+      }
+
+      while (c->outCursor < outHead) {
+         target = outByte(c->outCursor);
+         len = outByte(c->outCursor + 1);
+
+         if (!addressedTo(c, target)) {
+            c->outCursor += OUT_REC_HDR + len;
+            continue;
+         }
+
+         // Gather the unsent tail of the record (it may wrap) and hand it to Transport
+         for (i = c->outSent; i < len; i++) {
+            chunk[i - c->outSent] = outByte(c->outCursor + OUT_REC_HDR + i);
+         }
+         n = call Transport.write(c->fd, chunk, len - c->outSent);
+         if (n == 0) {
+            // Window full: writable() resumes from here
+            c->stalls++;
+            break;
+         }
+
+         c->outSent += n;
+         if (c->outSent >= len) {
+            c->outCursor += OUT_REC_HDR + len;
+            c->outSent = 0;
+         }
+      }
+
+      advanceTail();
+   }
+
+   void drainAll() {
+      uint8_t i;
+      for (i = 0; i < MAX_CLIENTS; i++) {
+         if (clients[i].inUse) {
+            drainClient(&clients[i]);
+         }
+      }
+   }
+
+   void sendToClient(client_entry_t *c, char *msg) {
+      enqueueLine((uint8_t)(c - clients), msg);
+      drainClient(c);
    }
 
    uint16_t appendStr(char *dst, uint16_t idx, char *src, uint16_t maxLen) {
@@ -88,6 +372,19 @@ implementation {
       return idx;
    }
 
+   uint16_t appendNum(char *dst, uint16_t idx, uint16_t value, uint16_t maxLen) {
+      char digits[5];
+      uint8_t n = 0;
+      do {
+         digits[n++] = '0' + (value % 10);
+         value /= 10;
+      } while (value > 0 && n < sizeof(digits));
+      while (n > 0) {
+         idx = appendChar(dst, idx, digits[--n], maxLen);
+      }
+      return idx;
+   }
+
    void finalizeCrlf(char *buf, uint16_t idx, uint16_t maxLen) {
       if (idx + 2 < maxLen) {
          buf[idx++] = '\r';
@@ -96,22 +393,65 @@ implementation {
       buf[idx] = '\0';
    }
 
-   void broadcast(char *sender, char *msg) {
+   // Relay lines go to one peer server, or to every peer if peer == NULL
+   void sendRelay(client_entry_t *peer, char *line) {
+      if (peer == NULL) {
+         enqueueLine(OUT_TARGET_RELAY, line);
+         drainAll();
+      } else {
+         sendToClient(peer, line);
+      }
+   }
+
+   // "relay join|leave <user>" to every peer
+   void relayUser(char *verb, char *username) {
       char outBuf[LINE_BUF_SIZE];
       uint16_t idx = 0;
+
+      idx = appendStr(outBuf, idx, "relay ", sizeof(outBuf));
+      idx = appendStr(outBuf, idx, verb, sizeof(outBuf));
+      idx = appendChar(outBuf, idx, ' ', sizeof(outBuf));
+      idx = appendStr(outBuf, idx, username, sizeof(outBuf));
+      finalizeCrlf(outBuf, idx, sizeof(outBuf));
+      sendRelay(NULL, outBuf);
+   }
+
+   // Bring a new relay peer up to date: who we are and which users we serve
+   void relayIntroduce(client_entry_t *peer) {
+      char outBuf[LINE_BUF_SIZE];
+      uint16_t idx;
       uint8_t i;
 
+      idx = 0;
+      idx = appendStr(outBuf, idx, "relay hello ", sizeof(outBuf));
+      idx = appendNum(outBuf, idx, TOS_NODE_ID, sizeof(outBuf));
+      finalizeCrlf(outBuf, idx, sizeof(outBuf));
+      sendToClient(peer, outBuf);
+
+      for (i = 0; i < MAX_CLIENTS; i++) {
+         if (clients[i].inUse && !clients[i].isRelay && clients[i].username[0] != '\0') {
+            idx = 0;
+            idx = appendStr(outBuf, idx, "relay join ", sizeof(outBuf));
+            idx = appendStr(outBuf, idx, clients[i].username, sizeof(outBuf));
+            finalizeCrlf(outBuf, idx, sizeof(outBuf));
+            sendToClient(peer, outBuf);
+         }
+      }
+   }
+
+   void broadcast(char *sender, char *msg) {
+      char outBuf[LINE_BUF_SIZE];
+      uint16_t idx = 0;
+
       idx = appendStr(outBuf, idx, "msgFrom ", sizeof(outBuf));
       idx = appendStr(outBuf, idx, sender, sizeof(outBuf));
       idx = appendChar(outBuf, idx, ' ', sizeof(outBuf));
       idx = appendStr(outBuf, idx, msg, sizeof(outBuf));
       finalizeCrlf(outBuf, idx, sizeof(outBuf));
 
-      for (i = 0; i < MAX_CLIENTS; i++) {
-         if (clients[i].inUse && clients[i].fd != NULL_SOCKET) {
-            sendToClient(clients[i].fd, outBuf);
-         }
-      }
+      // Stored once in the ring; each client picks it up through its cursor
+      enqueueLine(OUT_TARGET_ALL, outBuf);
+      drainAll();
    }
 
    void whisperTo(char *target, char *sender, char *msg) {
@@ -127,7 +467,7 @@ implementation {
          idx = appendChar(outBuf, idx, ' ', sizeof(outBuf));
          idx = appendStr(outBuf, idx, msg, sizeof(outBuf));
          finalizeCrlf(outBuf, idx, sizeof(outBuf));
-         sendToClient(dest->fd, outBuf);
+         sendToClient(dest, outBuf);
       }
    }
 
@@ -147,13 +487,90 @@ implementation {
          }
       }
 
+      // Users on other servers, as learned from relay join/leave
+      for (i = 0; i < MAX_REMOTE_USERS && idx + 1 < sizeof(outBuf); i++) {
+         if (remoteUsers[i].inUse) {
+            if (idx > 12) {
+               idx = appendChar(outBuf, idx, ',', sizeof(outBuf));
+            }
+            idx = appendStr(outBuf, idx, remoteUsers[i].username, sizeof(outBuf));
+         }
+      }
+
       finalizeCrlf(outBuf, idx, sizeof(outBuf));
       dbg(CHAT_CHANNEL, "ChatServer listUsrRply to %s: %s\n",
           (c->username[0] != '\0') ? c->username : "<nouser>", outBuf);
-      sendToClient(c->fd, outBuf);
+      sendToClient(c, outBuf);
+   }
+
+   // Copy the first space-delimited word of src (at most USERNAME_MAX bytes) into
+   // word; returns what follows the space, or NULL if there is none
+   char* splitWord(char *src, char *word) {
+      char *space = strchr(src, ' ');
+      uint8_t len;
+      if (space == NULL) {
+         return NULL;
+      }
+      len = space - src;
+      if (len > USERNAME_MAX) {
+         len = USERNAME_MAX;
+      }
+      memcpy(word, src, len);
+      word[len] = '\0';
+      return space + 1;
+   }
+
+   // Lines from a peer server; these are only ever delivered locally, never relayed again
+   void processRelayLine(client_entry_t *c, char *line) {
+      char user[USERNAME_BUF];
+      char target[USERNAME_BUF];
+      char *rest;
+
+      if (strncmp(line, "relay hello ", 12) == 0) {
+         c->peer = parseNum(line + 12);
+         c->relayUp = TRUE;
+         dbg(CHAT_CHANNEL, "ChatServer: relay up with server %hu (fd=%hhu)\n", c->peer, c->fd);
+         return;
+      }
+
+      if (strncmp(line, "relay join ", 11) == 0) {
+         addRemoteUser(c->peer, line + 11);
+         dbg(CHAT_CHANNEL, "ChatServer: remote user=%s on server %hu\n", line + 11, c->peer);
+         return;
+      }
+
+      if (strncmp(line, "relay leave ", 12) == 0) {
+         removeRemoteUsers(c->peer, line + 12);
+         return;
+      }
+
+      if (strncmp(line, "relay msg ", 10) == 0) {
+         rest = splitWord(line + 10, user);
+         if (rest != NULL) {
+            broadcast(user, rest);
+         }
+         return;
+      }
+
+      if (strncmp(line, "relay whisper ", 14) == 0) {
+         rest = splitWord(line + 14, target);
+         if (rest == NULL) {
+            return;
+         }
+         rest = splitWord(rest, user);
+         if (rest != NULL) {
+            whisperTo(target, user, rest);
+         }
+         return;
+      }
    }
 
    void processLine(client_entry_t *c, char *line) {
+      if (c->isRelay) {
+         processRelayLine(c, line);
+         return;
+      }
+
       if (c->username[0] == '\0') {
          if (strncmp(line, "hello ", 6) == 0) {
             char *u = line + 6;
@@ -163,13 +580,25 @@ implementation {
             }
             c->username[i] = '\0';
             dbg(CHAT_CHANNEL, "ChatServer: user=%s joined\n", c->username);
+            relayUser("join", c->username);
          }
          return;
       }
 
       if (strncmp(line, "msg ", 4) == 0) {
          char *m = line + 4;
+         char outBuf[LINE_BUF_SIZE];
+         uint16_t idx = 0;
+
          broadcast(c->username, m);
+
+         // Peer servers deliver it to their own users
+         idx = appendStr(outBuf, idx, "relay msg ", sizeof(outBuf));
+         idx = appendStr(outBuf, idx, c->username, sizeof(outBuf));
+         idx = appendChar(outBuf, idx, ' ', sizeof(outBuf));
+         idx = appendStr(outBuf, idx, m, sizeof(outBuf));
+         finalizeCrlf(outBuf, idx, sizeof(outBuf));
+         sendRelay(NULL, outBuf);
          return;
       }
 
@@ -194,7 +623,25 @@ implementation {
             
             target[len] = '\0';
          }
-         whisperTo(target, c->username, space + 1);
+         if (findClientByUsername(target) != NULL) {
+            whisperTo(target, c->username, space + 1);
+         } else {
+            // Not ours: hand it to the server that has the user
+            remote_user_t *u = findRemoteUser(target);
+            client_entry_t *peer = (u != NULL) ? findRelay(u->server) : NULL;
+            if (peer != NULL) {
+               char outBuf[LINE_BUF_SIZE];
+               uint16_t idx = 0;
+               idx = appendStr(outBuf, idx, "relay whisper ", sizeof(outBuf));
+               idx = appendStr(outBuf, idx, target, sizeof(outBuf));
+               idx = appendChar(outBuf, idx, ' ', sizeof(outBuf));
+               idx = appendStr(outBuf, idx, c->username, sizeof(outBuf));
+               idx = appendChar(outBuf, idx, ' ', sizeof(outBuf));
+               idx = appendStr(outBuf, idx, space + 1, sizeof(outBuf));
+               finalizeCrlf(outBuf, idx, sizeof(outBuf));
+               sendRelay(peer, outBuf);
+            }
+         }
          return;
       }
 
@@ -204,17 +651,18 @@ implementation {
       }
    }
 
-   void handleRead(client_entry_t *c) {
+   // Consume one read() worth of data; returns bytes read
+   uint16_t readChunk(client_entry_t *c) {
       uint16_t n = call Transport.read(c->fd, readBuf, READ_BUF_SIZE);
       if (n == 0) {
-         return;
+         return 0;
       }
 
       // Append to line buffer
       if (c->lineLen + n >= LINE_BUF_SIZE) {
          c->lineLen = 0;
          c->lineBuf[0] = '\0';
-         return;
+         return n;
       }
       {
          uint8_t i;
@@ -254,6 +702,42 @@ implementation {
             break;
          }
       }
+      return n;
+   }
+
+   // readable() is edge-triggered: drain everything buffered
+   void handleRead(client_entry_t *c) {
+      while (c->inUse && readChunk(c) > 0) {
+      }
+   }
+
+   client_entry_t* findClientByFd(socket_t fd) {
+      uint8_t i;
+      for (i = 0; i < MAX_CLIENTS; i++) {
+         if (clients[i].inUse && clients[i].fd == fd) {
+            return &clients[i];
+         }
+      }
+      return NULL;
+   }
+
+   command void ChatServer.printStats() {
+      uint8_t i;
+      uint8_t users = 0;
+      uint8_t relays = 0;
+      uint8_t remote = 0;
+      uint16_t stalls = 0;
+      if (serverSocket == NULL_SOCKET) return;
+      for (i = 0; i < MAX_CLIENTS; i++) {
+         if (!clients[i].inUse) continue;
+         if (clients[i].isRelay) relays++; else users++;
+         stalls += clients[i].stalls;
+      }
+      for (i = 0; i < MAX_REMOTE_USERS; i++) {
+         if (remoteUsers[i].inUse) remote++;
+      }
+      dbg(STATS_CHANNEL, "STAT chat users=%u relays=%u remoteusers=%u backlog=%lu ringpeak=%u evictions=%u stalls=%u\n",
+          users, relays, remote, (unsigned long)(outHead - outTail), outPeak, evictions, stalls);
    }
 
    command void ChatServer.start() {
@@ -269,8 +753,11 @@ implementation {
          clients[i].username[0] = '\0';
          clients[i].lineBuf[0] = '\0';
          clients[i].lineLen = 0;
+         clients[i].isRelay = FALSE;
+      }
+      for (i = 0; i < MAX_REMOTE_USERS; i++) {
+         remoteUsers[i].inUse = FALSE;
       }
-
 
       serverSocket = call Transport.socket();
       if (serverSocket == NULL_SOCKET) {
@@ -296,39 +783,134 @@ implementation {
          return;
       }
 
-      call AcceptTimer.startPeriodic(200);
-      call ReadTimer.startPeriodic(200);
       dbg(CHAT_CHANNEL, "ChatServer: listening on port %hu\n", CHAT_PORT);
+
+      // Relay endpoint for the other chat servers
+      relaySocket = call Transport.socket();
+      if (relaySocket != NULL_SOCKET) {
+         addr.port = CHAT_RELAY_PORT;
+         if (call Transport.bind(relaySocket, &addr) != SUCCESS ||
+             call Transport.listen(relaySocket) != SUCCESS) {
+            dbg(CHAT_CHANNEL, "ChatServer: relay listen failed port=%hu\n", CHAT_RELAY_PORT);
+            call Transport.close(relaySocket);
+            relaySocket = NULL_SOCKET;
+         }
+      }
+      call RelayTimer.startPeriodic(CHAT_RELAY_RETRY);
    }
 
-   event void AcceptTimer.fired() {
-      if (serverSocket == NULL_SOCKET) {
-         call AcceptTimer.stop();
-         call ReadTimer.stop();
+   // Open the relay connection to chatServers[k]
+   void connectRelay(uint8_t k) {
+      socket_addr_t addr;
+      socket_t fd;
+      client_entry_t *c;
+
+      fd = call Transport.socket();
+      if (fd == NULL_SOCKET) {
+         return;
+      }
+      addr.addr = TOS_NODE_ID;
+      addr.port = CHAT_RELAY_LOCAL_PORT + k;
+      if (call Transport.bind(fd, &addr) != SUCCESS) {
+         call Transport.close(fd);
+         return;
+      }
+      addr.addr = chatServers[k];
+      addr.port = CHAT_RELAY_PORT;
+      if (call Transport.connect(fd, &addr) != SUCCESS) {
+         call Transport.close(fd);
+         return;
+      }
+      c = allocClient(fd, TRUE);
+      if (c == NULL) {
+         call Transport.close(fd);
+         return;
+      }
+      c->peer = chatServers[k];
+      dbg(CHAT_CHANNEL, "ChatServer: relay connecting to server %hu (fd=%hhu)\n", c->peer, fd);
+      relayIntroduce(c);
+   }
+
+   // Full mesh: the lower node id dials every higher one and redials after failures
+   event void RelayTimer.fired() {
+      uint8_t k;
+      client_entry_t *c;
+
+      for (k = 0; k < CHAT_SERVER_COUNT && k < MAX_CHAT_SERVERS; k++) {
+         if (chatServers[k] <= TOS_NODE_ID) {
+            continue;
+         }
+         c = findRelay(chatServers[k]);
+         if (c != NULL && !c->relayUp) {
+            // Handshake did not finish within a whole retry period
+            socket_t fd = c->fd;
+            dropClient(c);
+            call Transport.close(fd);
+            c = NULL;
+         }
+         if (c == NULL) {
+            connectRelay(k);
+         }
+      }
+   }
+
+   event void Transport.acceptable(socket_t listenFd) {
+      bool isRelay;
+
+      if (listenFd == NULL_SOCKET ||
+          (listenFd != serverSocket && listenFd != relaySocket)) {
          return;
       }
+      isRelay = (listenFd == relaySocket);
+
       while (1) {
-         socket_t fd = call Transport.accept(serverSocket);
+         socket_t fd = call Transport.accept(listenFd);
          client_entry_t *c;
          if (fd == NULL_SOCKET) {
             break;
          }
-         c = allocClient(fd);
+         c = allocClient(fd, isRelay);
          if (c == NULL) {
             dbg(CHAT_CHANNEL, "ChatServer: max clients reached, closing fd=%hhu\n", fd);
             call Transport.close(fd);
+         } else if (isRelay) {
+            // Peer id arrives in its "relay hello"; send our side of the introduction now
+            c->relayUp = TRUE;
+            dbg(CHAT_CHANNEL, "ChatServer: accepted relay fd=%hhu\n", fd);
+            relayIntroduce(c);
          } else {
             dbg(CHAT_CHANNEL, "ChatServer: accepted fd=%hhu\n", fd);
          }
       }
    }
 
-   event void ReadTimer.fired() {
-      uint8_t i;
-      for (i = 0; i < MAX_CLIENTS; i++) {
-         if (clients[i].inUse && clients[i].fd != NULL_SOCKET) {
-            handleRead(&clients[i]);
+   event void Transport.readable(socket_t fd) {
+      client_entry_t *c = findClientByFd(fd);
+      if (c != NULL) {
+         handleRead(c);
+      }
+   }
+
+   // Send window opened again: resume this client's backlog
+   event void Transport.writable(socket_t fd) {
+      client_entry_t *c = findClientByFd(fd);
+      if (c != NULL) {
+         if (c->isRelay) {
+            c->relayUp = TRUE;    // first writable() on a dialled relay: handshake done
          }
+         drainClient(c);
+      }
+   }
+
+   // Client hung up: drop its entry and finish closing our side
+   event void Transport.closed(socket_t fd) {
+      client_entry_t *c = findClientByFd(fd);
+      if (c == NULL) {
+         return;
       }
+      dbg(CHAT_CHANNEL, "ChatServer: user=%s left (fd=%hhu)\n",
+          (c->username[0] != '\0') ? c->username : "<nouser>", fd);
+      dropClient(c);
+      call Transport.close(fd);
    }
 }
\ No newline at end of file
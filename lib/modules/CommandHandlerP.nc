@@ -30,11 +30,228 @@ implementation{
         return ((uint16_t)buff[0] << 8) | buff[1];
     }
 
+    // Reassembly state for CMD_FRAME (one command in flight at a time)
+    uint8_t frameBuf[CMD_MULTI_MAX_PAYLOAD];
+    uint8_t frameCmd = 0;
+    uint8_t frameTag = 0;
+    uint8_t frameCount = 0;
+    uint16_t frameMask = 0;
+    uint16_t frameLen = 0;
+
+    // Zero-padded copy of one CMD_BATCH record, so fixed-offset readers stay in bounds
+    uint8_t batchBuf[CMD_MULTI_MAX_PAYLOAD];
+
+    void dispatchCommand(uint8_t commandID, uint8_t* buff, uint16_t len);
+
+    // Copy a NUL-terminated string of at most max bytes out of a command payload
+    static uint8_t copyString(char *dst, uint8_t *src, uint16_t len, uint16_t max) {
+        uint8_t i;
+        for (i = 0; i < max && i < len && src[i] != 0; i++) {
+            dst[i] = src[i];
+        }
+        dst[i] = '\0';
+        return i;
+    }
+
+    void handleFrame(uint8_t* buff) {
+        cmd_frame_header_t *hdr = (cmd_frame_header_t *)buff;
+        uint8_t index = hdr->index;
+        uint8_t count = hdr->count;
+        uint8_t len = hdr->len;
+        uint16_t bit;
+
+        if (hdr->id == CMD_FRAME || count == 0 || count > CMD_MAX_FRAMES || index >= count || len > CMD_FRAME_DATA ||
+            (index + 1 < count && len != CMD_FRAME_DATA)) {
+            dbg(COMMAND_CHANNEL, "CMD_FRAME: bad frame %d/%d len=%d\n", index, count, len);
+            return;
+        }
+
+        // A new tag starts a new command; anything half-assembled is abandoned
+        if (frameMask == 0 || hdr->tag != frameTag) {
+            if (frameMask != 0) {
+                dbg(COMMAND_CHANNEL, "CMD_FRAME: dropped incomplete command %d (tag=%d)\n", frameCmd, frameTag);
+            }
+            frameTag = hdr->tag;
+            frameCmd = hdr->id;
+            frameCount = count;
+            frameMask = 0;
+            frameLen = 0;
+            memset(frameBuf, 0, sizeof(frameBuf));
+        }
+
+        bit = (uint16_t)1 << index;
+        if (frameMask & bit) return;
+        frameMask |= bit;
+        memcpy(&frameBuf[index * CMD_FRAME_DATA], &buff[CMD_FRAME_HDR_LEN], len);
+        frameLen += len;
+
+        if (frameMask == (uint16_t)((1UL << frameCount) - 1)) {
+            frameMask = 0;
+            dbg(COMMAND_CHANNEL, "CMD_FRAME: command %d reassembled (%d bytes, %d frames)\n", frameCmd, frameLen, frameCount);
+            dispatchCommand(frameCmd, frameBuf, frameLen);
+        }
+    }
+
+    void handleBatch(uint8_t* buff, uint16_t len) {
+        uint16_t pos = 1;
+        uint8_t n = 0;
+        uint8_t count;
+        uint8_t id;
+        uint8_t subLen;
+
+        if (len == 0) return;
+        count = buff[0];
+
+        while (n < count) {
+            if (pos + 2 > len) {
+                dbg(COMMAND_CHANNEL, "CMD_BATCH: record %d truncated\n", n);
+                break;
+            }
+            id = buff[pos];
+            subLen = buff[pos + 1];
+            pos += 2;
+            if (pos + subLen > len) {
+                dbg(COMMAND_CHANNEL, "CMD_BATCH: record %d truncated\n", n);
+                break;
+            }
+            if (id == CMD_BATCH || id == CMD_FRAME) {
+                dbg(COMMAND_CHANNEL, "CMD_BATCH: command %d cannot be nested\n", id);
+            } else {
+                memset(batchBuf, 0, sizeof(batchBuf));
+                memcpy(batchBuf, &buff[pos], subLen);
+                dispatchCommand(id, batchBuf, subLen);
+            }
+            pos += subLen;
+            n++;
+        }
+        dbg(COMMAND_CHANNEL, "CMD_BATCH: dispatched %d of %d commands\n", n, count);
+    }
+
+    // Run one command. buff holds at least CMD_PACKET_MAX_PAYLOAD_SIZE bytes
+    // (zero-padded past len), so the fixed-layout commands can read it directly.
+    void dispatchCommand(uint8_t commandID, uint8_t* buff, uint16_t len) {
+        // Find out which command was called
+        switch(commandID){
+            case CMD_PING:
+                // dbg(COMMAND_CHANNEL, "Command Type: Ping\n");
+                signal CommandHandler.ping(buff[0], &buff[1]);
+                break;
+
+            case CMD_NEIGHBOR_DUMP:
+                // dbg(COMMAND_CHANNEL, "Command Type: Neighbor Dump\n");
+                signal CommandHandler.printNeighbors();
+                break;
+
+            case CMD_LINKSTATE_DUMP:
+                // dbg(COMMAND_CHANNEL, "Command Type: Link State Dump\n");
+                signal CommandHandler.printLinkState();
+                break;
+
+            case CMD_ROUTETABLE_DUMP:
+                // dbg(COMMAND_CHANNEL, "Command Type: Route Table Dump\n");
+                signal CommandHandler.printRouteTable();
+                break;
+
+            case CMD_TEST_CLIENT:
+                dbg(COMMAND_CHANNEL, "Command Type: Test_Client\n");
+                testClientAddress = readUint16(&buff[0]);
+                testClientDest = readUint16(&buff[2]);
+                testClientSrcPort = readUint16(&buff[4]);
+                testClientDestPort = readUint16(&buff[6]);
+                testClientTransfer = readUint16(&buff[8]);
+                signal CommandHandler.setTestClient();
+                break;
+
+            case CMD_TEST_SERVER:
+                dbg(COMMAND_CHANNEL, "Command Type: Test_Server\n");
+                testServerAddress = readUint16(&buff[0]);
+                testServerPort = readUint16(&buff[2]);
+                signal CommandHandler.setTestServer();
+                break;
+
+            case CMD_CLOSE:
+                dbg(COMMAND_CHANNEL, "Command Type: Test_Close\n");
+                testCloseClientAddr = readUint16(&buff[0]);
+                testCloseDest = readUint16(&buff[2]);
+                testCloseSrcPort = readUint16(&buff[4]);
+                testCloseDestPort = readUint16(&buff[6]);
+                signal CommandHandler.setTestClose();
+                break;
+
+            case CMD_CHAT_HELLO: {
+                cmd_chat_hello_t *hello = (cmd_chat_hello_t *)buff;
+                char username[CMD_CHAT_USERNAME_MAX + 1];
+                uint16_t clientPort;
+                uint8_t i;
+                for (i = 0; i < CMD_CHAT_USERNAME_MAX && hello->username[i] != 0; i++) {
+                    username[i] = hello->username[i];
+                }
+                username[i] = '\0';
+                clientPort = readUint16((uint8_t *)&hello->clientPort);
+                signal CommandHandler.chatHello(username, clientPort);
+                break;
+            }
+
+            case CMD_CHAT_MSG: {
+                char chatMsg[CMD_CHAT_LINE_MAX + 1];
+                copyString(chatMsg, buff, len, CMD_CHAT_LINE_MAX);
+                signal CommandHandler.chatMsg(chatMsg);
+                break;
+            }
+
+            case CMD_CHAT_WHISPER: {
+                char username[CMD_CHAT_USERNAME_MAX + 1];
+                char whisperMsg[CMD_CHAT_LINE_MAX + 1];
+                copyString(username, buff, CMD_CHAT_USERNAME_MAX, CMD_CHAT_USERNAME_MAX);
+                // A single frame leaves 13 bytes after the username; frames allow a full line
+                copyString(whisperMsg, &buff[CMD_CHAT_USERNAME_MAX],
+                           (len > CMD_CHAT_USERNAME_MAX) ? len - CMD_CHAT_USERNAME_MAX : 0, CMD_CHAT_LINE_MAX);
+                signal CommandHandler.chatWhisper(username, whisperMsg);
+                break;
+            }
+
+            case CMD_CHAT_LISTUSR:
+                signal CommandHandler.chatListUsr();
+                break;
+
+            case CMD_MCAST_JOIN:
+                signal CommandHandler.mcastJoin(buff[0]);
+                break;
+
+            case CMD_MCAST_LEAVE:
+                signal CommandHandler.mcastLeave(buff[0]);
+                break;
+
+            case CMD_MCAST_SEND:
+                signal CommandHandler.mcastSend(buff[0], &buff[1]);
+                break;
+
+            case CMD_FRAG_TEST:
+                dbg(COMMAND_CHANNEL, "Command Type: Frag_Test\n");
+                signal CommandHandler.fragTest(readUint16(&buff[0]), readUint16(&buff[2]));
+                break;
+
+            case CMD_STATS_DUMP:
+                signal CommandHandler.printStats();
+                break;
+
+            case CMD_FRAME:
+                handleFrame(buff);
+                break;
+
+            case CMD_BATCH:
+                handleBatch(buff, len);
+                break;
+
+            default:
+                dbg(COMMAND_CHANNEL, "CMD_ERROR: \"%d\" does not match any known commands.\n", commandID);
+                break;
+        }
+    }
+
     task void processCommand(){
         if(! call Queue.empty()){
             CommandMsg *msg;
-            uint8_t commandID;
-            uint8_t* buff;
             message_t *raw_msg;
             void *payload;
 
@@ -51,107 +268,7 @@ implementation{
             msg = (CommandMsg*) payload;
 
             // dbg(COMMAND_CHANNEL, "A Command has been Issued.\n");
-            buff = (uint8_t*) msg->payload;
-            commandID = msg->id;
-
-            // Find out which command was called
-            switch(commandID){
-                case CMD_PING:
-                    // dbg(COMMAND_CHANNEL, "Command Type: Ping\n");
-                    signal CommandHandler.ping(buff[0], &buff[1]);
-                    break;
-
-                case CMD_NEIGHBOR_DUMP:
-                    // dbg(COMMAND_CHANNEL, "Command Type: Neighbor Dump\n");
-                    signal CommandHandler.printNeighbors();
-                    break;
-
-                case CMD_LINKSTATE_DUMP:
-                    // dbg(COMMAND_CHANNEL, "Command Type: Link State Dump\n");
-                    signal CommandHandler.printLinkState();
-                    break;
-
-                case CMD_ROUTETABLE_DUMP:
-                    // dbg(COMMAND_CHANNEL, "Command Type: Route Table Dump\n");
-                    signal CommandHandler.printRouteTable();
-                    break;
-
-                case CMD_TEST_CLIENT:
-                    dbg(COMMAND_CHANNEL, "Command Type: Test_Client\n");
-                    testClientAddress = readUint16(&buff[0]);
-                    testClientDest = readUint16(&buff[2]);
-                    testClientSrcPort = readUint16(&buff[4]);
-                    testClientDestPort = readUint16(&buff[6]);
-                    testClientTransfer = readUint16(&buff[8]);
-                    signal CommandHandler.setTestClient();
-                    break;
-
-                case CMD_TEST_SERVER:
-                    dbg(COMMAND_CHANNEL, "Command Type: Test_Server\n");
-                    testServerAddress = readUint16(&buff[0]);
-                    testServerPort = readUint16(&buff[2]);
-                    signal CommandHandler.setTestServer();
-                    break;
-
-                case CMD_CLOSE:
-                    dbg(COMMAND_CHANNEL, "Command Type: Test_Close\n");
-                    testCloseClientAddr = readUint16(&buff[0]);
-                    testCloseDest = readUint16(&buff[2]);
-                    testCloseSrcPort = readUint16(&buff[4]);
-                    testCloseDestPort = readUint16(&buff[6]);
-                    signal CommandHandler.setTestClose();
-                    break;
-
-                case CMD_CHAT_HELLO: {
-                    cmd_chat_hello_t *hello = (cmd_chat_hello_t *)buff;
-                    char username[CMD_CHAT_USERNAME_MAX + 1];
-                    uint16_t clientPort;
-                    uint8_t i;
-                    for (i = 0; i < CMD_CHAT_USERNAME_MAX && hello->username[i] != 0; i++) {
-                        username[i] = hello->username[i];
-                    }
-                    username[i] = '\0';
-                    clientPort = readUint16((uint8_t *)&hello->clientPort);
-                    signal CommandHandler.chatHello(username, clientPort);
-                    break;
-                }
-
-                case CMD_CHAT_MSG: {
-                    char chatMsg[CMD_CHAT_MSG_MAX + 1];
-                    uint8_t i;
-                    for (i = 0; i < CMD_CHAT_MSG_MAX && buff[i] != 0; i++) {
-                        chatMsg[i] = buff[i];
-                    }
-                    chatMsg[i] = '\0';
-                    signal CommandHandler.chatMsg(chatMsg);
-                    break;
-                }
-
-                case CMD_CHAT_WHISPER: {
-                    cmd_chat_whisper_t *whisper = (cmd_chat_whisper_t *)buff;
-                    char username[CMD_CHAT_USERNAME_MAX + 1];
-                    char whisperMsg[CMD_CHAT_WHISPER_MSG_MAX + 1];
-                    uint8_t i;
-                    for (i = 0; i < CMD_CHAT_USERNAME_MAX && whisper->username[i] != 0; i++) {
-                        username[i] = whisper->username[i];
-                    }
-                    username[i] = '\0';
-                    for (i = 0; i < CMD_CHAT_WHISPER_MSG_MAX && whisper->msg[i] != 0; i++) {
-                        whisperMsg[i] = whisper->msg[i];
-                    }
-                    whisperMsg[i] = '\0';
-                    signal CommandHandler.chatWhisper(username, whisperMsg);
-                    break;
-                }
-
-                case CMD_CHAT_LISTUSR:
-                    signal CommandHandler.chatListUsr();
-                    break;
-
-                default:
-                    dbg(COMMAND_CHANNEL, "CMD_ERROR: \"%d\" does not match any known commands.\n", msg->id);
-                    break;
-                }
+            dispatchCommand(msg->id, (uint8_t*) msg->payload, CMD_PACKET_MAX_PAYLOAD_SIZE);
             call Pool.put(raw_msg);
         }
 
@@ -11,7 +11,7 @@ typedef struct {
 
 enum {
    MAX_DUP_ENTRIES = 20,      // 20 because we have at most 20 neighbors
-   FLOOD_PROTOCOL = 3,       // 3 because 1=ND, 2=Routing
+   FLOOD_PROTOCOL = 3,       // 3 because 0/1=ping, 2=Routing, 9/10=ND
    DUP_AGE_TIMEOUT = 10000  // 10 seconds because nodes should re-flood within this time
 };
 
@@ -27,6 +27,14 @@ implementation {
    dupEntry_t dupTable[MAX_DUP_ENTRIES];       // Create an array to hold duplicate node entries in the table
    uint8_t numDupEntries = 0;
    bool running = FALSE;
+   uint16_t originSeq = 0;     // Dedup sequence for floods we originate, shared by every client (LSAs, group adverts)
+
+   // Counters for stats dumps
+   uint16_t statOriginated = 0;   // floods started here
+   uint16_t statAccepted = 0;     // new floods received and passed up
+   uint16_t statDuplicates = 0;   // copies suppressed by the dup table
+   uint16_t statForwarded = 0;    // per-link copies sent
+   uint16_t statTtlDrops = 0;     // packets dropped with TTL 0
 
 
    // Function to find a duplicate entry by source addr
@@ -104,6 +112,7 @@ implementation {
       // Drop if TTL expired
       if (pkt->TTL == 0) {
          dbg(FLOODING_CHANNEL, "Flood: TTL expired, dropping\n");
+         statTtlDrops++;
          return;
       }
 
@@ -116,6 +125,7 @@ implementation {
          if (call ND.getNeighbor(i, &neighborAddr, &isActive) && isActive) {
             if (neighborAddr == inbound) continue; // skip inbound link (don't send back to where it came from)
             call SS.send(*pkt, neighborAddr); // SimpleSend is synchronous so it will block the node until send is done
+            statForwarded++;
             dbg(FLOODING_CHANNEL, "Flood: FWD seq=%d to %d TTL=%d\n", pkt->seq, neighborAddr, pkt->TTL);       // Shows flooding activity
          }
       }
@@ -142,6 +152,7 @@ implementation {
    command error_t Flooding.send(pack msg, uint16_t dest) {
       if (!running) return FAIL;
       msg.protocol = FLOOD_PROTOCOL;
+      msg.seq = ++originSeq;     // Clients keep their own sequence numbers in the payload
       if (msg.TTL == 0) msg.TTL = MAX_TTL;
       updateDupEntry(msg.src, msg.seq);    // Update own entry to prevent re-receiving own flood packets
       if (msg.payload[0]=='L' && msg.payload[1]=='S' && msg.payload[2]=='A') {
@@ -149,10 +160,17 @@ implementation {
       } else {
          dbg(FLOODING_CHANNEL, "Flood: Originating seq=%d TTL=%d\n", msg.seq, msg.TTL);
       }
+      statOriginated++;
       forwardPerLink(&msg, 0xFFFF);  // Broadcast to all neighbors, so inbound is invalid
       return SUCCESS;
    }
 
+   command void Flooding.printStats() {
+      dbg(STATS_CHANNEL, "STAT flood originated=%u accepted=%u duplicates=%u forwarded=%u ttldrops=%u dupentries=%u\n",
+          statOriginated, statAccepted, statDuplicates, statForwarded, statTtlDrops, numDupEntries);
+      call SS.printStats("flood_send");
+   }
+
    // Timer event to age out old dup entries
    event void dupTimer.fired() {
       if (running) {
@@ -160,15 +178,20 @@ implementation {
       }
    }
 
+   // Per-link forwarding reads the ND table on every send, so a lost neighbor needs no action here
+   event void ND.neighborLost(uint16_t addr) {}
+
    // Handle received packets from ND to check for dups and forward if not a dup
    command void Flooding.onReceive(pack* pkt, uint16_t from) {
       if (!running) return;
       if (pkt->protocol != FLOOD_PROTOCOL) return;
       if (isDuplicate(pkt->src, pkt->seq)) {
          dbg(FLOODING_CHANNEL, "Flood: Duplicate from %d seq=%d\n", pkt->src, pkt->seq);
+         statDuplicates++;
          return;
       }
       updateDupEntry(pkt->src, pkt->seq);
+      statAccepted++;
       if (pkt->payload[0]=='L' && pkt->payload[1]=='S' && pkt->payload[2]=='A') {
          dbg(FLOODING_CHANNEL, "Flooding: Forwarding LSA from %d seq=%d\n", pkt->src, pkt->seq);
       }
@@ -0,0 +1,19 @@
+#include "../../includes/am_types.h"
+
+configuration FragmentC{
+   provides interface Fragment;
+   uses interface LinkState;
+}
+
+implementation{
+   components FragmentP;
+   Fragment = FragmentP.Fragment;
+
+   components new SimpleSendC(AM_PACK) as FragSend;
+   FragmentP.SS -> FragSend;          // Queue holds a whole datagram's worth of fragments
+
+   components new TimerMilliC() as ReassemblyTimer;
+   FragmentP.reassemblyTimer -> ReassemblyTimer;   // Reclaims slots whose fragments stopped arriving
+
+   FragmentP.LinkState = LinkState;
+}
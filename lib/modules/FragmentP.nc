@@ -0,0 +1,222 @@
+#include <Timer.h>
+#include "../../includes/packet.h"
+#include "../../includes/protocol.h"
+#include "../../includes/channels.h"
+
+#ifndef FRAG_MAX_FRAGS
+#define FRAG_MAX_FRAGS 12          // Fragments per datagram (fits the 16-bit received mask)
+#endif
+
+#ifndef FRAG_SLOTS
+#define FRAG_SLOTS 4               // Datagrams being reassembled at once
+#endif
+
+#ifndef FRAG_REASSEMBLY_TIMEOUT
+#define FRAG_REASSEMBLY_TIMEOUT 3000   // Give up on a datagram this long after its last fragment
+#endif
+
+// Each fragment: pack header (seq = datagram id) + frag_header_t + up to FRAG_DATA bytes
+typedef nx_struct frag_header_t {
+   nx_uint8_t index;          // Position of this fragment, 0-based
+   nx_uint8_t count;          // Fragments in the datagram
+   nx_uint8_t protocol;       // Protocol of the reassembled datagram
+   nx_uint8_t len;            // Data bytes in this fragment
+} frag_header_t;
+
+enum {
+   FRAG_DATA = PACKET_MAX_PAYLOAD_SIZE - sizeof(frag_header_t),
+   FRAG_MAX_DATAGRAM = FRAG_MAX_FRAGS * FRAG_DATA,
+   FRAG_CHECK_PERIOD = 1000
+};
+
+typedef struct {
+   bool inUse;
+   uint16_t src;
+   uint16_t id;
+   uint8_t protocol;
+   uint8_t count;
+   uint16_t receivedMask;
+   uint16_t len;              // Bytes so far; final once every fragment is in
+   uint32_t lastHeard;
+   uint8_t data[FRAG_MAX_DATAGRAM];
+} reassembly_t;
+
+module FragmentP{
+   provides interface Fragment;
+
+   uses interface SimpleSend as SS;
+   uses interface LinkState;
+   uses interface Timer<TMilli> as reassemblyTimer;
+}
+
+implementation{
+   reassembly_t slots[FRAG_SLOTS];
+   uint16_t nextId = 0;
+   bool timerRunning = FALSE;
+
+   // Counters for printStats
+   uint16_t datagramsSent = 0;
+   uint16_t fragmentsSent = 0;
+   uint16_t datagramsDelivered = 0;
+   uint16_t datagramsLost = 0;
+   uint16_t fragmentsLost = 0;
+
+
+   uint8_t countReceived(uint16_t mask) {
+      uint8_t n = 0;
+      while (mask != 0) {
+         mask &= mask - 1;
+         n++;
+      }
+      return n;
+   }
+
+   // Report a datagram that will never complete and free its slot
+   void dropSlot(reassembly_t* r) {
+      uint8_t got = countReceived(r->receivedMask);
+      datagramsLost++;
+      fragmentsLost += r->count - got;
+      dbg(GENERAL_CHANNEL, "Frag: lost datagram from %d id=%d (%d/%d fragments)\n", r->src, r->id, got, r->count);
+      r->inUse = FALSE;
+      signal Fragment.lost(r->src, r->id, got, r->count);
+   }
+
+   // Find the slot for (src, id), or claim one. When all are busy the stalest is reclaimed.
+   reassembly_t* findSlot(uint16_t src, uint16_t id) {
+      uint8_t i;
+      reassembly_t* freeSlot = NULL;
+      reassembly_t* oldest = NULL;
+      for (i = 0; i < FRAG_SLOTS; i++) {
+         if (slots[i].inUse) {
+            if (slots[i].src == src && slots[i].id == id) return &slots[i];
+            if (oldest == NULL || slots[i].lastHeard < oldest->lastHeard) oldest = &slots[i];
+         } else if (freeSlot == NULL) {
+            freeSlot = &slots[i];
+         }
+      }
+      if (freeSlot == NULL) {
+         dropSlot(oldest);
+         freeSlot = oldest;
+      }
+      freeSlot->inUse = TRUE;
+      freeSlot->src = src;
+      freeSlot->id = id;
+      freeSlot->count = 0;
+      freeSlot->receivedMask = 0;
+      freeSlot->len = 0;
+      return freeSlot;
+   }
+
+   command error_t Fragment.send(uint16_t dest, uint8_t protocol, uint8_t* data, uint16_t len) {
+      pack msg;
+      frag_header_t hdr;
+      uint16_t nh;
+      uint16_t offset = 0;
+      uint8_t count;
+      uint8_t i;
+
+      if (len == 0 || len > FRAG_MAX_DATAGRAM) return FAIL;
+      nh = call LinkState.nextHop(dest);
+      if (nh == 0xFFFF) {
+         dbg(GENERAL_CHANNEL, "Frag: no route to %d\n", dest);
+         return FAIL;
+      }
+
+      count = (len + FRAG_DATA - 1) / FRAG_DATA;
+      msg.src = TOS_NODE_ID;
+      msg.dest = dest;
+      msg.seq = ++nextId;
+      msg.TTL = MAX_TTL;
+      msg.protocol = PROTOCOL_FRAGMENT;
+
+      for (i = 0; i < count; i++) {
+         uint8_t chunk = (len - offset > FRAG_DATA) ? FRAG_DATA : (uint8_t)(len - offset);
+         hdr.index = i;
+         hdr.count = count;
+         hdr.protocol = protocol;
+         hdr.len = chunk;
+         memcpy(msg.payload, &hdr, sizeof(frag_header_t));
+         memcpy(&msg.payload[sizeof(frag_header_t)], &data[offset], chunk);
+         if (call SS.send(msg, nh) != SUCCESS) {
+            dbg(GENERAL_CHANNEL, "Frag: send queue full at fragment %d/%d of id=%d\n", i, count, msg.seq);
+            return FAIL;
+         }
+         fragmentsSent++;
+         offset += chunk;
+      }
+      datagramsSent++;
+      dbg(GENERAL_CHANNEL, "Frag: sent id=%d len=%d to %d in %d fragments\n", msg.seq, len, dest, count);
+      return SUCCESS;
+   }
+
+   command void Fragment.onReceive(pack* pkt) {
+      frag_header_t hdr;
+      reassembly_t* r;
+      uint16_t bit;
+
+      memcpy(&hdr, pkt->payload, sizeof(frag_header_t));
+      if (hdr.count == 0 || hdr.count > FRAG_MAX_FRAGS || hdr.index >= hdr.count || hdr.len > FRAG_DATA) {
+         return;
+      }
+      // Every fragment but the last is full, so its offset follows from the index
+      if (hdr.index + 1 < hdr.count && hdr.len != FRAG_DATA) {
+         return;
+      }
+
+      r = findSlot(pkt->src, pkt->seq);
+      if (r->count == 0) {
+         r->count = hdr.count;
+         r->protocol = hdr.protocol;
+      } else if (r->count != hdr.count) {
+         return;
+      }
+      r->lastHeard = call reassemblyTimer.getNow();
+
+      bit = (uint16_t)1 << hdr.index;
+      if (r->receivedMask & bit) return;   // duplicate fragment
+      r->receivedMask |= bit;
+      memcpy(&r->data[hdr.index * FRAG_DATA], &pkt->payload[sizeof(frag_header_t)], hdr.len);
+      r->len += hdr.len;
+
+      if (r->receivedMask == (uint16_t)((1UL << r->count) - 1)) {
+         datagramsDelivered++;
+         r->inUse = FALSE;
+         signal Fragment.receive(r->src, r->protocol, r->data, r->len);
+         return;
+      }
+
+      if (!timerRunning) {
+         timerRunning = TRUE;
+         call reassemblyTimer.startPeriodic(FRAG_CHECK_PERIOD);
+      }
+   }
+
+   event void reassemblyTimer.fired() {
+      uint8_t i;
+      bool pending = FALSE;
+      uint32_t now = call reassemblyTimer.getNow();
+      for (i = 0; i < FRAG_SLOTS; i++) {
+         if (!slots[i].inUse) continue;
+         if (now - slots[i].lastHeard > FRAG_REASSEMBLY_TIMEOUT) {
+            dropSlot(&slots[i]);
+         } else {
+            pending = TRUE;
+         }
+      }
+      if (!pending) {
+         timerRunning = FALSE;
+         call reassemblyTimer.stop();
+      }
+   }
+
+   command void Fragment.printStats() {
+      uint8_t i;
+      uint8_t pending = 0;
+      for (i = 0; i < FRAG_SLOTS; i++) {
+         if (slots[i].inUse) pending++;
+      }
+      dbg(STATS_CHANNEL, "STAT frag sent=%u fragments=%u delivered=%u lost=%u fragslost=%u pending=%u\n",
+          datagramsSent, fragmentsSent, datagramsDelivered, datagramsLost, fragmentsLost, pending);
+      call SS.printStats("frag_send");
+   }
+}
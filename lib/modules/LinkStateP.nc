@@ -48,10 +48,40 @@ implementation {
    uint16_t dist[MAX_NODES];
    uint16_t prev[MAX_NODES];
    uint16_t nextHop[MAX_NODES];
+   uint32_t nextHopSet[MAX_NODES];   // Every first hop on an equal-cost shortest path (bit per neighbor id)
+
+   // Loop-free alternates: a second neighbor per destination whose own shortest path
+   // does not come back through us. Routes switch to it the moment ND reports the
+   // primary next hop lost, and stay there until new LSAs rerun Dijkstra.
+   uint16_t backupHop[MAX_NODES];
+   bool backupNodeSafe[MAX_NODES];   // The backup's path also avoids the primary next hop itself
+   uint32_t lostHops = 0;            // Neighbors ND reported lost and not seen active since (bit per id)
+   uint16_t nbrDist[MAX_NODES];      // Scratch Dijkstra from one neighbor
+   uint16_t nbrPrev[MAX_NODES];
+
+   // Shortest-path tree rooted at another node (multicast distribution trees).
+   // Cached for one root; cleared whenever the LSDB changes.
+   uint16_t treeRoot = INVALID_NODE;
+   uint16_t treeDist[MAX_NODES];
+   uint16_t treePrevOf[MAX_NODES];
+
+   // Counters for stats dumps
+   uint16_t statLsaSent = 0;       // LSAs we originated
+   uint16_t statLsaAccepted = 0;   // LSAs that changed the LSDB
+   uint16_t statLsaStale = 0;      // LSAs no newer than what we had
+   uint16_t statSpfRuns = 0;       // Dijkstra runs for our own routing table
+   uint16_t statTreeRuns = 0;      // Dijkstra runs for other roots (multicast trees)
+   uint16_t statLfaRuns = 0;       // Dijkstra runs from neighbors to find backup next hops
+   uint16_t statLost = 0;          // neighborLost events from ND
+   uint16_t statReroutes = 0;      // lookups answered with a backup because the primary was lost
 
    // Forward declarations
    void computeRoutes();
+   void runDijkstra(uint16_t src, uint16_t* d, uint16_t* p);
+   void computeEqualCostHops(uint16_t src);
+   void computeBackupHops(uint16_t src);
    void updateLocalLsdbFromND();
+   void floodLsa();
 
    // Find or create entry by nodeID
    LinkStateEntry* findEntry(uint16_t nodeID) {
@@ -101,36 +131,21 @@ implementation {
       running = TRUE;
       lsdbCount = 0;
       localSeq = 0;
+      lostHops = 0;
       {
          uint16_t i;
          for (i = 0; i < MAX_NODES; i++) {
             dist[i] = INF;
             prev[i] = INF;
             nextHop[i] = INF;
+            backupHop[i] = INF;
          }
       }
       call lsaTimer.startPeriodic(5000);
       // dbg(GENERAL_CHANNEL, "LS: Booted, starting periodic LSA flooding\n");
 
       // Proactively advertise once at startup so LSDBs populate early
-      {
-         pack msg;
-         uint8_t ok;
-         uint16_t plen = 0;
-         uint8_t neighborCount;
-         updateLocalLsdbFromND();
-         ok = buildLsaPayload((uint8_t*)msg.payload, &plen);
-         if (ok) {
-            msg.src = TOS_NODE_ID;
-            msg.dest = 0xFFFF;
-            msg.seq = localSeq;
-            msg.TTL = MAX_TTL;
-            msg.protocol = 3; // flood
-            neighborCount = msg.payload[LSA_TAG_LEN + 4];
-            call Flooding.send(msg, 0xFFFF);
-            // dbg(GENERAL_CHANNEL, "LS: Sent initial LSA seq=%d n=%d\n", localSeq, neighborCount);
-         }
-      }
+      floodLsa();
    }
 
    command void LinkState.stop() {
@@ -147,15 +162,35 @@ implementation {
 
    // Periodic LSA
    event void lsaTimer.fired() {
+      if (!running) return;
+
+      // dbg(GENERAL_CHANNEL, "LS: Timer fired, building new LSA\n");
+      floodLsa();
+   }
+
+   // Route around a dead neighbor right away: lookups through it now return the
+   // backup hop, and a triggered LSA starts the global reroute without waiting
+   // for the next lsaTimer period.
+   event void NeighborDiscovery.neighborLost(uint16_t addr) {
+      uint16_t i;
+      uint16_t moved = 0;
+      if (!running || addr >= MAX_NODES) return;
+      lostHops |= (uint32_t)1 << addr;
+      statLost++;
+      for (i = 0; i < MAX_NODES; i++) {
+         if (nextHop[i] == addr && backupHop[i] < INF) moved++;
+      }
+      dbg(ROUTING_CHANNEL, "LS: Neighbor %d lost, %d routes moved to backups\n", addr, moved);
+      floodLsa();
+   }
+
+   // Build and flood our LSA from the current ND table
+   void floodLsa() {
       pack msg;
       uint8_t ok;
       uint16_t plen = 0;
       uint8_t neighborCount;
 
-      if (!running) return;
-
-      // dbg(GENERAL_CHANNEL, "LS: Timer fired, building new LSA\n");
-
       // Refresh our own LSDB entry from current ND table
       updateLocalLsdbFromND();
 
@@ -168,7 +203,7 @@ implementation {
 
       msg.src = TOS_NODE_ID;
       msg.dest = 0xFFFF;
-      msg.seq = localSeq; // also used by Flooding for dedup
+      msg.seq = localSeq; // Flooding restamps this with its own sequence
       msg.TTL = MAX_TTL;
       msg.protocol = 3; // Use Flooding protocol to disseminate LSAs
 
@@ -176,6 +211,7 @@ implementation {
       neighborCount = msg.payload[LSA_TAG_LEN + 4];
       // dbg(GENERAL_CHANNEL, "LS: Flooding LSA from %d seq=%d n=%d\n", TOS_NODE_ID, localSeq, neighborCount);
       call Flooding.send(msg, 0xFFFF);
+      statLsaSent++;
       // dbg(GENERAL_CHANNEL, "LS: Sent LSA seq=%d n=%d\n", localSeq, neighborCount);
    }
 
@@ -202,8 +238,12 @@ implementation {
             return; // Table full, cannot add new entry
          }
       }
+      if (lsa.seqno <= e->seqno) {
+         statLsaStale++;
+      }
       if (lsa.seqno > e->seqno) {
          uint8_t i;
+         statLsaAccepted++;
          e->seqno = lsa.seqno;
          e->neighborCount = lsa.neighborCount;
          if (e->neighborCount > MAX_NEIGHBORS_LS) e->neighborCount = MAX_NEIGHBORS_LS;
@@ -221,43 +261,22 @@ implementation {
    }
 
 
-   // Build the adjacency matrix from the LSDB and run Dijkstra
-   void computeRoutes() {
-   uint16_t src;
+   // Dijkstra over cost[][] from src. Ties keep the lower-numbered predecessor,
+   // so every node with the same LSDB builds the same tree for a given root.
+   void runDijkstra(uint16_t src, uint16_t* d, uint16_t* p) {
    uint16_t i;
    uint16_t j;
    bool visited[MAX_NODES];
 
-   // Initialize matrix
    for (i = 0; i < MAX_NODES; i++) {
-      for (j = 0; j < MAX_NODES; j++) {
-         cost[i][j] = (i == j) ? 0 : INF;
-      }
-      dist[i] = INF;
-      prev[i] = INF;
-      nextHop[i] = INF;
+      d[i] = INF;
+      p[i] = INF;
       visited[i] = FALSE;
    }
 
-   // Populate cost from LSDB entries
-   for (i = 0; i < lsdbCount; i++) {
-      uint16_t u = lsdb[i].nodeID;
-      uint8_t k;
-      if (u >= MAX_NODES) continue;
-      for (k = 0; k < lsdb[i].neighborCount; k++) {
-         uint16_t v = lsdb[i].neighbors[k];
-         if (v >= MAX_NODES) continue;
-         cost[u][v] = 1;
-         cost[v][u] = 1;
-      }
-   }
-
-   src = TOS_NODE_ID;
-   if (src >= MAX_NODES) return;
-
    // Dijkstra initialization
-   dist[src] = 0;
-   prev[src] = src;
+   d[src] = 0;
+   p[src] = src;
 
    // Dijkstra loop
    for (i = 0; i < MAX_NODES; i++) {
@@ -265,8 +284,8 @@ implementation {
       uint16_t minDist = INF;
       // pick unvisited with smallest dist
       for (j = 0; j < MAX_NODES; j++) {
-         if (!visited[j] && dist[j] < minDist) {
-            minDist = dist[j];
+         if (!visited[j] && d[j] < minDist) {
+            minDist = d[j];
             u = j;
          }
       }
@@ -277,13 +296,67 @@ implementation {
       for (j = 0; j < MAX_NODES; j++) {
          uint16_t w = cost[u][j];
          if (w >= INF) continue;
-         if (dist[u] + w < dist[j]) {
-            dist[j] = dist[u] + w;
-            prev[j] = u;
+         if (d[u] + w < d[j]) {
+            d[j] = d[u] + w;
+            p[j] = u;
          }
       }
    }
    // finished computing distances and predecessors
+   }
+
+   // Build the adjacency matrix from the LSDB and run Dijkstra
+   void computeRoutes() {
+   uint16_t src;
+   uint16_t i;
+   uint16_t j;
+   bool known[MAX_NODES];
+
+   // Initialize matrix
+   for (i = 0; i < MAX_NODES; i++) {
+      for (j = 0; j < MAX_NODES; j++) {
+         cost[i][j] = (i == j) ? 0 : INF;
+      }
+      nextHop[i] = INF;
+      nextHopSet[i] = 0;
+      backupHop[i] = INF;
+      backupNodeSafe[i] = FALSE;
+      known[i] = FALSE;
+   }
+
+   // Populate cost from LSDB entries, one direction per advertisement
+   for (i = 0; i < lsdbCount; i++) {
+      uint16_t u = lsdb[i].nodeID;
+      uint8_t k;
+      if (u >= MAX_NODES) continue;
+      known[u] = TRUE;
+      for (k = 0; k < lsdb[i].neighborCount; k++) {
+         uint16_t v = lsdb[i].neighbors[k];
+         if (v >= MAX_NODES) continue;
+         cost[u][v] = 1;
+      }
+   }
+
+   // A link is up once both ends list each other. An end we have no LSA from yet
+   // is taken on trust; otherwise a dead node's last LSA would keep its links alive.
+   for (i = 0; i < MAX_NODES; i++) {
+      for (j = i + 1; j < MAX_NODES; j++) {
+         bool fromI = cost[i][j] < INF;
+         bool fromJ = cost[j][i] < INF;
+         bool up = (fromI || fromJ) && (fromI || !known[i]) && (fromJ || !known[j]);
+         cost[i][j] = up ? 1 : INF;
+         cost[j][i] = up ? 1 : INF;
+      }
+   }
+
+   // Any cached tree was built from the old topology
+   treeRoot = INVALID_NODE;
+
+   src = TOS_NODE_ID;
+   if (src >= MAX_NODES) return;
+
+   runDijkstra(src, dist, prev);
+   statSpfRuns++;
 
    // Compute nextHop for each destination by following prev chain
    for (i = 0; i < MAX_NODES; i++) {
@@ -308,6 +381,101 @@ implementation {
          nextHop[i] = INF;
       }
    }
+
+   computeEqualCostHops(src);
+   computeBackupHops(src);
+   }
+
+   // Collect all equal-cost first hops. Visiting destinations in order of distance means
+   // every predecessor on a shortest path is done first, so its set can just be OR'd in.
+   void computeEqualCostHops(uint16_t src) {
+   uint16_t order[MAX_NODES];
+   uint16_t count = 0;
+   uint16_t i;
+   uint16_t j;
+
+   for (i = 0; i < MAX_NODES; i++) {
+      if (i != src && dist[i] < INF) order[count++] = i;
+   }
+   // Selection sort by distance; at most MAX_NODES entries
+   for (i = 0; i + 1 < count; i++) {
+      uint16_t best = i;
+      for (j = i + 1; j < count; j++) {
+         if (dist[order[j]] < dist[order[best]]) best = j;
+      }
+      if (best != i) {
+         uint16_t tmp = order[i];
+         order[i] = order[best];
+         order[best] = tmp;
+      }
+   }
+
+   for (i = 0; i < count; i++) {
+      uint16_t v = order[i];
+      uint16_t u;
+      for (u = 0; u < MAX_NODES; u++) {
+         if (u == v || dist[u] >= INF || cost[u][v] >= INF) continue;
+         if (dist[u] + cost[u][v] != dist[v]) continue;
+         nextHopSet[v] |= (u == src) ? ((uint32_t)1 << v) : nextHopSet[u];
+      }
+   }
+   }
+
+   // For each destination pick a backup neighbor n that is loop-free: n's own
+   // shortest path is shorter than going back through us, dist(n,d) < dist(n,src) + dist(src,d),
+   // so n never hands the packet back. Backups whose path also skips the primary
+   // next hop are preferred, since they survive that node failing and not just the link.
+   // One Dijkstra per neighbor; neighbors are few, so this stays cheap next to the main run.
+   void computeBackupHops(uint16_t src) {
+   uint16_t bestCost[MAX_NODES];
+   uint16_t n;
+   uint16_t d;
+
+   for (d = 0; d < MAX_NODES; d++) bestCost[d] = INF;
+
+   for (n = 0; n < MAX_NODES; n++) {
+      if (n == src || cost[src][n] >= INF) continue;
+      runDijkstra(n, nbrDist, nbrPrev);
+      statLfaRuns++;
+
+      for (d = 0; d < MAX_NODES; d++) {
+         uint16_t primary = nextHop[d];
+         uint16_t step;
+         uint16_t total;
+         bool nodeSafe;
+         if (d == src || primary >= INF || n == primary) continue;
+         if (nbrDist[d] >= INF || nbrDist[d] >= nbrDist[src] + dist[d]) continue;
+
+         // Walk n's tree back from d; the primary must not appear on the path
+         nodeSafe = (d != primary);
+         step = d;
+         while (nodeSafe && step != n && nbrPrev[step] < INF) {
+            if (step == primary) nodeSafe = FALSE;
+            step = nbrPrev[step];
+         }
+
+         total = cost[src][n] + nbrDist[d];
+         if (backupHop[d] < INF) {
+            if (backupNodeSafe[d] && !nodeSafe) continue;
+            if (backupNodeSafe[d] == nodeSafe && total >= bestCost[d]) continue;
+         }
+         backupHop[d] = n;
+         backupNodeSafe[d] = nodeSafe;
+         bestCost[d] = total;
+      }
+   }
+   }
+
+   bool hopLost(uint16_t hop) {
+      return hop < MAX_NODES && (lostHops & ((uint32_t)1 << hop));
+   }
+
+   // The primary next hop, or the backup while ND has the primary marked lost
+   uint16_t liveHop(uint16_t dest) {
+      if (!hopLost(nextHop[dest])) return nextHop[dest];
+      if (backupHop[dest] >= INF || hopLost(backupHop[dest])) return INVALID_NODE;
+      statReroutes++;
+      return backupHop[dest];
    }
 
    // Debugging: print LSDB
@@ -334,23 +502,103 @@ implementation {
       }
    }
 
+   uint8_t countHops(uint32_t set) {
+      uint8_t n = 0;
+      while (set != 0) {
+         set &= set - 1;
+         n++;
+      }
+      return n;
+   }
+
    // Debugging: print routing table
    command void LinkState.printRouteTable() {
    uint16_t i;
    dbg(GENERAL_CHANNEL, "Routing Table for Node %d\n", TOS_NODE_ID);
    for (i = 0; i < MAX_NODES; i++) {
       if (i != TOS_NODE_ID && nextHop[i] < INF) {
-         dbg(GENERAL_CHANNEL, "Dest %d --> NextHop %d (dist=%d)\n", i, nextHop[i], dist[i]);
+         uint8_t paths = countHops(nextHopSet[i]);
+         if (paths > 1) {
+            dbg(GENERAL_CHANNEL, "Dest %d --> NextHop %d (dist=%d, %d equal-cost)\n", i, nextHop[i], dist[i], paths);
+         } else if (backupHop[i] < INF) {
+            dbg(GENERAL_CHANNEL, "Dest %d --> NextHop %d (dist=%d, backup %d%s)\n", i, nextHop[i], dist[i],
+                backupHop[i], backupNodeSafe[i] ? "" : " link-only");
+         } else {
+            dbg(GENERAL_CHANNEL, "Dest %d --> NextHop %d (dist=%d)\n", i, nextHop[i], dist[i]);
+         }
       }
    }
    }
 
+   command void LinkState.printStats() {
+   uint16_t i;
+   uint16_t routes = 0;
+   uint16_t multipath = 0;
+   uint16_t protectedRoutes = 0;
+   for (i = 0; i < MAX_NODES; i++) {
+      if (i == TOS_NODE_ID || nextHop[i] >= INF) continue;
+      routes++;
+      if (countHops(nextHopSet[i]) > 1) multipath++;
+      if (backupHop[i] < INF && backupNodeSafe[i]) protectedRoutes++;
+   }
+   dbg(STATS_CHANNEL, "STAT ls lsdb=%u routes=%u multipath=%u protected=%u lsasent=%u lsaaccepted=%u lsastale=%u spfruns=%u treeruns=%u lfaruns=%u lost=%u reroutes=%u\n",
+       lsdbCount, routes, multipath, protectedRoutes, statLsaSent, statLsaAccepted, statLsaStale, statSpfRuns, statTreeRuns,
+       statLfaRuns, statLost, statReroutes);
+   }
+
    command uint16_t LinkState.nextHop(uint16_t dest) {
       if (dest >= MAX_NODES) return INVALID_NODE;
       if (nextHop[dest] >= INF) return INVALID_NODE;
+      return liveHop(dest);
+   }
+
+   // Pick one of the equal-cost next hops by flow hash. The same flow always maps to
+   // the same neighbor; our id is mixed in so successive hops don't all make the same choice.
+   // Lost neighbors drop out of the set; with none left the backup hop is used.
+   command uint16_t LinkState.nextHopFor(uint16_t dest, uint16_t flowHash) {
+      uint32_t set;
+      uint8_t paths;
+      uint8_t pick;
+      uint16_t v;
+      if (dest >= MAX_NODES) return INVALID_NODE;
+      if (nextHop[dest] >= INF) return INVALID_NODE;
+      set = nextHopSet[dest] & ~lostHops;
+      paths = countHops(set);
+      if (paths == 0) return liveHop(dest);
+      if (set != nextHopSet[dest]) statReroutes++;
+      if (paths == 1 && !hopLost(nextHop[dest])) return nextHop[dest];
+
+      pick = (uint8_t)((uint16_t)(flowHash ^ (TOS_NODE_ID * 0x9E37u)) % paths);
+      for (v = 0; v < MAX_NODES; v++) {
+         if (!(set & ((uint32_t)1 << v))) continue;
+         if (pick == 0) return v;
+         pick--;
+      }
       return nextHop[dest];
    }
 
+   command uint16_t LinkState.treeParent(uint16_t root, uint16_t node) {
+      uint16_t* p = prev;
+      if (root >= MAX_NODES || node >= MAX_NODES || root == node) return INVALID_NODE;
+      if (root != TOS_NODE_ID) {
+         if (treeRoot != root) {
+            runDijkstra(root, treeDist, treePrevOf);
+            statTreeRuns++;
+            treeRoot = root;
+         }
+         p = treePrevOf;
+      }
+      if (p[node] >= INF) return INVALID_NODE;
+      return p[node];
+   }
+
+   command uint16_t LinkState.distance(uint16_t dest) {
+      if (dest == TOS_NODE_ID) return 0;
+      if (dest >= MAX_NODES) return INVALID_NODE;
+      if (dist[dest] >= INF) return INVALID_NODE;
+      return dist[dest];
+   }
+
    // Update or insert our own LSDB entry from NeighborDiscovery table
    void updateLocalLsdbFromND() {
       LinkStateEntry* e = findEntry(TOS_NODE_ID);
@@ -369,6 +617,8 @@ implementation {
          uint16_t addr; bool active;
          if (call NeighborDiscovery.getNeighbor(i, &addr, &active) && active) {
             e->neighbors[e->neighborCount++] = addr;
+            // Seen again since it was lost, so it can carry traffic again
+            if (addr < MAX_NODES) lostHops &= ~((uint32_t)1 << addr);
          }
       }
    }
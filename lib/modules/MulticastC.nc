@@ -0,0 +1,20 @@
+#include "../../includes/am_types.h"
+
+configuration MulticastC{
+   provides interface Multicast;
+   uses interface LinkState;
+}
+
+implementation{
+   components MulticastP, FloodingC;
+   Multicast = MulticastP.Multicast;
+
+   components new SimpleSendC(AM_PACK) as McastSend;
+   MulticastP.SS -> McastSend;         // One copy per tree branch
+
+   components new TimerMilliC() as AdvertTimer;
+   MulticastP.advertTimer -> AdvertTimer;   // Periodic membership refresh for late joiners
+
+   MulticastP.Flooding -> FloodingC.Flooding;   // Membership adverts ride on flooding like LSAs
+   MulticastP.LinkState = LinkState;            // Distribution trees come from the LSDB
+}
@@ -0,0 +1,224 @@
+#include <Timer.h>
+#include "../../includes/packet.h"
+#include "../../includes/protocol.h"
+#include "../../includes/channels.h"
+
+#ifndef MCAST_ADVERT_PERIOD
+#define MCAST_ADVERT_PERIOD 20000   // Re-flood our membership so late-booting nodes learn it
+#endif
+
+enum {
+   MCAST_MAX_GROUPS = 16,    // One bit per group in a 16-bit membership mask
+   MCAST_MAX_NODES = 20,     // Same node range as the LSDB in LinkStateP
+   MCAST_TAG_LEN = 3,
+   MCAST_NO_NODE = 0xFFFF
+};
+
+// Payload format: "GRP" + grp_advert_t
+typedef nx_struct grp_advert_t {
+   nx_uint16_t origin;
+   nx_uint16_t seqno;
+   nx_uint16_t groups;       // Bit g set = origin is a member of group g
+} grp_advert_t;
+
+module MulticastP{
+   provides interface Multicast;
+
+   uses interface Flooding;
+   uses interface LinkState;
+   uses interface SimpleSend as SS;
+   uses interface Timer<TMilli> as advertTimer;
+}
+
+implementation{
+   uint16_t members[MCAST_MAX_NODES];       // Group mask per node id, ours included
+   uint16_t memberSeq[MCAST_MAX_NODES];     // Newest advert seen from each node
+   uint16_t lastDataSeq[MCAST_MAX_NODES];   // Newest data packet seen from each source
+   uint16_t advertSeq = 0;
+   uint16_t dataSeq = 0;
+   bool running = FALSE;
+
+   // Counters for stats dumps
+   uint16_t statSent = 0;         // packets originated here
+   uint16_t statCopies = 0;       // per-branch copies sent (originated or forwarded)
+   uint16_t statDelivered = 0;    // packets handed to the application
+   uint16_t statDuplicates = 0;   // copies dropped as already seen
+
+
+   // Flood our current group mask, tagged so LinkStateP ignores it
+   void advertise() {
+      pack msg;
+      grp_advert_t adv;
+
+      msg.payload[0] = 'G'; msg.payload[1] = 'R'; msg.payload[2] = 'P';
+      adv.origin = TOS_NODE_ID;
+      adv.seqno = ++advertSeq;
+      adv.groups = members[TOS_NODE_ID];
+      memcpy(&msg.payload[MCAST_TAG_LEN], &adv, sizeof(grp_advert_t));
+
+      msg.src = TOS_NODE_ID;
+      msg.dest = 0xFFFF;
+      msg.TTL = MAX_TTL;
+      msg.protocol = 3;
+      call Flooding.send(msg, 0xFFFF);
+      dbg(MULTICAST_CHANNEL, "Mcast: advertised groups=0x%04x seq=%d\n", members[TOS_NODE_ID], advertSeq);
+   }
+
+
+   // Send one copy of pkt down each branch of the source's tree that leads to a member.
+   // A branch is found by climbing from every member toward the root: if the climb
+   // passes through us, the node just below us is the child to send to.
+   uint8_t forwardDown(pack* pkt) {
+      uint16_t root = pkt->src;
+      uint16_t bit = 1 << pkt->dest;
+      bool isBranch[MCAST_MAX_NODES];
+      uint16_t m;
+      uint8_t copies = 0;
+
+      for (m = 0; m < MCAST_MAX_NODES; m++) {
+         isBranch[m] = FALSE;
+      }
+
+      for (m = 0; m < MCAST_MAX_NODES; m++) {
+         uint16_t cur = m;
+         uint16_t parent;
+         uint8_t hops = 0;
+         if (m == TOS_NODE_ID || m == root || !(members[m] & bit)) continue;
+         parent = call LinkState.treeParent(root, cur);
+         while (parent != MCAST_NO_NODE && parent != TOS_NODE_ID && hops < MCAST_MAX_NODES) {
+            cur = parent;
+            parent = call LinkState.treeParent(root, cur);
+            hops++;
+         }
+         if (parent == TOS_NODE_ID) {
+            isBranch[cur] = TRUE;
+         }
+      }
+
+      for (m = 0; m < MCAST_MAX_NODES; m++) {
+         if (!isBranch[m]) continue;
+         if (call SS.send(*pkt, m) == SUCCESS) {
+            copies++;
+            statCopies++;
+            dbg(MULTICAST_CHANNEL, "Mcast: FWD group=%d src=%d seq=%d to %d TTL=%d\n", pkt->dest, pkt->src, pkt->seq, m, pkt->TTL);
+         }
+      }
+      return copies;
+   }
+
+
+   command void Multicast.start() {
+      uint8_t i;
+      for (i = 0; i < MCAST_MAX_NODES; i++) {
+         members[i] = 0;
+         memberSeq[i] = 0;
+         lastDataSeq[i] = 0;
+      }
+      running = TRUE;
+      call advertTimer.startPeriodic(MCAST_ADVERT_PERIOD);
+   }
+
+   command error_t Multicast.join(uint8_t group) {
+      if (!running || group >= MCAST_MAX_GROUPS || TOS_NODE_ID >= MCAST_MAX_NODES) return FAIL;
+      members[TOS_NODE_ID] |= (1 << group);
+      dbg(MULTICAST_CHANNEL, "Mcast: joined group %d\n", group);
+      advertise();
+      return SUCCESS;
+   }
+
+   command error_t Multicast.leave(uint8_t group) {
+      if (!running || group >= MCAST_MAX_GROUPS || TOS_NODE_ID >= MCAST_MAX_NODES) return FAIL;
+      members[TOS_NODE_ID] &= ~(1 << group);
+      dbg(MULTICAST_CHANNEL, "Mcast: left group %d\n", group);
+      advertise();
+      return SUCCESS;
+   }
+
+   command error_t Multicast.send(uint8_t group, uint8_t* payload) {
+      pack msg;
+      uint8_t copies;
+      if (!running || group >= MCAST_MAX_GROUPS || TOS_NODE_ID >= MCAST_MAX_NODES) return FAIL;
+
+      msg.src = TOS_NODE_ID;
+      msg.dest = group;
+      msg.seq = ++dataSeq;
+      msg.TTL = MAX_TTL;
+      msg.protocol = PROTOCOL_MULTICAST;
+      memcpy(msg.payload, payload, PACKET_MAX_PAYLOAD_SIZE);
+
+      copies = forwardDown(&msg);
+      statSent++;
+      dbg(MULTICAST_CHANNEL, "Mcast: send group=%d seq=%d copies=%d\n", group, msg.seq, copies);
+      return SUCCESS;
+   }
+
+   // Deliver locally if we are a member, then pass the packet down our branches
+   command void Multicast.onReceive(pack* pkt, uint16_t from) {
+      uint16_t group = pkt->dest;
+      if (!running) return;
+      if (pkt->protocol != PROTOCOL_MULTICAST) return;
+      if (group >= MCAST_MAX_GROUPS || pkt->src >= MCAST_MAX_NODES) return;
+
+      // Trees can briefly disagree while LSDBs converge; drop any copy we already handled
+      if (pkt->seq <= lastDataSeq[pkt->src]) {
+         dbg(MULTICAST_CHANNEL, "Mcast: Duplicate from %d seq=%d via %d\n", pkt->src, pkt->seq, from);
+         statDuplicates++;
+         return;
+      }
+      lastDataSeq[pkt->src] = pkt->seq;
+
+      if (members[TOS_NODE_ID] & (1 << group)) {
+         statDelivered++;
+         signal Multicast.receive(group, pkt->src, pkt->payload);
+      }
+
+      if (pkt->TTL == 0) {
+         dbg(MULTICAST_CHANNEL, "Mcast: TTL expired, dropping\n");
+         return;
+      }
+      pkt->TTL--;
+      forwardDown(pkt);
+   }
+
+   command void Multicast.printGroups() {
+      uint8_t i;
+      dbg(MULTICAST_CHANNEL, "Group membership at node %d:\n", TOS_NODE_ID);
+      for (i = 0; i < MCAST_MAX_NODES; i++) {
+         if (members[i] != 0) {
+            dbg(MULTICAST_CHANNEL, "  Node %d groups=0x%04x\n", i, members[i]);
+         }
+      }
+   }
+
+   command void Multicast.printStats() {
+      dbg(STATS_CHANNEL, "STAT mcast groups=0x%04x adverts=%u sent=%u copies=%u delivered=%u duplicates=%u\n",
+          members[TOS_NODE_ID], advertSeq, statSent, statCopies, statDelivered, statDuplicates);
+      call SS.printStats("mcast_send");
+   }
+
+   event void advertTimer.fired() {
+      // Nodes that never joined have nothing to say
+      if (running && advertSeq > 0) {
+         advertise();
+      }
+   }
+
+   // Membership adverts arrive through flooding alongside LSAs
+   event void Flooding.receive(pack pkt, uint16_t from) {
+      grp_advert_t adv;
+      uint16_t origin;
+      if (!running) return;
+      if (pkt.protocol != 3) return;
+      if (pkt.payload[0] != 'G' || pkt.payload[1] != 'R' || pkt.payload[2] != 'P') return;
+      memcpy(&adv, &pkt.payload[MCAST_TAG_LEN], sizeof(grp_advert_t));
+
+      origin = adv.origin;
+      if (origin >= MCAST_MAX_NODES || origin == TOS_NODE_ID) return;
+      if (adv.seqno <= memberSeq[origin]) return;
+      memberSeq[origin] = adv.seqno;
+      if (members[origin] != adv.groups) {
+         dbg(MULTICAST_CHANNEL, "Mcast: node %d groups 0x%04x -> 0x%04x\n", origin, members[origin], (uint16_t)adv.groups);
+      }
+      members[origin] = adv.groups;
+   }
+}
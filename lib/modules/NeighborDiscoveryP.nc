@@ -17,8 +17,8 @@ enum {
    MAX_NEIGHBORS = 10,          // 10 for small networks
    ND_REQ_INTERVAL = 2000,  // 2 seconds
    ND_MISS_THRESHOLD = 5,   // age out after 5 missed periods
-   ND_REQ_TYPE = 1,          // 1 is for ND request packets
-   ND_REP_TYPE = 2            // 2 is for ND reply packets
+   ND_REQ_TYPE = PROTOCOL_ND_REQ,   // ND request packets
+   ND_REP_TYPE = PROTOCOL_ND_REP    // ND reply packets (1 and 2 are ping and ping reply)
 };
 
 generic module NeighborDiscoveryP() {
@@ -37,6 +37,12 @@ implementation {
    bool running = FALSE;
    uint16_t reqSeq = 0;
 
+   // Counters for stats dumps
+   uint16_t statReqSent = 0;
+   uint16_t statRepSent = 0;
+   uint16_t statReqRecv = 0;
+   uint16_t statRepRecv = 0;
+
    // Function to find a neighbor by source address using linear search
    neighbor_t* findNeighbor(uint16_t addr) {
       uint8_t i;
@@ -84,6 +90,7 @@ implementation {
          req.protocol = ND_REQ_TYPE;           // set protocol type to ND
          memcpy(req.payload, "ND_REQ", 6);
          call SS.send(req, 0xFFFF);
+         statReqSent++;
          if ((req.seq % 10) == 0) {
             // Display every 10th REQ for debugging to reduce console spam
             // dbg(GENERAL_CHANNEL, "ND: Sent REQ seq=%d\n", req.seq);
@@ -102,6 +109,7 @@ implementation {
                memcpy(req2.payload, "ND_REQ", 6);
                call SS.send(req2, neighbors[i].addr);
                neighbors[i].numReqSentTo++;
+               statReqSent++;
                if ((req2.seq % 10) == 0) {
                   // dbg(GENERAL_CHANNEL, "ND: Sent REQ to %d seq=%d\n", neighbors[i].addr, req2.seq);
                }
@@ -120,6 +128,7 @@ implementation {
       rep.protocol = ND_REP_TYPE;
       memcpy(rep.payload, "ND_REP", 6);
       call SS.send(rep, dest);
+      statRepSent++;
       // dbg(GENERAL_CHANNEL, "ND: Sent REP to %d\n", dest);
    }
 
@@ -143,6 +152,7 @@ implementation {
             if (neighbors[i].missedCount > ND_MISS_THRESHOLD) {          // Deactivate after threshold (5 periods)
                neighbors[i].active = FALSE;
                // dbg(GENERAL_CHANNEL, "ND: Aged out neighbor %d\n", neighbors[i].addr);
+               signal NeighborDiscovery.neighborLost(neighbors[i].addr);
             }
          }
       }
@@ -220,12 +230,14 @@ implementation {
 
       // Handle ND packets by checking type and updating neighbor table
       if (pkt->protocol == ND_REQ_TYPE && pkt->src != TOS_NODE_ID) {
+         statReqRecv++;
          updateNeighborOnSeen(from);
          sendNDRep(from);
          // dbg(GENERAL_CHANNEL, "ND: Received REQ from %d\n", from);
 
          // Update stats for the neighbor that send the REQ
       } else if (pkt->protocol == ND_REP_TYPE && pkt->src != TOS_NODE_ID) {
+         statRepRecv++;
          updateNeighborOnSeen(from);
          n = findNeighbor(from);
          // Update stats for existing neighbor that sent the REP
@@ -236,6 +248,17 @@ implementation {
       }
    }
 
+   command void NeighborDiscovery.printStats() {
+      uint8_t i;
+      uint8_t active = 0;
+      for (i = 0; i < numNeighbors; i++) {
+         if (neighbors[i].active) active++;
+      }
+      dbg(STATS_CHANNEL, "STAT nd neighbors=%u active=%u reqsent=%u repsent=%u reqrecv=%u reprecv=%u\n",
+          numNeighbors, active, statReqSent, statRepSent, statReqRecv, statRepRecv);
+      call SS.printStats("nd_send");
+   }
+
    // Method to get # of neighbors in table
    command uint8_t NeighborDiscovery.getNeighborCount() {
       return numNeighbors;
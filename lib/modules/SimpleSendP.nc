@@ -23,6 +23,13 @@ implementation{
    bool busy = FALSE;
    message_t pkt;
 
+   // Counters for stats dumps
+   uint16_t queued = 0;       // packets accepted into the queue
+   uint16_t dropped = 0;      // packets refused because the pool was empty
+   uint16_t transmitted = 0;  // packets handed to the radio
+   uint16_t radioBusy = 0;    // send attempts deferred because the radio was busy
+   uint8_t maxDepth = 0;      // deepest the queue has been
+
    error_t send(uint16_t src, uint16_t dest, pack *message);
 
    // Call this method to send a task to add a delay between sends (to avoid collisions)
@@ -45,15 +52,25 @@ implementation{
 
          // Now that we have a value from the pool we can put it into our queue
          call Queue.enqueue(input);
+         queued++;
+         if (call Queue.size() > maxDepth) {
+            maxDepth = call Queue.size();
+         }
 
          // Start a send task which will be delayed.
          postSendTask();
 
          return SUCCESS;
       }
+      dropped++;
       return FAIL;
    }
 
+   command void SimpleSend.printStats(char *name){
+      dbg(STATS_CHANNEL, "STAT %s queued=%u dropped=%u sent=%u busy=%u depth=%u maxdepth=%u\n",
+          name, queued, dropped, transmitted, radioBusy, call Queue.size(), maxDepth);
+   }
+
    task void sendBufferTask(){
        // If there are values in the queue and the radio is not busy, then attempt to send a packet
       if(!call Queue.empty() && !busy){
@@ -65,6 +82,9 @@ implementation{
          if(SUCCESS == send(info->src,info->dest, &(info->packet))){
             call Queue.dequeue();
             call Pool.put(info);
+            transmitted++;
+         }else{
+            radioBusy++;
          }
 
 
@@ -11,7 +11,10 @@ implementation {
    components ActiveMessageC;
    components new TimerMilliC() as TestTimerC;
    components new TimerMilliC() as RetransTimerC;
+   components new TimerMilliC() as AckTimerC;
+   components new TimerMilliC() as PaceTimerC;
    components MainC;
+   components RandomC as Random;
    
    Transport = TransportP.Transport;
    TransportP.LinkState = LinkState;
@@ -19,6 +22,9 @@ implementation {
    TransportP.Packet -> ActiveMessageC;
    TransportP.TestTimer -> TestTimerC;
    TransportP.RetransTimer -> RetransTimerC;
+   TransportP.AckTimer -> AckTimerC;
+   TransportP.PaceTimer -> PaceTimerC;
    TransportP.Boot -> MainC.Boot;
+   TransportP.Random -> Random;
 }
 
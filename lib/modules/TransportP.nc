@@ -19,18 +19,34 @@ enum {
    TCP_STATE_TIME_WAIT
 };
 
-// Buffer size constants
+// Per-socket buffer caps (multiples of TCP_CHUNK_SIZE). Memory is only
+// committed as chunks are borrowed from the shared pool below.
 #ifndef SEND_BUF_SIZE
-#define SEND_BUF_SIZE 128
+#define SEND_BUF_SIZE 512
 #endif
 
 #ifndef RECV_BUF_SIZE
-#define RECV_BUF_SIZE 128
+#define RECV_BUF_SIZE 512
 #endif
 
+// Shared buffer pool: TCP_POOL_CHUNKS chunks of TCP_CHUNK_SIZE bytes for all
+// sockets (at most 255 chunks; index 0xFF marks an unbacked slot)
+#ifndef TCP_CHUNK_SIZE
+#define TCP_CHUNK_SIZE 32
+#endif
+
+#ifndef TCP_POOL_CHUNKS
+#define TCP_POOL_CHUNKS 64
+#endif
+
+#define TCP_NO_CHUNK 0xFF
+#define SEND_BUF_SLOTS (SEND_BUF_SIZE / TCP_CHUNK_SIZE)
+#define RECV_BUF_SLOTS (RECV_BUF_SIZE / TCP_CHUNK_SIZE)
+
 // RTT / timeout tuning
 #ifndef TCP_RTT_EST
 #define TCP_RTT_EST 500 
+#endif
 
 #ifndef TCP_TIMEOUT
 #define TCP_TIMEOUT (2 * TCP_RTT_EST)
@@ -38,8 +54,58 @@ enum {
 
 #ifndef TCP_TIME_WAIT
 #define TCP_TIME_WAIT 5000  
+#endif
+
+// Delayed ACKs: ACK every TCP_DELACK_SEGS in-order segments or after TCP_DELACK_TIMEOUT ms
+#ifndef TCP_DELACK_SEGS
+#define TCP_DELACK_SEGS 2
+#endif
+
+#ifndef TCP_DELACK_TIMEOUT
+#define TCP_DELACK_TIMEOUT 100
+#endif
+
+// Pacing: spread each socket's segments over the smoothed RTT at a rate of
+// TCP_PACING_GAIN% of cwnd/SRTT (0 disables pacing on new sockets)
+#ifndef TCP_PACING_GAIN
+#define TCP_PACING_GAIN 125
+#endif
+
+// Offer the compact header in our SYNs (set to 0 to always use the full header)
+#ifndef TCP_COMPACT_ENABLE
+#define TCP_COMPACT_ENABLE 1
+#endif
 
-#define MAX_SOCKETS 8
+// Fast open: servers hand out cookies and take data on SYNs carrying a valid one
+// (set to 0 to always run the full handshake). Clients cache TCP_FASTOPEN_CACHE cookies.
+#ifndef TCP_FASTOPEN_ENABLE
+#define TCP_FASTOPEN_ENABLE 1
+#endif
+
+#ifndef TCP_FASTOPEN_CACHE
+#define TCP_FASTOPEN_CACHE 4
+#endif
+
+#ifndef MAX_SOCKETS
+#define MAX_SOCKETS 16
+#endif
+
+// Half-open connections wait in a SYN queue instead of holding a socket. Each
+// listener may queue TCP_SYN_BACKLOG handshakes out of TCP_SYNQ_SIZE shared
+// entries; one older than TCP_SYNQ_TIMEOUT ms may be evicted for a new SYN.
+#ifndef TCP_SYN_BACKLOG
+#define TCP_SYN_BACKLOG 8
+#endif
+
+#ifndef TCP_SYNQ_SIZE
+#define TCP_SYNQ_SIZE 16
+#endif
+
+#ifndef TCP_SYNQ_TIMEOUT
+#define TCP_SYNQ_TIMEOUT (4 * TCP_TIMEOUT)
+#endif
+
+#define NULL_SYN 0xFF
 
 // Retransmission tracking
 typedef struct {
@@ -66,12 +132,22 @@ typedef struct {
 
    bool isServer;           // TRUE if this is the server side of a connection
    bool pendingAccept;      // TRUE until this connection is returned by accept()
+   bool writeBlocked;       // TRUE after write() ran out of buffer space; cleared by writable()
+
+   // Segment format negotiated in the handshake
+   bool     compact;        // TRUE once both sides agreed on the compact header
+   uint16_t mss;            // TCP_MSS, or TCP_COMPACT_MSS for compact connections
+
+   // Fast open (client side)
+   bool     fastOpen;       // setFastOpen() was called; connect() defers the SYN to synTask
+   bool     synDeferred;    // connect() ran, SYN not sent yet
 
    // Handshake sequence numbers
    uint32_t iss;            // Initial send sequence number
    uint32_t irs;            // Initial receive sequence number from peer
    uint32_t sndNext;        // Next send sequence number
    uint32_t rcvNext;        // Next expected receive sequence number (legacy, prefer nextByteExpected)
+   bool     peerUnconfirmed; // client: ESTABLISHED but nothing heard since the SYN+ACK, so a reset may still come
 
    // FIN / teardown tracking
    bool     finInFlight;    // TRUE if we have sent a FIN not yet ACKed
@@ -80,8 +156,8 @@ typedef struct {
    uint32_t timeWaitStart;  // Timestamp when we entered TIME_WAIT (ms)
    
    // Send-side state (for reliability / sliding window)
-   uint8_t  sendBuf[SEND_BUF_SIZE];   // app data waiting to be (or already) sent
-   uint32_t lastByteWritten;          // highest byte index written by app into sendBuf
+   uint8_t  sendChunk[SEND_BUF_SLOTS]; // pool chunk backing each slot of the send ring
+   uint32_t lastByteWritten;          // highest byte index written by app into the send ring
    uint32_t lastByteSent;             // highest byte index actually sent in segments
    uint32_t lastByteAcked;            // highest byte index cumulatively acknowledged by peer
    uint16_t remoteAdvWindow;          // last advertised window from peer
@@ -89,12 +165,52 @@ typedef struct {
    uint16_t ssthresh;                 // slow start threshold (bytes)
    
    // Receive-side state (for Go-Back-N + flow control)
-   uint8_t  recvBuf[RECV_BUF_SIZE];   // buffer for in-order received data
+   uint8_t  recvChunk[RECV_BUF_SLOTS]; // pool chunk backing each slot of the receive ring
    uint32_t nextByteExpected;         // seq number of next byte we expect from peer
    uint32_t lastByteRead;             // last byte index returned to the app (for later read())
-   uint16_t advWindow;                // this connection's advertised window (free space in recvBuf)
+   uint16_t advWindow;                // this connection's advertised window (free space in the receive ring)
+
+   // Delayed ACK / piggybacking state
+   uint8_t  ackPendingSegs;           // in-order data segments received but not yet ACKed
+   uint32_t ackDeadline;              // time by which a delayed ACK must be sent
+   uint16_t pureAcksSent;             // ACK-only segments sent on this connection
+   uint16_t acksSuppressed;           // data segments whose ACK was coalesced or piggybacked
+
+   // RTT estimation (one timed segment at a time, never a retransmission)
+   uint16_t srtt;                     // smoothed RTT in ms (0 until the first sample)
+   uint32_t rttSeq;                   // last byte of the segment being timed (0 = none)
+   uint32_t rttStart;                 // time that segment was sent
+   uint32_t sndMax;                   // highest byte ever sent, to tell new data from resends
+
+   // Pacing state
+   uint8_t  paceGain;                 // pacing gain in percent of cwnd/SRTT (0 = off)
+   bool     paceWaiting;              // a segment is being held back for the pacing timer
+   uint32_t paceNext;                 // earliest time the next segment may leave
+   uint32_t paceWaitStart;            // when the held-back segment first became ready
+   uint16_t pacedSegs;                // segments that had to wait for their pacing slot
+   uint32_t paceDelayTotal;           // total ms segments spent waiting for pacing
+
+   // Counters for stats dumps
+   uint16_t segsSent;                 // data segments sent, resends included
+   uint16_t retransSegs;              // data segments that resent already-sent bytes
+   uint16_t timeouts;                 // retransmission timeouts
+   uint16_t windowStalls;             // sends that stopped with data queued but the window full
 } socket_cb_t;
 
+// A handshake waiting for the client's final ACK: just enough to check that ACK
+// and build the socket. Our ISS is always 0, so the SYN+ACK can be rebuilt from it.
+typedef struct {
+   bool     inUse;
+   socket_t listenFd;
+   uint16_t localAddr;
+   uint16_t localPort;
+   uint16_t remoteAddr;
+   uint16_t remotePort;
+   uint32_t irs;            // client's initial sequence number
+   bool     compact;        // compact header agreed in our SYN+ACK
+   uint32_t createdAt;      // when the SYN arrived (ms)
+} syn_entry_t;
+
 module TransportP {
    provides interface Transport;
    uses interface LinkState;
@@ -102,7 +218,10 @@ module TransportP {
    uses interface Packet;
    uses interface Timer<TMilli> as TestTimer;
    uses interface Timer<TMilli> as RetransTimer;
+   uses interface Timer<TMilli> as AckTimer;
+   uses interface Timer<TMilli> as PaceTimer;
    uses interface Boot;
+   uses interface Random;
 }
 
 implementation {
@@ -117,10 +236,206 @@ implementation {
 
    // Internal socket control block array
    static socket_cb_t sockets[MAX_SOCKETS];
-   
-   // Legacy socket_store_t array
-   socket_store_t socketStores[MAX_NUM_OF_SOCKETS];
-   uint8_t socketCount = 0;
+
+   // Readiness events waiting to be signalled to the application, per socket
+   enum {
+      SOCK_EVT_READABLE   = 0x01,
+      SOCK_EVT_ACCEPTABLE = 0x02,
+      SOCK_EVT_WRITABLE   = 0x04,
+      SOCK_EVT_CLOSED     = 0x08
+   };
+   static uint8_t pendingEvents[MAX_SOCKETS];
+   static bool notifyPosted = FALSE;
+
+   // Handshakes in progress on listening sockets
+   static syn_entry_t synq[TCP_SYNQ_SIZE];
+
+   // Stack-wide counters for stats dumps (per-socket ones live in socket_cb_t)
+   static uint16_t statSegsOut = 0;       // segments handed to SimpleSend
+   static uint16_t statSegsIn = 0;        // segments delivered to Transport.receive
+   static uint16_t statNoRoute = 0;       // segments dropped for lack of a route
+   static uint16_t statRetransTotal = 0;  // resent data segments, all sockets ever
+   static uint16_t statTimeoutsTotal = 0; // retransmission timeouts, all sockets ever
+   static uint16_t statStallsTotal = 0;   // window stalls, all sockets ever
+   static uint16_t statTfoSent = 0;       // SYNs sent carrying data
+   static uint16_t statTfoAccepted = 0;   // data-carrying SYNs accepted with a valid cookie
+   static uint16_t statTfoCookies = 0;    // cookies handed out in SYN+ACKs
+   static uint16_t statSynDrops = 0;      // SYNs refused because the listener's backlog was full
+   static uint16_t statSynNoSocket = 0;   // final ACKs that found no free socket (answered with a reset)
+   static uint16_t statResets = 0;        // resets sent for dropped handshakes
+
+   // Fast-open cookies learned from servers, replaced round robin
+   static uint16_t tfoCacheAddr[TCP_FASTOPEN_CACHE];
+   static uint16_t tfoCacheCookie[TCP_FASTOPEN_CACHE];
+   static uint8_t tfoCacheNext = 0;
+
+   // Key for the cookies this server hands out, drawn at boot so they cannot be
+   // computed from the source
+   static uint16_t tfoSecret = 0;
+
+   // Shared chunk pool; free chunk indices are kept on a stack
+   static uint8_t chunkPool[TCP_POOL_CHUNKS][TCP_CHUNK_SIZE];
+   static uint8_t freeChunks[TCP_POOL_CHUNKS];
+   static uint8_t freeChunkCount = 0;
+   static uint8_t minFreeChunks = TCP_POOL_CHUNKS;   // low-water mark, for tuning the pool size
+
+   static void initChunkPool() {
+      uint8_t i;
+      for (i = 0; i < TCP_POOL_CHUNKS; i++) {
+         freeChunks[i] = i;
+      }
+      freeChunkCount = TCP_POOL_CHUNKS;
+      minFreeChunks = TCP_POOL_CHUNKS;
+   }
+
+   // Each socket buffer is a ring of cap bytes split into cap / TCP_CHUNK_SIZE
+   // slots. Sequence number N lives at ring offset (N - 1) % cap, and a slot
+   // is backed by a pool chunk only while it holds live bytes.
+
+   // Back every slot touched by [seq, seq + len) with a chunk. Callers check
+   // ringRoom() first, so the pool cannot run dry part way through.
+   static void ringReserve(uint8_t *map, uint16_t cap, uint32_t seq, uint16_t len) {
+      uint16_t off = (uint16_t)((seq - 1) % cap);
+      uint16_t n;
+      uint8_t slot;
+
+      while (len > 0) {
+         slot = off / TCP_CHUNK_SIZE;
+         n = TCP_CHUNK_SIZE - (off % TCP_CHUNK_SIZE);
+         if (n > len) {
+            n = len;
+         }
+         if (map[slot] == TCP_NO_CHUNK && freeChunkCount > 0) {
+            map[slot] = freeChunks[--freeChunkCount];
+            if (freeChunkCount < minFreeChunks) {
+               minFreeChunks = freeChunkCount;
+            }
+         }
+         len -= n;
+         off = (off + n) % cap;
+      }
+   }
+
+   // Copy len bytes from src into the ring starting at seq
+   static void ringCopyIn(uint8_t *map, uint16_t cap, uint32_t seq, uint8_t *src, uint16_t len) {
+      uint16_t off = (uint16_t)((seq - 1) % cap);
+      uint16_t n;
+      uint8_t slot;
+
+      while (len > 0) {
+         slot = off / TCP_CHUNK_SIZE;
+         n = TCP_CHUNK_SIZE - (off % TCP_CHUNK_SIZE);
+         if (n > len) {
+            n = len;
+         }
+         if (map[slot] != TCP_NO_CHUNK) {
+            memcpy(&chunkPool[map[slot]][off % TCP_CHUNK_SIZE], src, n);
+         }
+         src += n;
+         len -= n;
+         off = (off + n) % cap;
+      }
+   }
+
+   // Copy len bytes out of the ring starting at seq into dst
+   static void ringCopyOut(uint8_t *map, uint16_t cap, uint32_t seq, uint8_t *dst, uint16_t len) {
+      uint16_t off = (uint16_t)((seq - 1) % cap);
+      uint16_t n;
+      uint8_t slot;
+
+      while (len > 0) {
+         slot = off / TCP_CHUNK_SIZE;
+         n = TCP_CHUNK_SIZE - (off % TCP_CHUNK_SIZE);
+         if (n > len) {
+            n = len;
+         }
+         if (map[slot] != TCP_NO_CHUNK) {
+            memcpy(dst, &chunkPool[map[slot]][off % TCP_CHUNK_SIZE], n);
+         }
+         dst += n;
+         len -= n;
+         off = (off + n) % cap;
+      }
+   }
+
+   // Bytes that can be appended at endSeq, bounded by both the ring cap and
+   // the chunks this ring already holds plus what the pool can still lend
+   static uint16_t ringRoom(uint8_t *map, uint16_t cap, uint32_t endSeq, uint16_t used) {
+      uint16_t limit;
+      uint16_t room = 0;
+      uint16_t off;
+      uint8_t budget = freeChunkCount;
+      uint8_t slot;
+
+      if (used >= cap) {
+         return 0;
+      }
+      limit = cap - used;
+      off = (uint16_t)((endSeq - 1) % cap);
+
+      while (room < limit) {
+         slot = off / TCP_CHUNK_SIZE;
+         if (map[slot] == TCP_NO_CHUNK) {
+            if (budget == 0) {
+               break;
+            }
+            budget--;
+         }
+         room += TCP_CHUNK_SIZE - (off % TCP_CHUNK_SIZE);
+         off = (uint16_t)((off + TCP_CHUNK_SIZE - (off % TCP_CHUNK_SIZE)) % cap);
+      }
+
+      if (room > limit) {
+         room = limit;
+      }
+      return room;
+   }
+
+   // Return chunks whose slot no longer overlaps the live bytes [startSeq, startSeq + used).
+   // The slot at the append position is kept so an active flow always has room to progress.
+   static void ringTrim(uint8_t *map, uint16_t cap, uint32_t startSeq, uint16_t used) {
+      uint16_t startOff = (uint16_t)((startSeq - 1) % cap);
+      uint8_t endSlot = (uint8_t)(((startOff + used) % cap) / TCP_CHUNK_SIZE);
+      uint16_t slotOff;
+      uint8_t slot;
+
+      for (slot = 0; slot < cap / TCP_CHUNK_SIZE; slot++) {
+         if (map[slot] == TCP_NO_CHUNK || slot == endSlot) {
+            continue;
+         }
+         slotOff = (uint16_t)slot * TCP_CHUNK_SIZE;
+         // Live if the slot starts inside the live range, or the live range starts inside the slot
+         if ((uint16_t)((slotOff + cap - startOff) % cap) < used ||
+             (uint16_t)((startOff + cap - slotOff) % cap) < TCP_CHUNK_SIZE) {
+            continue;
+         }
+         freeChunks[freeChunkCount++] = map[slot];
+         map[slot] = TCP_NO_CHUNK;
+      }
+   }
+
+   // Hand every chunk of a ring back to the pool
+   static void ringRelease(uint8_t *map, uint16_t slots) {
+      uint8_t slot;
+      for (slot = 0; slot < slots; slot++) {
+         if (map[slot] != TCP_NO_CHUNK) {
+            freeChunks[freeChunkCount++] = map[slot];
+            map[slot] = TCP_NO_CHUNK;
+         }
+      }
+   }
+
+   // ACKed bytes no longer need their send chunks
+   static void trimSendRing(socket_cb_t *s) {
+      ringTrim(s->sendChunk, SEND_BUF_SIZE, s->lastByteAcked + 1,
+               (uint16_t)(s->lastByteWritten - s->lastByteAcked));
+   }
+
+   // Bytes handed to the application no longer need their receive chunks
+   static void trimRecvRing(socket_cb_t *s) {
+      ringTrim(s->recvChunk, RECV_BUF_SIZE, s->lastByteRead + 1,
+               (uint16_t)(s->nextByteExpected - 1 - s->lastByteRead));
+   }
    
    // Forward declarations
    static error_t sendSegment(uint16_t dstAddr, uint16_t srcPort, uint16_t dstPort, 
@@ -132,12 +447,19 @@ implementation {
    static void cleanupAckedRetrans(socket_t fd, uint32_t lastByteAcked);
    static void clearRetransEntriesForSocket(socket_t fd);
    static error_t sendFin(socket_t fd);
+   static uint16_t computeRecvFreeSpace(socket_t fd);
+
+   // Tell a client whose SYN we answered that its handshake is gone. Our ISS is 0,
+   // so seq 1 is exactly what the client expects next and the reset is believed.
+   static void sendReset(uint16_t dstAddr, uint16_t srcPort, uint16_t dstPort, uint32_t ack) {
+      sendSegment(dstAddr, srcPort, dstPort, 1, ack, TCP_FLAG_RST, 0, NULL, 0);
+      statResets++;
+   }
    
    
    // Allocate a new socket from the socket table
    static socket_t allocSocket() {
       uint8_t i;
-      uint16_t j;
       for (i = 0; i < MAX_SOCKETS; i++) {
          if (!sockets[i].inUse) {
             sockets[i].inUse = TRUE;
@@ -148,6 +470,12 @@ implementation {
             sockets[i].remotePort = 0;
             sockets[i].isServer = FALSE;
             sockets[i].pendingAccept = FALSE;
+            sockets[i].writeBlocked = FALSE;
+            sockets[i].compact = FALSE;
+            sockets[i].mss = TCP_MSS;
+            sockets[i].fastOpen = FALSE;
+            sockets[i].synDeferred = FALSE;
+            sockets[i].peerUnconfirmed = FALSE;
             sockets[i].iss = 0;
             sockets[i].irs = 0;
             sockets[i].sndNext = 0;
@@ -164,17 +492,36 @@ implementation {
             sockets[i].remoteAdvWindow = SEND_BUF_SIZE;
             sockets[i].cwnd = TCP_MSS;           // start congestion window at 1 MSS
             sockets[i].ssthresh = 4 * TCP_MSS;   // simple initial slow-start threshold
-            for (j = 0; j < SEND_BUF_SIZE; j++) {
-               sockets[i].sendBuf[j] = 0;
-            }
+            memset(sockets[i].sendChunk, TCP_NO_CHUNK, SEND_BUF_SLOTS);
             
             // Initialize receive-side state
             sockets[i].nextByteExpected = 1;
             sockets[i].lastByteRead = 0;
-            sockets[i].advWindow = RECV_BUF_SIZE;
-            for (j = 0; j < RECV_BUF_SIZE; j++) {
-               sockets[i].recvBuf[j] = 0;
-            }
+            memset(sockets[i].recvChunk, TCP_NO_CHUNK, RECV_BUF_SLOTS);
+            sockets[i].advWindow = computeRecvFreeSpace(i);
+
+            // Initialize delayed ACK state
+            sockets[i].ackPendingSegs = 0;
+            sockets[i].ackDeadline = 0;
+            sockets[i].pureAcksSent = 0;
+            sockets[i].acksSuppressed = 0;
+
+            // Initialize RTT estimation and pacing state
+            sockets[i].srtt = 0;
+            sockets[i].rttSeq = 0;
+            sockets[i].rttStart = 0;
+            sockets[i].sndMax = 0;
+            sockets[i].paceGain = TCP_PACING_GAIN;
+            sockets[i].paceWaiting = FALSE;
+            sockets[i].paceNext = 0;
+            sockets[i].paceWaitStart = 0;
+            sockets[i].pacedSegs = 0;
+            sockets[i].paceDelayTotal = 0;
+
+            sockets[i].segsSent = 0;
+            sockets[i].retransSegs = 0;
+            sockets[i].timeouts = 0;
+            sockets[i].windowStalls = 0;
             
             return i;
          }
@@ -185,8 +532,29 @@ implementation {
    // Free a socket, clearing its state
    static void freeSocket(socket_t fd) {
       if (fd < MAX_SOCKETS) {
+         if (sockets[fd].inUse) {
+            dbg(TRANSPORT_CHANNEL, "freeSocket(): fd=%hhu pureAcksSent=%hu acksSuppressed=%hu\n",
+                fd, sockets[fd].pureAcksSent, sockets[fd].acksSuppressed);
+            ringRelease(sockets[fd].sendChunk, SEND_BUF_SLOTS);
+            ringRelease(sockets[fd].recvChunk, RECV_BUF_SLOTS);
+            dbg(TRANSPORT_CHANNEL, "freeSocket(): poolFree=%hhu/%hhu minFree=%hhu\n",
+                freeChunkCount, (uint8_t)TCP_POOL_CHUNKS, minFreeChunks);
+            dbg(TRANSPORT_CHANNEL, "freeSocket(): fd=%hhu srtt=%hu pacedSegs=%hu paceDelay=%lu\n",
+                fd, sockets[fd].srtt, sockets[fd].pacedSegs, (unsigned long)sockets[fd].paceDelayTotal);
+            // Handshakes queued on a listener die with it
+            if (sockets[fd].state == TCP_STATE_LISTEN) {
+               uint8_t i;
+               for (i = 0; i < TCP_SYNQ_SIZE; i++) {
+                  if (synq[i].inUse && synq[i].listenFd == fd) {
+                     synq[i].inUse = FALSE;
+                     sendReset(synq[i].remoteAddr, synq[i].localPort, synq[i].remotePort, synq[i].irs + 1);
+                  }
+               }
+            }
+         }
          sockets[fd].inUse = FALSE;
          sockets[fd].state = TCP_STATE_CLOSED;
+         pendingEvents[fd] = 0;
       }
    }
    
@@ -218,11 +586,135 @@ implementation {
       }
       return NULL_SOCKET;
    }
+
+   // Find a queued handshake by 4-tuple
+   static uint8_t findSynEntry(uint16_t localAddr, uint16_t localPort,
+                               uint16_t remoteAddr, uint16_t remotePort) {
+      uint8_t i;
+      for (i = 0; i < TCP_SYNQ_SIZE; i++) {
+         if (synq[i].inUse &&
+             synq[i].localAddr == localAddr &&
+             synq[i].localPort == localPort &&
+             synq[i].remoteAddr == remoteAddr &&
+             synq[i].remotePort == remotePort) {
+            return i;
+         }
+      }
+      return NULL_SYN;
+   }
+
+   // Pick a SYN queue entry for a new handshake on listenFd. Below its backlog the
+   // listener gets a free entry, or else the oldest stale one; at its backlog it can
+   // only recycle one of its own stale entries.
+   static uint8_t allocSynEntry(socket_t listenFd, uint32_t now) {
+      uint8_t i;
+      uint8_t queued = 0;
+      uint8_t freeIdx = NULL_SYN;
+      uint8_t staleAny = NULL_SYN;
+      uint8_t staleOwn = NULL_SYN;
+
+      for (i = 0; i < TCP_SYNQ_SIZE; i++) {
+         if (!synq[i].inUse) {
+            if (freeIdx == NULL_SYN) {
+               freeIdx = i;
+            }
+            continue;
+         }
+         if (synq[i].listenFd == listenFd) {
+            queued++;
+         }
+         if ((now - synq[i].createdAt) < TCP_SYNQ_TIMEOUT) {
+            continue;
+         }
+         if (staleAny == NULL_SYN || synq[i].createdAt < synq[staleAny].createdAt) {
+            staleAny = i;
+         }
+         if (synq[i].listenFd == listenFd &&
+             (staleOwn == NULL_SYN || synq[i].createdAt < synq[staleOwn].createdAt)) {
+            staleOwn = i;
+         }
+      }
+
+      if (queued >= TCP_SYN_BACKLOG) {
+         return staleOwn;
+      }
+      return (freeIdx != NULL_SYN) ? freeIdx : staleAny;
+   }
+
+   // Window a socket with an empty receive ring would advertise right now
+   static uint16_t freshRecvWindow() {
+      uint32_t room = (uint32_t)freeChunkCount * TCP_CHUNK_SIZE;
+      return (room < RECV_BUF_SIZE) ? (uint16_t)room : RECV_BUF_SIZE;
+   }
+
+   // The compact header carries 8-bit ports, so only offer it when both ends fit
+   static bool compactPortsFit(uint16_t localPort, uint16_t remotePort) {
+      return TCP_COMPACT_ENABLE &&
+             localPort <= TCP_COMPACT_MAX_PORT &&
+             remotePort <= TCP_COMPACT_MAX_PORT;
+   }
+
+   // Switch a connection to the compact header after the handshake agreed on it
+   static void enableCompact(socket_cb_t *s) {
+      s->compact = TRUE;
+      s->mss = TCP_COMPACT_MSS;
+   }
+
+   // Rebuild a 32-bit sequence number from its low 16 bits, picking the value closest to ref
+   static uint32_t unwrapSeq16(uint16_t wire, uint32_t ref) {
+      int16_t delta = (int16_t)(wire - (uint16_t)ref);
+      return ref + (int32_t)delta;
+   }
+
+   // Cookie this server hands to a client; never 0, which means "send me one"
+   static uint16_t tfoCookieFor(uint16_t clientAddr) {
+      uint16_t cookie = tcpFlowHash(clientAddr, TOS_NODE_ID, tfoSecret, 0);
+      return cookie != 0 ? cookie : 1;
+   }
+
+   static uint16_t tfoCachedCookie(uint16_t serverAddr) {
+      uint8_t i;
+      for (i = 0; i < TCP_FASTOPEN_CACHE; i++) {
+         if (tfoCacheCookie[i] != 0 && tfoCacheAddr[i] == serverAddr) {
+            return tfoCacheCookie[i];
+         }
+      }
+      return 0;
+   }
+
+   static void tfoStoreCookie(uint16_t serverAddr, uint16_t cookie) {
+      uint8_t i;
+      for (i = 0; i < TCP_FASTOPEN_CACHE; i++) {
+         if (tfoCacheCookie[i] != 0 && tfoCacheAddr[i] == serverAddr) {
+            tfoCacheCookie[i] = cookie;
+            return;
+         }
+      }
+      tfoCacheAddr[tfoCacheNext] = serverAddr;
+      tfoCacheCookie[tfoCacheNext] = cookie;
+      tfoCacheNext = (tfoCacheNext + 1) % TCP_FASTOPEN_CACHE;
+   }
+
+   // Compact headers have a 4-bit flag field; a compact segment never carries the
+   // COMPACT option itself, so its bit stands for FASTOPEN on the wire
+   static uint8_t compactFlagsOut(uint8_t flags) {
+      return (flags & (TCP_FLAG_SYN | TCP_FLAG_ACK | TCP_FLAG_FIN)) |
+             ((flags & TCP_FLAG_FASTOPEN) ? TCP_FLAG_COMPACT : 0);
+   }
+
+   static uint8_t compactFlagsIn(uint8_t wire) {
+      return (wire & (TCP_FLAG_SYN | TCP_FLAG_ACK | TCP_FLAG_FIN)) |
+             ((wire & TCP_FLAG_COMPACT) ? TCP_FLAG_FASTOPEN : 0);
+   }
    
 
    // Start client-side handshake (send SYN)
    static error_t startClientHandshake(socket_t fd, uint16_t remoteAddr, uint16_t remotePort, uint16_t localPort) {
       socket_cb_t *s;
+      uint8_t synFlags;
+      uint16_t cookie = 0;
+      uint8_t synData[TCP_MAX_DATA];
+      uint8_t synLen = 0;
       
       if (fd >= MAX_SOCKETS || !sockets[fd].inUse) {
          return FAIL;
@@ -246,18 +738,106 @@ implementation {
       // Initialize receive sequence numbers and advertised window
       s->irs = 0;
       s->rcvNext = 0;
-      s->advWindow = RECV_BUF_SIZE;
+      s->advWindow = computeRecvFreeSpace(fd);
+
+      // Offer the compact header; the server echoes TCP_FLAG_COMPACT if it agrees
+      synFlags = TCP_FLAG_SYN;
+      if (compactPortsFit(localPort, remotePort)) {
+         synFlags |= TCP_FLAG_COMPACT;
+      }
+
+      // Fast open: with a cookie, the first bytes already written ride on the SYN
+      // (in a compact SYN when the ports fit); without one, ask the server for a cookie
+      if (s->fastOpen) {
+         synFlags |= TCP_FLAG_FASTOPEN;
+         cookie = tfoCachedCookie(remoteAddr);
+         if (cookie != 0 && s->lastByteWritten > 0) {
+            synLen = compactPortsFit(localPort, remotePort) ? TCP_COMPACT_MSS : TCP_MSS;
+            if (synLen > s->lastByteWritten) {
+               synLen = (uint8_t)s->lastByteWritten;
+            }
+            ringCopyOut(s->sendChunk, SEND_BUF_SIZE, 1, synData, synLen);
+         }
+      }
       
-      // Send SYN segment
+      // Send SYN segment; the ack field of a SYN carries the fast-open cookie
       if (sendSegment(remoteAddr, localPort, remotePort, 
-                      s->iss, 0, TCP_FLAG_SYN, s->advWindow, NULL, 0) == SUCCESS) {
+                      s->iss, cookie, synFlags, s->advWindow, synData, synLen) == SUCCESS) {
          // dbg(TRANSPORT_CHANNEL, "Client: SYN sent (fd=%hhu, iss=%lu)\n", fd, s->iss);
+         if (synLen > 0) {
+            // Data bytes 1..synLen are in flight; the SYN+ACK says how many the server took
+            s->lastByteSent = synLen;
+            s->sndNext = synLen + 1;
+            s->sndMax = synLen;
+            s->segsSent++;
+            statTfoSent++;
+            // If the SYN or its SYN+ACK is lost, RetransTimer sends the SYN again
+            enqueueRetrans(fd, 1, synLen, call RetransTimer.getNow());
+            dbg(TRANSPORT_CHANNEL, "Client: fast-open SYN with %hhu bytes (fd=%hhu)\n", synLen, fd);
+         }
          return SUCCESS;
       }
       
       return FAIL;
    }
+
+   // Send the SYNs that connect() deferred for fast-open sockets
+   task void synTask() {
+      uint8_t i;
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         socket_cb_t *s = &sockets[i];
+         if (!s->inUse || !s->synDeferred || s->state != TCP_STATE_SYN_SENT) {
+            continue;
+         }
+         s->synDeferred = FALSE;
+         if (startClientHandshake(i, s->remoteAddr, s->remotePort, s->localPort) != SUCCESS) {
+            dbg(TRANSPORT_CHANNEL, "Client: deferred SYN failed (fd=%hhu)\n", i);
+         }
+      }
+   }
    
+   // Signal queued readiness events from task context, so applications may
+   // call back into Transport (read/write/accept/close) from their handlers
+   task void notifyTask() {
+      uint8_t i;
+      uint8_t evts;
+
+      notifyPosted = FALSE;
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         evts = pendingEvents[i];
+         if (evts == 0) {
+            continue;
+         }
+         pendingEvents[i] = 0;
+         if (!sockets[i].inUse) {
+            continue;
+         }
+         if (evts & SOCK_EVT_ACCEPTABLE) {
+            signal Transport.acceptable(i);
+         }
+         if (evts & SOCK_EVT_READABLE) {
+            signal Transport.readable(i);
+         }
+         if (evts & SOCK_EVT_WRITABLE) {
+            signal Transport.writable(i);
+         }
+         if (evts & SOCK_EVT_CLOSED) {
+            signal Transport.closed(i);
+         }
+      }
+   }
+
+   // Queue a readiness event for fd; repeated edges before the task runs coalesce
+   static void raiseEvent(socket_t fd, uint8_t evt) {
+      if (fd >= MAX_SOCKETS || !sockets[fd].inUse) {
+         return;
+      }
+      pendingEvents[fd] |= evt;
+      if (!notifyPosted && post notifyTask() == SUCCESS) {
+         notifyPosted = TRUE;
+      }
+   }
+
    // Compute receive buffer free space for flow control
    static uint16_t computeRecvFreeSpace(socket_t fd) {
       socket_cb_t *s = &sockets[fd];
@@ -274,7 +854,7 @@ implementation {
       if (used >= RECV_BUF_SIZE) {
          return 0;
       }
-      return (uint16_t)(RECV_BUF_SIZE - used);
+      return ringRoom(s->recvChunk, RECV_BUF_SIZE, s->nextByteExpected, (uint16_t)used);
    }
 
    // Initialize retransmission queue
@@ -404,6 +984,127 @@ implementation {
       }
    }
    
+   // Account for an ACK leaving on this connection. A pure ACK answers one pending
+   // segment itself; any ACK riding on data or a FIN answers all of them for free.
+   static void noteAckSent(socket_cb_t *s, bool pure) {
+      if (pure) {
+         s->pureAcksSent++;
+         if (s->ackPendingSegs > 1) {
+            s->acksSuppressed += s->ackPendingSegs - 1;
+         }
+      } else {
+         s->acksSuppressed += s->ackPendingSegs;
+      }
+      s->ackPendingSegs = 0;
+   }
+
+   // Arm the shared AckTimer for the earliest pending delayed ACK
+   static void scheduleAckTimer() {
+      uint8_t i;
+      bool found = FALSE;
+      uint32_t minDeadline = 0;
+      uint32_t now;
+
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         if (sockets[i].inUse && sockets[i].ackPendingSegs > 0) {
+            if (!found || sockets[i].ackDeadline < minDeadline) {
+               minDeadline = sockets[i].ackDeadline;
+               found = TRUE;
+            }
+         }
+      }
+
+      if (!found) {
+         call AckTimer.stop();
+         return;
+      }
+
+      now = call AckTimer.getNow();
+      if (minDeadline <= now) {
+         call AckTimer.startOneShot(1);
+      } else {
+         call AckTimer.startOneShot(minDeadline - now);
+      }
+   }
+
+   // Send a pure cumulative ACK with our current receive window
+   static void sendPureAck(socket_t fd) {
+      socket_cb_t *s = &sockets[fd];
+
+      s->advWindow = computeRecvFreeSpace(fd);
+      dbg(TRANSPORT_CHANNEL,
+          "EST: sending ACK ack=%lu advWindow=%u (fd=%hhu)\n",
+          (unsigned long)s->nextByteExpected, s->advWindow, fd);
+      sendSegment(
+         s->remoteAddr,
+         s->localPort,
+         s->remotePort,
+         s->sndNext,
+         s->nextByteExpected,
+         TCP_FLAG_ACK,
+         s->advWindow,
+         NULL,
+         0
+      );
+   }
+
+   // Fold an RTT sample into srtt once the timed segment is cumulatively ACKed
+   static void updateRtt(socket_cb_t *s, uint32_t now) {
+      uint32_t sample;
+
+      if (s->rttSeq == 0 || s->lastByteAcked < s->rttSeq) {
+         return;
+      }
+      sample = now - s->rttStart;
+      if (sample > 65535U) {
+         sample = 65535U;
+      }
+      if (s->srtt == 0) {
+         s->srtt = (uint16_t)sample;
+      } else {
+         // srtt = 7/8 srtt + 1/8 sample
+         s->srtt = (uint16_t)(((uint32_t)s->srtt * 7 + sample) / 8);
+      }
+      s->rttSeq = 0;
+   }
+
+   // Gap to leave after a segment of len bytes so cwnd drains over srtt * 100 / gain
+   static uint32_t paceInterval(socket_cb_t *s, uint16_t len) {
+      if (s->paceGain == 0 || s->srtt == 0 || s->cwnd == 0) {
+         return 0;
+      }
+      return ((uint32_t)s->srtt * len * 100) / ((uint32_t)s->cwnd * s->paceGain);
+   }
+
+   // Arm the shared PaceTimer for the earliest socket waiting on its pacing slot
+   static void schedulePaceTimer() {
+      uint8_t i;
+      bool found = FALSE;
+      uint32_t minNext = 0;
+      uint32_t now;
+
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         if (sockets[i].inUse && sockets[i].paceWaiting) {
+            if (!found || sockets[i].paceNext < minNext) {
+               minNext = sockets[i].paceNext;
+               found = TRUE;
+            }
+         }
+      }
+
+      if (!found) {
+         call PaceTimer.stop();
+         return;
+      }
+
+      now = call PaceTimer.getNow();
+      if (minNext <= now) {
+         call PaceTimer.startOneShot(1);
+      } else {
+         call PaceTimer.startOneShot(minNext - now);
+      }
+   }
+
    // Try to send data from send buffer using Go-Back-N sliding window
    static void trySendData(socket_t fd) {
       socket_cb_t *s;
@@ -413,9 +1114,9 @@ implementation {
       uint32_t windowSpace;
       uint16_t dataLen;
       uint32_t seqNum;
-      uint16_t bufIndex;
-      uint16_t spaceToEnd;
       uint32_t ackToSend;
+      uint8_t segBuf[TCP_MAX_DATA];
+      uint32_t now;
       
       if (fd >= MAX_SOCKETS || !sockets[fd].inUse) {
          return;
@@ -456,8 +1157,8 @@ implementation {
          windowSpace = effectiveWindow - inFlight;
          dataLen = (uint16_t)bytesAvailable;
          
-         if (dataLen > TCP_MSS) {
-            dataLen = TCP_MSS;
+         if (dataLen > s->mss) {
+            dataLen = s->mss;
          }
          if (dataLen > windowSpace) {
             dataLen = (uint16_t)windowSpace;
@@ -466,18 +1167,23 @@ implementation {
          if (dataLen == 0) {
             break;
          }
+
+         // Hold the segment back until its pacing slot comes up
+         now = call PaceTimer.getNow();
+         if (s->paceGain > 0 && s->srtt > 0 && (int32_t)(s->paceNext - now) > 0) {
+            if (!s->paceWaiting) {
+               s->paceWaiting = TRUE;
+               s->paceWaitStart = now;
+            }
+            schedulePaceTimer();
+            break;
+         }
          
          // Compute sequence number of first byte in this segment
          seqNum = s->lastByteSent + 1;
-         
-         // Map seqNum (1-based) to buffer index (0-based, circular)
-         bufIndex = (uint16_t)((seqNum - 1) % SEND_BUF_SIZE);
 
-         // Ensure we never run past the end of the circular buffer in this segment
-         spaceToEnd = (uint16_t)(SEND_BUF_SIZE - bufIndex);
-         if (dataLen > spaceToEnd) {
-            dataLen = spaceToEnd;
-         }
+         // The segment may span chunks; gather it into one contiguous buffer
+         ringCopyOut(s->sendChunk, SEND_BUF_SIZE, seqNum, segBuf, dataLen);
          
          // Build and send segment
          if (sendSegment(
@@ -488,26 +1194,52 @@ implementation {
                ackToSend,
                TCP_FLAG_ACK,
                s->advWindow,
-               &s->sendBuf[bufIndex],
+               segBuf,
                dataLen
             ) == SUCCESS) {
             
+            s->segsSent++;
+            if (seqNum <= s->sndMax) {
+               s->retransSegs++;
+               statRetransTotal++;
+            }
+
+            // Time one new segment at a time; resends give ambiguous samples (Karn)
+            if (s->rttSeq == 0 && seqNum > s->sndMax) {
+               s->rttSeq = seqNum + dataLen - 1;
+               s->rttStart = now;
+            }
+
             // Update send state
             s->lastByteSent += dataLen;
             inFlight = bytesInFlight(s);
             s->sndNext = s->lastByteSent + 1;
+            if (s->lastByteSent > s->sndMax) {
+               s->sndMax = s->lastByteSent;
+            }
 
-            // Track segment for possible retransmission
-            {
-               uint32_t now = call RetransTimer.getNow();
-               enqueueRetrans(fd, seqNum, dataLen, now);
+            // Account for time spent waiting on the pacer, then book the next slot
+            if (s->paceWaiting) {
+               s->paceWaiting = FALSE;
+               s->pacedSegs++;
+               s->paceDelayTotal += now - s->paceWaitStart;
             }
+            s->paceNext = now + paceInterval(s, dataLen);
+
+            // Track segment for possible retransmission
+            enqueueRetrans(fd, seqNum, dataLen, now);
             
          } else {
             dbg(TRANSPORT_CHANNEL, "trySendData: sendSegment failed, breaking\n");
             break;
          }
       }
+
+      // Data is waiting but the window is closed (cwnd, peer window or buffer)
+      if (s->lastByteSent < s->lastByteWritten && inFlight >= effectiveWindow) {
+         s->windowStalls++;
+         statStallsTotal++;
+      }
    }
 
    // Send FIN segment for socket
@@ -572,6 +1304,39 @@ implementation {
       
       s = &sockets[fd];
       flags = seg->header.flags;
+
+      // The server dropped our handshake (no socket free, backlog recycled or
+      // listener closed). A reset is only believed before the server has shown it
+      // holds a socket for us, at exactly the next expected seq, and acking no more
+      // than our SYN. Once anything else arrives from the server it is ignored.
+      if (flags & TCP_FLAG_RST) {
+         if ((s->state == TCP_STATE_SYN_SENT ||
+              (s->state == TCP_STATE_ESTABLISHED && s->peerUnconfirmed)) &&
+             seg->header.seq == s->nextByteExpected && seg->header.ack == s->iss + 1) {
+            dbg(TRANSPORT_CHANNEL, "Reset from %hu:%hu in state %hhu (fd=%hhu)\n",
+                s->remoteAddr, s->remotePort, s->state, fd);
+            clearRetransEntriesForSocket(fd);
+            s->synDeferred = FALSE;
+            s->peerUnconfirmed = FALSE;
+            s->state = TCP_STATE_CLOSED;
+            raiseEvent(fd, SOCK_EVT_CLOSED);
+         }
+         return;
+      }
+
+      // A fast-open SYN sent again because our SYN+ACK was lost: the connection is
+      // already built, so repeat the SYN+ACK (acking the data we took) instead of
+      // reading the SYN as data
+      if ((flags & (TCP_FLAG_SYN | TCP_FLAG_ACK)) == TCP_FLAG_SYN) {
+         if (s->isServer && s->state == TCP_STATE_ESTABLISHED && seg->header.seq == s->irs) {
+            dbg(TRANSPORT_CHANNEL, "Server: repeated fast-open SYN from %hu:%hu, SYN+ACK resent (fd=%hhu)\n",
+                s->remoteAddr, s->remotePort, fd);
+            sendSegment(s->remoteAddr, s->localPort, s->remotePort, s->iss, s->nextByteExpected,
+                        TCP_FLAG_SYN | TCP_FLAG_ACK | (s->compact ? TCP_FLAG_COMPACT : 0),
+                        s->advWindow, NULL, 0);
+         }
+         return;
+      }
       
       // Handle handshake based on current state
       switch (s->state) {
@@ -581,30 +1346,55 @@ implementation {
                // Validate ACK acknowledges our SYN
                dbg(TRANSPORT_CHANNEL, "SYN_SENT: received SYN+ACK ack=%lu expected=%lu (fd=%hhu)\n",
                    seg->header.ack, s->sndNext, fd);
-               if (seg->header.ack == s->sndNext) {
+               // The ack covers our SYN and, after a fast-open SYN, as much of its data as the server took
+               if (seg->header.ack > s->iss && seg->header.ack <= s->sndNext) {
                   // Record peer's initial sequence number
                   s->irs = seg->header.seq;
                   s->rcvNext = seg->header.seq + 1;  // SYN consumes one sequence number
 
+                  // A cookie for the next fast open to this server
+                  if ((flags & TCP_FLAG_FASTOPEN) && dataLen >= 2) {
+                     tfoStoreCookie(s->remoteAddr, ((uint16_t)seg->data[0] << 8) | seg->data[1]);
+                  }
+
+                  // SYN data the server did not take goes out again as ordinary data
+                  clearRetransEntriesForSocket(fd);
+                  s->lastByteAcked = seg->header.ack - 1;
+                  s->lastByteSent = s->lastByteAcked;
+                  s->sndNext = s->lastByteSent + 1;
+                  if (s->lastByteAcked > 0) {
+                     trimSendRing(s);
+                     dbg(TRANSPORT_CHANNEL, "Client: fast open accepted %lu bytes (fd=%hhu)\n",
+                         (unsigned long)s->lastByteAcked, fd);
+                  }
+
                   // Initialize receive state for data from server
                   s->nextByteExpected = s->rcvNext;
                   s->lastByteRead = 0;
 
                   // Learn server's advertised window
                   s->remoteAdvWindow = seg->header.advWindow;
+
+                  // Server agreed to the compact header we offered
+                  if ((flags & TCP_FLAG_COMPACT) &&
+                      compactPortsFit(s->localPort, s->remotePort)) {
+                     enableCompact(s);
+                  }
                   
                   // Send final ACK
                   if (sendSegment(s->remoteAddr, s->localPort, s->remotePort,
                                   s->sndNext, s->rcvNext, TCP_FLAG_ACK, 0, NULL, 0) == SUCCESS) {
                      s->state = TCP_STATE_ESTABLISHED;
+                     s->peerUnconfirmed = TRUE;
                      // Initialize congestion control on successful handshake
-                     s->cwnd = TCP_MSS;
-                     if (s->ssthresh < 2 * TCP_MSS) {
-                        s->ssthresh = 4 * TCP_MSS;
+                     s->cwnd = s->mss;
+                     if (s->ssthresh < 2 * s->mss) {
+                        s->ssthresh = 4 * s->mss;
                      }
-                     dbg(TRANSPORT_CHANNEL, "Client: connection ESTABLISHED (fd=%hhu)\n", fd);
+                     dbg(TRANSPORT_CHANNEL, "Client: connection ESTABLISHED (fd=%hhu, mss=%hu)\n", fd, s->mss);
                      // If any application data was queued before connect completed, send it now
                      trySendData(fd);
+                     raiseEvent(fd, SOCK_EVT_WRITABLE);
                   }
                } else {
                   dbg(TRANSPORT_CHANNEL, "Client: invalid ACK in SYN+ACK (expected %lu, got %lu, fd=%hhu)\n", 
@@ -628,12 +1418,15 @@ implementation {
 
                   s->state = TCP_STATE_ESTABLISHED;
                   // Initialize congestion control on successful handshake
-                  s->cwnd = TCP_MSS;
-                  if (s->ssthresh < 2 * TCP_MSS) {
-                     s->ssthresh = 4 * TCP_MSS;
+                  s->cwnd = s->mss;
+                  if (s->ssthresh < 2 * s->mss) {
+                     s->ssthresh = 4 * s->mss;
                   }
                   // If any application data was queued before connect completed, send it now
                   trySendData(fd);
+
+                  // Tell the owner of the listening socket there is a connection to accept
+                  raiseEvent(findListeningSocketByPort(s->localPort), SOCK_EVT_ACCEPTABLE);
                } else {
                   break;
                }
@@ -646,18 +1439,17 @@ implementation {
             uint32_t ackNum;
             uint32_t seqNum;
             uint32_t expected;
-            uint16_t bufIndex;
-            uint32_t ackToSend;
-            uint16_t freeSpace;
-            uint16_t firstChunk;
-            uint16_t secondChunk;
-            uint16_t spaceToEnd;
             uint32_t oldLastByteAcked;
             uint32_t newLastByteAcked;
             uint32_t ackedBytes;
 
             ackNum = seg->header.ack;
             seqNum = seg->header.seq;
+
+            // Anything but a repeated SYN+ACK comes from the server's socket
+            if (!(flags & TCP_FLAG_SYN)) {
+               s->peerUnconfirmed = FALSE;
+            }
             
             // 1) Handle ACKs (even if data is also present)
             if (flags & TCP_FLAG_ACK) {
@@ -688,12 +1480,13 @@ implementation {
 
                // Tahoe-style congestion control: only adjust cwnd when we make forward progress
                if (ackedBytes > 0) {
+                  updateRtt(s, call PaceTimer.getNow());
                   if (s->cwnd < s->ssthresh) {
                      // Slow start: cwnd grows by 1 MSS per ACK
-                     if ((uint32_t)s->cwnd + TCP_MSS > 65535U) {
+                     if ((uint32_t)s->cwnd + s->mss > 65535U) {
                         s->cwnd = 65535;
                      } else {
-                        s->cwnd += TCP_MSS;
+                        s->cwnd += s->mss;
                      }
                      dbg(TRANSPORT_CHANNEL,
                          "CC: fd=%hhu slow-start ackedBytes=%u cwnd=%u ssthresh=%u\n",
@@ -714,9 +1507,16 @@ implementation {
                
                // Remove fully ACKed retransmission entries
                cleanupAckedRetrans(fd, s->lastByteAcked);
+               trimSendRing(s);
 
                // Try to send more data now that window space may have opened
                trySendData(fd);
+
+               // Send buffer space was freed for a writer that came up short
+               if (ackedBytes > 0 && s->writeBlocked) {
+                  s->writeBlocked = FALSE;
+                  raiseEvent(fd, SOCK_EVT_WRITABLE);
+               }
             }
             
             // 2) Handle data (Go-Back-N receiver behavior)
@@ -724,59 +1524,50 @@ implementation {
                expected = s->nextByteExpected;
                
                if (seqNum == expected) {
-                  // In-order segment: accept and place in recvBuf (circular)
-                  // Map seqNum (1-based) to buffer index (0-based, circular)
-                  bufIndex = (uint16_t)((seqNum - 1) % RECV_BUF_SIZE);
-                  spaceToEnd = (uint16_t)(RECV_BUF_SIZE - bufIndex);
-
-                  // Copy may wrap; split into at most two chunks
-                  firstChunk = dataLen;
-                  if (firstChunk > spaceToEnd) {
-                     firstChunk = spaceToEnd;
-                  }
-
-                  if (firstChunk > 0) {
-                     memcpy(&s->recvBuf[bufIndex], seg->data, firstChunk);
+                  // In-order segment: only accept it if the receive ring can back it
+                  if (dataLen > computeRecvFreeSpace(fd)) {
+                     dbg(TRANSPORT_CHANNEL, "EST: no buffer for seq=%lu len=%hhu (drop, fd=%hhu, poolFree=%hhu)\n",
+                         (unsigned long)seqNum, dataLen, fd, freeChunkCount);
+                     sendPureAck(fd);
+                     break;   // any FIN behind the dropped data waits for the retransmission
                   }
+                  ringReserve(s->recvChunk, RECV_BUF_SIZE, seqNum, dataLen);
+                  ringCopyIn(s->recvChunk, RECV_BUF_SIZE, seqNum, seg->data, dataLen);
 
-                  secondChunk = dataLen - firstChunk;
-                  if (secondChunk > 0) {
-                     memcpy(&s->recvBuf[0], seg->data + firstChunk, secondChunk);
+                  // Receive buffer goes from empty to non-empty: edge for readable()
+                  if (s->nextByteExpected - 1 == s->lastByteRead) {
+                     raiseEvent(fd, SOCK_EVT_READABLE);
                   }
 
                   // Advance expected sequence by full dataLen accepted
                   s->nextByteExpected += dataLen;
+
+                  // Piggyback the ACK on queued data if the window lets any out
+                  s->ackPendingSegs++;
+                  if (s->lastByteSent < s->lastByteWritten) {
+                     trySendData(fd);
+                  }
+
+                  // Otherwise delay it: ACK every TCP_DELACK_SEGS segments or on the timer
+                  if (s->ackPendingSegs >= TCP_DELACK_SEGS) {
+                     sendPureAck(fd);
+                  } else if (s->ackPendingSegs > 0) {
+                     if (s->ackPendingSegs == 1) {
+                        s->ackDeadline = call AckTimer.getNow() + TCP_DELACK_TIMEOUT;
+                     }
+                     scheduleAckTimer();
+                  }
                } else if (seqNum < expected) {
-                  // Duplicate or already received, ignore payload
+                  // Duplicate or already received, ignore payload and ACK immediately
                   dbg(TRANSPORT_CHANNEL, "EST: duplicate data seq=%lu expected=%lu (fd=%hhu)\n",
                       (unsigned long)seqNum, (unsigned long)expected, fd);
+                  sendPureAck(fd);
                } else { // seqNum > expected
-                  // Out-of-order ahead; Go-Back-N receiver drops payload
+                  // Out-of-order ahead; Go-Back-N receiver drops payload and ACKs immediately
                   dbg(TRANSPORT_CHANNEL, "EST: out-of-order seq=%lu expected=%lu (drop, fd=%hhu)\n",
                       (unsigned long)seqNum, (unsigned long)expected, fd);
+                  sendPureAck(fd);
                }
-               
-               // After any data, we always send a cumulative ACK
-               // (even if payload was dropped/duplicate).
-               ackToSend = s->nextByteExpected;
-               freeSpace = computeRecvFreeSpace(fd);
-               s->advWindow = freeSpace;
-               
-               dbg(TRANSPORT_CHANNEL,
-                   "EST: sending ACK ack=%lu advWindow=%u (fd=%hhu)\n",
-                   (unsigned long)ackToSend, freeSpace, fd);
-               
-               sendSegment(
-                  s->remoteAddr,
-                  s->localPort,
-                  s->remotePort,
-                  s->sndNext,
-                  ackToSend,
-                  TCP_FLAG_ACK,
-                  s->advWindow,
-                  NULL,
-                  0
-               );
             }
 
             // 3) Handle FIN from peer (passive close)
@@ -813,6 +1604,7 @@ implementation {
                s->finReceived = TRUE;
                s->state = TCP_STATE_CLOSE_WAIT;
                dbg(TRANSPORT_CHANNEL, "ESTABLISHED: fd=%hhu -> CLOSE_WAIT\n", fd);
+               raiseEvent(fd, SOCK_EVT_CLOSED);
                return;
             }
             
@@ -829,6 +1621,7 @@ implementation {
                if (ackNum > 0 && ackNum - 1 > s->lastByteAcked) {
                   s->lastByteAcked = ackNum - 1;
                   cleanupAckedRetrans(fd, s->lastByteAcked);
+                  trimSendRing(s);
                }
                s->remoteAdvWindow = seg->header.advWindow;
 
@@ -880,6 +1673,7 @@ implementation {
                if (ackNum > 0 && ackNum - 1 > s->lastByteAcked) {
                   s->lastByteAcked = ackNum - 1;
                   cleanupAckedRetrans(fd, s->lastByteAcked);
+                  trimSendRing(s);
                }
                s->remoteAdvWindow = seg->header.advWindow;
             }
@@ -949,6 +1743,7 @@ implementation {
                if (ackNum > 0 && ackNum - 1 > s->lastByteAcked) {
                   s->lastByteAcked = ackNum - 1;
                   cleanupAckedRetrans(fd, s->lastByteAcked);
+                  trimSendRing(s);
                }
                s->remoteAdvWindow = seg->header.advWindow;
                if (s->finInFlight && s->lastByteAcked >= s->finSeq) {
@@ -1014,42 +1809,74 @@ implementation {
                       uint32_t seq, uint32_t ack, uint8_t flags, 
                       uint16_t advWindow, uint8_t *data, uint8_t dataLen) {
       tcp_segment_t tcpSeg;
+      tcp_compact_segment_t compactSeg;
       uint8_t len;
       uint16_t nextHop;
       pack sendPack;
+      socket_t fd;
+      bool compact;
+      uint8_t maxData;
 
-      
-      
-      // TCP header
-      tcpSeg.header.srcPort = srcPort;
-      tcpSeg.header.dstPort = dstPort;
-      tcpSeg.header.seq = seq;
-      tcpSeg.header.ack = ack;
-      tcpSeg.header.flags = flags;
-      tcpSeg.header.advWindow = advWindow;
-
-      // Copy data payload
+      // SYNs use the full header so the peer can negotiate (or ignore) the compact one,
+      // except a fast-open SYN with data, which goes compact to carry more of it
+      fd = findSocketBy4Tuple(TOS_NODE_ID, srcPort, dstAddr, dstPort);
+      compact = (fd != NULL_SOCKET && sockets[fd].compact && !(flags & TCP_FLAG_SYN));
+      if ((flags & (TCP_FLAG_SYN | TCP_FLAG_ACK | TCP_FLAG_FASTOPEN)) == (TCP_FLAG_SYN | TCP_FLAG_FASTOPEN) &&
+          dataLen > 0 && compactPortsFit(srcPort, dstPort)) {
+         compact = TRUE;
+      }
+      maxData = compact ? TCP_COMPACT_MSS : TCP_MSS;
+
+      // Clamp data payload to the MSS of the chosen format
       if (dataLen > 0 && data != NULL) {
-         if (dataLen > TCP_MAX_DATA) {
-            dataLen = TCP_MAX_DATA;
-         }
-         if (dataLen > TCP_MSS) {
-            dataLen = TCP_MSS;
+         if (dataLen > maxData) {
+            dataLen = maxData;
          }
-         memcpy(tcpSeg.data, data, dataLen);
       } else {
          dataLen = 0;
       }
 
-      // Set dataLen in header to tell receiver exact payload size
-      tcpSeg.header.dataLen = dataLen;
-      
-      // Calculate total segment length
-      len = sizeof(tcp_header_t) + dataLen;
+      if (compact) {
+         uint16_t scaledWindow = advWindow >> TCP_COMPACT_WND_SHIFT;
+         if (scaledWindow > 255) {
+            scaledWindow = 255;
+         }
+
+         // Compact header: 8-bit ports, 16-bit seq/ack, flags and dataLen share a byte
+         compactSeg.header.srcPort = (uint8_t)srcPort;
+         compactSeg.header.dstPort = (uint8_t)dstPort;
+         compactSeg.header.seq = (uint16_t)seq;
+         compactSeg.header.ack = (uint16_t)ack;
+         compactSeg.header.flagsLen = (uint8_t)((compactFlagsOut(flags) << TCP_COMPACT_FLAGS_SHIFT) |
+                                                (dataLen & TCP_COMPACT_LEN_MASK));
+         compactSeg.header.advWindow = (uint8_t)scaledWindow;
+         if (dataLen > 0) {
+            memcpy(compactSeg.data, data, dataLen);
+         }
+         len = sizeof(tcp_compact_header_t) + dataLen;
+      } else {
+         // TCP header
+         tcpSeg.header.srcPort = srcPort;
+         tcpSeg.header.dstPort = dstPort;
+         tcpSeg.header.seq = seq;
+         tcpSeg.header.ack = ack;
+         tcpSeg.header.flags = flags;
+         tcpSeg.header.advWindow = advWindow;
+         if (dataLen > 0) {
+            memcpy(tcpSeg.data, data, dataLen);
+         }
+
+         // Set dataLen in header to tell receiver exact payload size
+         tcpSeg.header.dataLen = dataLen;
+
+         // Calculate total segment length
+         len = sizeof(tcp_header_t) + dataLen;
+      }
       
-      // Get next hop for destination
-      nextHop = call LinkState.nextHop(dstAddr);   // call routing
+      // Get next hop for destination, spreading flows over equal-cost paths
+      nextHop = call LinkState.nextHopFor(dstAddr, tcpFlowHash(TOS_NODE_ID, dstAddr, srcPort, dstPort));
       if (nextHop == 0xFFFF) {
+         statNoRoute++;
          return FAIL;
       }
       
@@ -1059,15 +1886,23 @@ implementation {
       sendPack.dest = dstAddr;
       sendPack.TTL = MAX_TTL;
       sendPack.seq = 0; 
-      sendPack.protocol = PROTOCOL_TCP;
+      sendPack.protocol = compact ? PROTOCOL_TCP_COMPACT : PROTOCOL_TCP;
       
       if (len > PACKET_MAX_PAYLOAD_SIZE) {
          return FAIL;
       }
-      memcpy(sendPack.payload, (uint8_t *)&tcpSeg, len);
+      if (compact) {
+         memcpy(sendPack.payload, (uint8_t *)&compactSeg, len);
+      } else {
+         memcpy(sendPack.payload, (uint8_t *)&tcpSeg, len);
+      }
       
       // Send via SimpleSend to next hop
       if (call SimpleSend.send(sendPack, nextHop) == SUCCESS) {
+         statSegsOut++;
+         if (fd != NULL_SOCKET && (flags & TCP_FLAG_ACK)) {
+            noteAckSent(&sockets[fd], (flags == TCP_FLAG_ACK && dataLen == 0));
+         }
          return SUCCESS;
       }
       
@@ -1148,6 +1983,21 @@ implementation {
       s->remoteAddr = addr->addr;
       s->remotePort = addr->port;
 
+      // Fast open: hold the SYN until the caller's task is done, so the bytes it
+      // writes straight after connect() can go out on the SYN
+      if (s->fastOpen) {
+         s->state = TCP_STATE_SYN_SENT;
+         s->synDeferred = TRUE;
+         if (post synTask() != SUCCESS) {
+            s->synDeferred = FALSE;
+            s->state = TCP_STATE_CLOSED;
+            return FAIL;
+         }
+         dbg(TRANSPORT_CHANNEL, "connect(): fd=%hhu to %hu:%hu (fast open)\n",
+             fd, s->remoteAddr, s->remotePort);
+         return SUCCESS;
+      }
+
       if (startClientHandshake(fd, s->remoteAddr, s->remotePort, s->localPort) != SUCCESS) {
          return FAIL;
       }
@@ -1214,6 +2064,12 @@ implementation {
 
          s->pendingAccept = FALSE;
 
+         // Data that arrived before accept() raised readable() on an fd the
+         // application did not own yet; raise it again now that it does
+         if (s->nextByteExpected - 1 > s->lastByteRead) {
+            raiseEvent(i, SOCK_EVT_READABLE);
+         }
+
          return (socket_t)i;
       }
 
@@ -1225,10 +2081,6 @@ implementation {
       uint32_t used;
       uint16_t freeSpace;
       uint16_t toCopy;
-      uint32_t startIndex;
-      uint16_t firstChunk;
-      uint16_t spaceToEnd;
-      uint16_t secondChunk;
 
       // Validate socket
       if (fd >= MAX_SOCKETS || !sockets[fd].inUse) {
@@ -1247,11 +2099,16 @@ implementation {
       // Bytes currently buffered but not yet ACKed
       used = s->lastByteWritten - s->lastByteAcked;
       if (used >= SEND_BUF_SIZE) {
-         // No space in send buffer
+         // No space in send buffer; writable() fires once ACKs free some
+         s->writeBlocked = TRUE;
          return 0;
       }
 
-      freeSpace = (uint16_t)(SEND_BUF_SIZE - used);
+      // Free space is bounded by the socket cap and by what the shared pool can lend
+      freeSpace = ringRoom(s->sendChunk, SEND_BUF_SIZE, s->lastByteWritten + 1, (uint16_t)used);
+      if (bufflen > freeSpace) {
+         s->writeBlocked = TRUE;
+      }
 
       toCopy = bufflen;
       if (toCopy > freeSpace) {
@@ -1265,24 +2122,9 @@ implementation {
          return 0;
       }
 
-      // Starting index into sendBuf for new data (0-based, circular)
-      startIndex = (uint32_t)(s->lastByteWritten % SEND_BUF_SIZE);
-
-      // Copy may wrap; split into at most two chunks
-      spaceToEnd = (uint16_t)(SEND_BUF_SIZE - startIndex);
-      firstChunk = toCopy;
-      if (firstChunk > spaceToEnd) {
-         firstChunk = spaceToEnd;
-      }
-
-      if (firstChunk > 0) {
-         memcpy(&s->sendBuf[startIndex], buff, firstChunk);
-      }
-
-      secondChunk = toCopy - firstChunk;
-      if (secondChunk > 0) {
-         memcpy(&s->sendBuf[0], buff + firstChunk, secondChunk);
-      }
+      // Borrow chunks for the new bytes and copy them into the send ring
+      ringReserve(s->sendChunk, SEND_BUF_SIZE, s->lastByteWritten + 1, toCopy);
+      ringCopyIn(s->sendChunk, SEND_BUF_SIZE, s->lastByteWritten + 1, buff, toCopy);
 
       s->lastByteWritten += toCopy;
 
@@ -1300,12 +2142,7 @@ implementation {
       socket_cb_t *s;
       uint32_t available;
       uint16_t toCopy;
-      uint32_t startIndex;
-      uint16_t firstChunk;
-      uint16_t spaceToEnd;
-      uint16_t secondChunk;
       uint16_t freeSpace;
-      uint32_t nextSeqToRead;
 
       // Validate socket
       if (fd >= MAX_SOCKETS || !sockets[fd].inUse || sockets[fd].state != TCP_STATE_ESTABLISHED) {
@@ -1354,31 +2191,11 @@ implementation {
          return 0;
       }
 
-      // Starting index into recvBuf (0-based, circular)
       // The next byte to read is at sequence number (lastByteRead + 1)
-      // We store sequence number N at buffer index (N - 1) % RECV_BUF_SIZE
-      // Compute the buffer index for the next sequence to read
-      nextSeqToRead = s->lastByteRead + 1;
-
-      startIndex = (nextSeqToRead - 1) % RECV_BUF_SIZE;  // wrap around circular buffer
-
-      // Copy may wrap; split into at most two chunks
-      spaceToEnd = (uint16_t)(RECV_BUF_SIZE - startIndex);
-      firstChunk = toCopy;
-      if (firstChunk > spaceToEnd) {
-         firstChunk = spaceToEnd;
-      }
-
-      if (firstChunk > 0) {
-         memcpy(buff, &s->recvBuf[startIndex], firstChunk);
-      }
-
-      secondChunk = toCopy - firstChunk;
-      if (secondChunk > 0) {
-         memcpy(buff + firstChunk, &s->recvBuf[0], secondChunk);
-      }
+      ringCopyOut(s->recvChunk, RECV_BUF_SIZE, s->lastByteRead + 1, buff, toCopy);
 
       s->lastByteRead += toCopy;
+      trimRecvRing(s);
 
       dbg(TRANSPORT_CHANNEL,
           "read: fd=%hhu read=%hu available=%lu lastByteRead=%lu\n",
@@ -1408,6 +2225,278 @@ implementation {
       return toCopy;
    }
 
+   // Answer a SYN on a listening port. An ordinary SYN only takes a SYN queue
+   // entry; the socket is built when the final ACK arrives (completeSyn). A
+   // fast-open SYN with a valid cookie gets its socket at once: its data is
+   // accepted and the connection established. One without a valid cookie gets
+   // a cookie back in the SYN+ACK and is queued like any other.
+   static void acceptSyn(uint16_t srcAddr, uint16_t dstAddr, tcp_segment_t *seg, uint8_t dataLen) {
+      uint16_t srcPort = seg->header.srcPort;
+      uint16_t dstPort = seg->header.dstPort;
+      uint32_t seq = seg->header.seq;
+      uint8_t flags = seg->header.flags;
+      socket_t listenFd;
+      socket_t newFd;
+      socket_cb_t *newS;
+      syn_entry_t *e;
+      uint8_t idx;
+      uint32_t now;
+      uint8_t synAckFlags;
+      uint8_t cookieBuf[2];
+      uint8_t cookieLen = 0;
+      bool compact;
+      bool fastOpen = FALSE;
+      uint16_t cookie;
+
+      listenFd = findListeningSocketByPort(dstPort);
+      if (listenFd == NULL_SOCKET) {
+         return;
+      }
+
+      // Accept the compact header if the client offered it
+      synAckFlags = TCP_FLAG_SYN | TCP_FLAG_ACK;
+      compact = (flags & TCP_FLAG_COMPACT) && compactPortsFit(dstPort, srcPort);
+      if (compact) {
+         synAckFlags |= TCP_FLAG_COMPACT;
+      }
+
+      if (TCP_FASTOPEN_ENABLE && (flags & TCP_FLAG_FASTOPEN)) {
+         cookie = tfoCookieFor(srcAddr);
+         if (dataLen > 0 && (uint16_t)seg->header.ack == cookie && dataLen <= freshRecvWindow()) {
+            fastOpen = TRUE;
+         } else {
+            // No cookie yet (or a stale one): hand one out, the data is sent again after the handshake
+            cookieBuf[0] = (uint8_t)(cookie >> 8);
+            cookieBuf[1] = (uint8_t)cookie;
+            cookieLen = 2;
+            synAckFlags |= TCP_FLAG_FASTOPEN;
+            statTfoCookies++;
+         }
+      }
+
+      if (!fastOpen) {
+         // A repeated SYN reuses its entry and gets the SYN+ACK again
+         now = call RetransTimer.getNow();
+         idx = findSynEntry(dstAddr, dstPort, srcAddr, srcPort);
+         if (idx == NULL_SYN) {
+            idx = allocSynEntry(listenFd, now);
+            if (idx == NULL_SYN) {
+               statSynDrops++;
+               dbg(TRANSPORT_CHANNEL, "SYN from %hu:%hu dropped, backlog full on port %hu\n",
+                   srcAddr, srcPort, dstPort);
+               return;
+            }
+            if (synq[idx].inUse) {
+               // Recycling a stale handshake: its client may believe it is connected
+               e = &synq[idx];
+               sendReset(e->remoteAddr, e->localPort, e->remotePort, e->irs + 1);
+            }
+         }
+         e = &synq[idx];
+         e->inUse = TRUE;
+         e->listenFd = listenFd;
+         e->localAddr = dstAddr;
+         e->localPort = dstPort;
+         e->remoteAddr = srcAddr;
+         e->remotePort = srcPort;
+         e->irs = seq;
+         e->compact = compact;
+         e->createdAt = now;
+
+         if (sendSegment(srcAddr, dstPort, srcPort, 0, seq + 1,
+                         synAckFlags, freshRecvWindow(), cookieBuf, cookieLen) != SUCCESS) {
+            e->inUse = FALSE;
+            return;
+         }
+         dbg(TRANSPORT_CHANNEL, "SYN received from %hu:%hu, SYN+ACK sent, queued in synq[%hhu]\n",
+             srcAddr, srcPort, idx);
+         return;
+      }
+
+      newFd = allocSocket();
+      if (newFd == NULL_SOCKET) {
+         statSynDrops++;
+         return;
+      }
+      newS = &sockets[newFd];
+      
+      newS->localAddr = dstAddr;
+      newS->localPort = dstPort;
+      newS->remoteAddr = srcAddr;
+      newS->remotePort = srcPort;
+      
+      newS->iss = 0; 
+      newS->sndNext = newS->iss + 1;  
+      newS->irs = seq;  
+      newS->rcvNext = seq + 1;
+      newS->isServer = TRUE;
+      newS->pendingAccept = TRUE;
+      if (compact) {
+         enableCompact(newS);
+      }
+
+      // Data on the SYN is sequence 1..dataLen; take it before the app accepts
+      ringReserve(newS->recvChunk, RECV_BUF_SIZE, newS->rcvNext, dataLen);
+      ringCopyIn(newS->recvChunk, RECV_BUF_SIZE, newS->rcvNext, seg->data, dataLen);
+      newS->nextByteExpected = newS->rcvNext + dataLen;
+      newS->rcvNext = newS->nextByteExpected;
+      newS->lastByteRead = 0;
+      newS->advWindow = computeRecvFreeSpace(newFd);
+      statTfoAccepted++;
+      
+      if (sendSegment(srcAddr, dstPort, srcPort,
+                      newS->iss, newS->rcvNext, 
+                      synAckFlags, newS->advWindow, NULL, 0) != SUCCESS) {
+         freeSocket(newFd);
+         return;
+      }
+
+      // The cookie proves the client's address, so skip waiting for the final ACK:
+      // the app sees the request now and its reply can leave right away
+      newS->state = TCP_STATE_ESTABLISHED;
+      newS->cwnd = newS->mss;
+      if (newS->ssthresh < 2 * newS->mss) {
+         newS->ssthresh = 4 * newS->mss;
+      }
+      dbg(TRANSPORT_CHANNEL, "Server: fast open from %hu:%hu with %hhu bytes, newFd=%hhu ESTABLISHED\n",
+          srcAddr, srcPort, dataLen, newFd);
+      raiseEvent(listenFd, SOCK_EVT_ACCEPTABLE);
+   }
+
+   // The final ACK of a queued handshake: build the socket in SYN_RCVD and let the
+   // state machine establish it. The client is already ESTABLISHED, so with no
+   // socket free it gets a reset rather than waiting for a connection that never comes.
+   static void completeSyn(uint8_t idx, tcp_segment_t *seg, uint8_t dataLen) {
+      syn_entry_t *e = &synq[idx];
+      socket_t fd;
+      socket_cb_t *s;
+
+      if ((seg->header.flags & (TCP_FLAG_SYN | TCP_FLAG_ACK)) != TCP_FLAG_ACK ||
+          seg->header.ack != 1 || seg->header.seq != e->irs + 1) {
+         return;
+      }
+      fd = allocSocket();
+      if (fd == NULL_SOCKET) {
+         statSynNoSocket++;
+         dbg(TRANSPORT_CHANNEL, "Handshake from %hu:%hu complete but no free socket, reset\n",
+             e->remoteAddr, e->remotePort);
+         e->inUse = FALSE;
+         sendReset(e->remoteAddr, e->localPort, e->remotePort, e->irs + 1);
+         return;
+      }
+      s = &sockets[fd];
+      s->localAddr = e->localAddr;
+      s->localPort = e->localPort;
+      s->remoteAddr = e->remoteAddr;
+      s->remotePort = e->remotePort;
+      s->iss = 0;
+      s->sndNext = s->iss + 1;
+      s->irs = e->irs;
+      s->rcvNext = e->irs + 1;
+      s->isServer = TRUE;
+      s->pendingAccept = TRUE;
+      s->state = TCP_STATE_SYN_RCVD;
+      if (e->compact) {
+         enableCompact(s);
+      }
+      e->inUse = FALSE;
+
+      handleSegmentForSocket(fd, seg, dataLen);
+      // If the ACK that completed the handshake also carried data, take it too
+      if (dataLen > 0 && s->state == TCP_STATE_ESTABLISHED) {
+         handleSegmentForSocket(fd, seg, dataLen);
+      }
+   }
+
+   // Expand a compact segment into the full header and hand it to the socket state machine
+   static error_t receiveCompact(pack* package) {
+      tcp_compact_segment_t *cseg;
+      tcp_segment_t seg;
+      socket_cb_t *s;
+      socket_t fd;
+      uint8_t idx;
+      uint8_t dataLen;
+
+      cseg = (tcp_compact_segment_t *)package->payload;
+
+      dataLen = cseg->header.flagsLen & TCP_COMPACT_LEN_MASK;
+      if (dataLen > TCP_COMPACT_MSS) {
+         return FAIL;
+      }
+
+      seg.header.srcPort = cseg->header.srcPort;
+      seg.header.dstPort = cseg->header.dstPort;
+      seg.header.flags = compactFlagsIn(cseg->header.flagsLen >> TCP_COMPACT_FLAGS_SHIFT);
+      seg.header.advWindow = (uint16_t)cseg->header.advWindow << TCP_COMPACT_WND_SHIFT;
+      seg.header.dataLen = dataLen;
+      if (dataLen > 0) {
+         memcpy(seg.data, cseg->data, dataLen);
+      }
+
+      fd = findSocketBy4Tuple(package->dest, cseg->header.dstPort,
+                              package->src, cseg->header.srcPort);
+
+      // A compact SYN is a fast-open SYN: seq and ack (the cookie) are taken as
+      // sent, and it implies the offer of the compact header
+      if (fd == NULL_SOCKET && (seg.header.flags & (TCP_FLAG_SYN | TCP_FLAG_ACK)) == TCP_FLAG_SYN) {
+         seg.header.seq = cseg->header.seq;
+         seg.header.ack = cseg->header.ack;
+         seg.header.flags |= TCP_FLAG_COMPACT;
+         acceptSyn(package->src, package->dest, &seg, dataLen);
+         return SUCCESS;
+      }
+
+      // The final ACK of a queued handshake that agreed on the compact header
+      if (fd == NULL_SOCKET) {
+         idx = findSynEntry(package->dest, cseg->header.dstPort,
+                            package->src, cseg->header.srcPort);
+         if (idx == NULL_SYN || !synq[idx].compact) {
+            return FAIL;
+         }
+         seg.header.seq = unwrapSeq16(cseg->header.seq, synq[idx].irs + 1);
+         seg.header.ack = unwrapSeq16(cseg->header.ack, 1);
+         completeSyn(idx, &seg, dataLen);
+         return SUCCESS;
+      }
+
+      // Other compact segments are only valid on connections that negotiated them
+      if (!sockets[fd].compact) {
+         return FAIL;
+      }
+      s = &sockets[fd];
+
+      seg.header.seq = unwrapSeq16(cseg->header.seq, s->nextByteExpected);
+      seg.header.ack = unwrapSeq16(cseg->header.ack, s->lastByteAcked + 1);
+
+      handleSegmentForSocket(fd, &seg, dataLen);
+      return SUCCESS;
+   }
+
+   // One "STAT tcp" summary line, then one "STAT tcp_sock" line per open socket
+   command void Transport.printStats() {
+      uint8_t i;
+      uint8_t open = 0;
+      uint8_t queued = 0;
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         if (sockets[i].inUse) open++;
+      }
+      for (i = 0; i < TCP_SYNQ_SIZE; i++) {
+         if (synq[i].inUse) queued++;
+      }
+      dbg(STATS_CHANNEL, "STAT tcp sockets=%u segsout=%u segsin=%u noroute=%u retrans=%u timeouts=%u stalls=%u poolfree=%u poolmin=%u tfosent=%u tfoaccepted=%u tfocookies=%u synq=%u syndrops=%u synnosocket=%u resets=%u\n",
+          open, statSegsOut, statSegsIn, statNoRoute, statRetransTotal, statTimeoutsTotal, statStallsTotal,
+          freeChunkCount, minFreeChunks, statTfoSent, statTfoAccepted, statTfoCookies,
+          queued, statSynDrops, statSynNoSocket, statResets);
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         socket_cb_t *s = &sockets[i];
+         if (!s->inUse) continue;
+         dbg(STATS_CHANNEL, "STAT tcp_sock fd=%u state=%u lport=%u raddr=%u rport=%u sent=%u retrans=%u timeouts=%u stalls=%u cwnd=%u srtt=%u paced=%u\n",
+             i, s->state, s->localPort, s->remoteAddr, s->remotePort, s->segsSent, s->retransSegs,
+             s->timeouts, s->windowStalls, s->cwnd, s->srtt, s->pacedSegs);
+      }
+      call SimpleSend.printStats("tcp_send");
+   }
+
    command error_t Transport.receive(pack* package) {
       tcp_segment_t *seg;
       uint8_t totalLen;
@@ -1421,8 +2510,15 @@ implementation {
       uint8_t flags;
       uint16_t advWindow;
       socket_t fd;
+      uint8_t idx;
       
       
+      if (package->protocol == PROTOCOL_TCP || package->protocol == PROTOCOL_TCP_COMPACT) {
+         statSegsIn++;
+      }
+      if (package->protocol == PROTOCOL_TCP_COMPACT) {
+         return receiveCompact(package);
+      }
       if (package->protocol != PROTOCOL_TCP) {
          return FAIL;
       }
@@ -1453,42 +2549,15 @@ implementation {
 
       } else {
 
-         if (flags & TCP_FLAG_SYN) {
-            socket_t listenFd = findListeningSocketByPort(dstPort);
-            
-            if (listenFd != NULL_SOCKET) {
-               socket_t newFd = allocSocket();
-               
-               if (newFd != NULL_SOCKET) {
-                  socket_cb_t *newS = &sockets[newFd];
-                  
-                  newS->localAddr = dstAddr;
-                  newS->localPort = dstPort;
-                  newS->remoteAddr = srcAddr;
-                  newS->remotePort = srcPort;
-                  
-                  
-                  newS->iss = 0; 
-                  newS->sndNext = newS->iss + 1;  
-                  newS->irs = seq;  
-                  newS->rcvNext = seq + 1;
-                  newS->advWindow = RECV_BUF_SIZE;
-                  newS->isServer = TRUE;
-                  newS->pendingAccept = TRUE;
-                  
-                  newS->state = TCP_STATE_SYN_RCVD;
-                  
-                  if (sendSegment(srcAddr, dstPort, srcPort,
-                                  newS->iss, newS->rcvNext, 
-                                  TCP_FLAG_SYN | TCP_FLAG_ACK, newS->advWindow, NULL, 0) == SUCCESS) {
-                     dbg(TRANSPORT_CHANNEL, "SYN received from %hu:%hu, SYN+ACK sent, newFd=%hhu (pendingAccept=TRUE)\n", 
-                         srcAddr, srcPort, newFd);
-                  } else {
-                     freeSocket(newFd);
-                  }
-               } 
-            } 
-         } 
+         if ((flags & TCP_FLAG_SYN) && dataLen <= TCP_MSS) {
+            acceptSyn(srcAddr, dstAddr, seg, dataLen);
+         } else {
+            // No socket yet: this may be the final ACK of a queued handshake
+            idx = findSynEntry(dstAddr, dstPort, srcAddr, srcPort);
+            if (idx != NULL_SYN) {
+               completeSyn(idx, seg, dataLen);
+            }
+         }
       }
       
       return SUCCESS;
@@ -1531,14 +2600,38 @@ implementation {
       }
    }
 
+   command error_t Transport.setFastOpen(socket_t fd, bool enable) {
+      if (fd >= MAX_SOCKETS || !sockets[fd].inUse || sockets[fd].state != TCP_STATE_CLOSED) {
+         return FAIL;
+      }
+      sockets[fd].fastOpen = enable;
+      return SUCCESS;
+   }
+
    command error_t Transport.release(socket_t fd) {
       return FAIL;
    }
+
+   command error_t Transport.setPacing(socket_t fd, uint8_t gainPct) {
+      if (fd >= MAX_SOCKETS || !sockets[fd].inUse) {
+         return FAIL;
+      }
+      sockets[fd].paceGain = gainPct;
+      if (gainPct == 0 && sockets[fd].paceWaiting) {
+         // Pacing turned off with a segment held back: let it go now
+         sockets[fd].paceWaiting = FALSE;
+         trySendData(fd);
+         schedulePaceTimer();
+      }
+      return SUCCESS;
+   }
    
 
    // Testing TCP infra
    event void Boot.booted() {
       initRetransQueue();
+      initChunkPool();
+      tfoSecret = call Random.rand16();
       call TestTimer.startOneShot(10000);  // 10 seconds to let routing converge
    }
 
@@ -1604,6 +2697,17 @@ implementation {
          return;
       }
 
+      // A fast-open SYN (or its SYN+ACK) was lost: send the SYN with its data again
+      if (s->state == TCP_STATE_SYN_SENT) {
+         s->timeouts++;
+         statTimeoutsTotal++;
+         clearRetransEntriesForSocket(entry->fd);
+         dbg(TRANSPORT_CHANNEL, "Client: fast-open SYN timed out, resending (fd=%hhu)\n", entry->fd);
+         startClientHandshake(entry->fd, s->remoteAddr, s->remotePort, s->localPort);
+         scheduleRetransTimer();
+         return;
+      }
+
       switch (s->state) {
          case TCP_STATE_ESTABLISHED:
          case TCP_STATE_FIN_WAIT_1:
@@ -1624,20 +2728,26 @@ implementation {
          return;
       }
 
+      s->timeouts++;
+      statTimeoutsTotal++;
+
       // AIMD on congestion window for this timeout
-      if (s->cwnd > TCP_MSS) {
+      if (s->cwnd > s->mss) {
          uint16_t newSsthresh = s->cwnd / 2;
-         if (newSsthresh < TCP_MSS) {
-            newSsthresh = TCP_MSS;
+         if (newSsthresh < s->mss) {
+            newSsthresh = s->mss;
          }
          s->ssthresh = newSsthresh;
       }
-      s->cwnd = TCP_MSS;
+      s->cwnd = s->mss;
 
       // Go-Back-N: reset send pointer to last ACKed byte
       s->lastByteSent = s->lastByteAcked;
       s->sndNext = s->lastByteSent + 1;
 
+      // Karn: the timed segment is being resent, so its sample would be ambiguous
+      s->rttSeq = 0;
+
       clearRetransEntriesForSocket(entry->fd);
 
       // Resend all unACKed data
@@ -1646,6 +2756,46 @@ implementation {
       scheduleRetransTimer();
    }
    
+   // Flush delayed ACKs whose deadline has passed
+   event void AckTimer.fired() {
+      uint8_t i;
+      uint32_t now = call AckTimer.getNow();
+
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         socket_cb_t *s = &sockets[i];
+         if (!s->inUse || s->ackPendingSegs == 0 || s->ackDeadline > now) {
+            continue;
+         }
+         sendPureAck(i);
+         if (s->ackPendingSegs > 0) {
+            // Send queue was full; try again after another delay
+            s->ackDeadline = now + TCP_DELACK_TIMEOUT;
+         }
+      }
+
+      scheduleAckTimer();
+   }
+
+   // Release segments whose pacing slot has arrived
+   event void PaceTimer.fired() {
+      uint8_t i;
+      uint32_t now = call PaceTimer.getNow();
+
+      for (i = 0; i < MAX_SOCKETS; i++) {
+         socket_cb_t *s = &sockets[i];
+         if (!s->inUse || !s->paceWaiting || (int32_t)(s->paceNext - now) > 0) {
+            continue;
+         }
+         if (s->state != TCP_STATE_ESTABLISHED) {
+            s->paceWaiting = FALSE;
+            continue;
+         }
+         trySendData(i);
+      }
+
+      schedulePaceTimer();
+   }
+
    event void TestTimer.fired() {
       sendSegment(2, 1234, 5678, 0, 0, TCP_FLAG_SYN, 100, NULL, 0);
    }
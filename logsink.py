@@ -0,0 +1,198 @@
+# Buffered log sink for TestSim channels.
+#
+# TOSSIM writes dbg output through a C FILE*, so a sink hands it one spool file
+# per channel and TestSim drains the spools after every run(). Drained output
+# is gathered into large chunks and written to a log file, optionally
+# compressed (gzip-compatible zlib or xz) and rotated by size. It can also be
+# kept as a bounded ring of the last N lines per channel, so verbose channels
+# can stay on in long sweeps and still be inspected after a failure.
+#
+#   sink = LogSink("run.log", compress="zlib", rotateBytes=64 << 20)
+#   s.addChannel(s.TRANSPORT_CHANNEL, sink)
+#   ...
+#   s.closeLogs()
+#
+#   ring = LogSink(ringLines=200)            # memory only
+#   s.addChannel(s.FLOODING_CHANNEL, ring)
+#   ...
+#   ring.dumpTail(s.FLOODING_CHANNEL)
+
+import collections
+import sys
+import tempfile
+import zlib
+
+try:
+    import lzma
+except ImportError:     # Python 2 without backports.lzma
+    lzma = None
+
+
+class LogSink(object):
+    SPOOL_BUFFER = 1 << 20      # stdio buffer behind each channel's spool file
+
+    def __init__(self, path=None, compress=None, level=6, rotateBytes=0,
+                 chunkBytes=1 << 20, ringLines=0):
+        if compress not in (None, "zlib", "lzma"):
+            raise ValueError("compress must be None, 'zlib' or 'lzma'")
+        if compress == "lzma" and lzma is None:
+            raise ValueError("lzma compression needs the lzma module")
+        if path is None and ringLines <= 0:
+            raise ValueError("LogSink needs a path, a ring, or both")
+
+        self.path = path
+        self.compress = compress
+        self.level = level
+        self.rotateBytes = rotateBytes
+        self.chunkBytes = chunkBytes
+        self.ringLines = ringLines
+
+        self.spools = {}            # channel -> spool file handed to TOSSIM
+        self.rings = {}             # channel -> deque of the last ringLines lines
+        self.partial = {}           # channel -> unterminated tail of the last drain
+        self.pending = []           # drained chunks not yet written out
+        self.pendingBytes = 0
+
+        self.out = None             # current log file
+        self.compressor = None
+        self.fileIndex = 0
+        self.fileBytes = 0          # uncompressed bytes in the current file
+        self.files = []             # every file written so far
+
+        self.bytesIn = {}           # channel -> bytes drained
+        self.bytesOut = 0           # bytes written to disk (after compression)
+
+    # Spool file for one channel; pass it to Tossim.addChannel
+    def spoolFor(self, channel):
+        if channel not in self.spools:
+            self.spools[channel] = tempfile.TemporaryFile("w+b", self.SPOOL_BUFFER)
+            self.bytesIn[channel] = 0
+            if self.ringLines > 0:
+                self.rings[channel] = collections.deque(maxlen=self.ringLines)
+                self.partial[channel] = ""
+        return self.spools[channel]
+
+    # Move everything TOSSIM has written since the last drain into the sink.
+    # Returns {channel: bytes} for this drain.
+    def drain(self):
+        drained = {}
+        for channel, spool in self.spools.items():
+            spool.flush()
+            spool.seek(0)
+            data = spool.read()
+            # Reuse the spool from the start so it never grows past one run()
+            spool.seek(0)
+            spool.truncate()
+            if not data:
+                continue
+            drained[channel] = len(data)
+            self.write(data, channel)
+        return drained
+
+    # Add output to the sink directly (also used for drained spool data)
+    def write(self, data, channel=None):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        if channel is not None:
+            self.bytesIn[channel] = self.bytesIn.get(channel, 0) + len(data)
+            if channel in self.rings:
+                self._ring(channel, data)
+        if self.path is not None:
+            self.pending.append(data)
+            self.pendingBytes += len(data)
+            if self.pendingBytes >= self.chunkBytes:
+                self.flush()
+
+    def _ring(self, channel, data):
+        text = self.partial[channel] + data.decode("utf-8", "replace")
+        lines = text.split("\n")
+        self.partial[channel] = lines.pop()
+        self.rings[channel].extend(lines)
+
+    # Write buffered chunks to the current file, rotating when it is full
+    def flush(self):
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        self.pending = []
+        self.pendingBytes = 0
+        while data:
+            if self.out is None:
+                self._open()
+            room = len(data)
+            if self.rotateBytes > 0 and self.fileBytes + room > self.rotateBytes:
+                # Rotate on a line boundary; only split a line that fills a whole file
+                cut = data.rfind(b"\n", 0, max(self.rotateBytes - self.fileBytes, 0))
+                if cut >= 0:
+                    room = cut + 1
+                elif self.fileBytes > 0:
+                    self._finish()
+                    continue
+                else:
+                    room = self.rotateBytes
+            self._emit(data[:room])
+            data = data[room:]
+            if self.rotateBytes > 0 and self.fileBytes >= self.rotateBytes:
+                self._finish()
+
+    def _fileName(self):
+        suffix = {None: "", "zlib": ".gz", "lzma": ".xz"}[self.compress]
+        if self.rotateBytes > 0:
+            return "%s.%03d%s" % (self.path, self.fileIndex, suffix)
+        return self.path + suffix
+
+    def _open(self):
+        name = self._fileName()
+        self.out = open(name, "wb")
+        self.files.append(name)
+        self.fileBytes = 0
+        if self.compress == "zlib":
+            # wbits 31 writes a gzip header, so the files open with zcat/gzip
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        elif self.compress == "lzma":
+            self.compressor = lzma.LZMACompressor(preset=self.level)
+        else:
+            self.compressor = None
+
+    def _emit(self, data):
+        self.fileBytes += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if data:
+            self.out.write(data)
+            self.bytesOut += len(data)
+
+    def _finish(self):
+        if self.out is None:
+            return
+        if self.compressor is not None:
+            tail = self.compressor.flush()
+            self.out.write(tail)
+            self.bytesOut += len(tail)
+        self.out.close()
+        self.out = None
+        self.compressor = None
+        self.fileIndex += 1
+
+    # Last n ring lines for one channel, or for every channel in name order
+    def tail(self, channel=None, n=None):
+        channels = [channel] if channel is not None else sorted(self.rings)
+        lines = []
+        for name in channels:
+            ring = list(self.rings.get(name, []))
+            if self.partial.get(name):
+                ring.append(self.partial[name])
+            lines.extend(ring if n is None else ring[-n:])
+        return lines
+
+    def dumpTail(self, channel=None, n=None, out=sys.stdout):
+        for line in self.tail(channel, n):
+            out.write(line + "\n")
+
+    def close(self):
+        self.drain()
+        self.flush()
+        self._finish()
+        for spool in self.spools.values():
+            spool.close()
+        self.spools = {}
@@ -0,0 +1,28 @@
+import sys
+from TestSim import TestSim
+
+# All-pairs ping benchmark for one topology/noise combination:
+#   python2 pingSweep.py long_line.topo meyer-heavy.txt [pairs to sample]
+def main():
+    topo = sys.argv[1] if len(sys.argv) > 1 else "long_line.topo"
+    noise = sys.argv[2] if len(sys.argv) > 2 else "no_noise.txt"
+    sample = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    s = TestSim(seed=1)
+    s.runTime(1)
+    s.loadTopo(topo)
+    s.loadNoise(noise)
+    s.bootAll()
+
+    # Let neighbor discovery and link-state routing converge
+    s.runTime(8000)
+
+    results = s.pingSweep(sample=sample, count=5)
+    print("# %s / %s" % (topo, noise))
+    s.printPingSummary(results)
+    s.printPingMatrix(results, "p50")
+    s.printPingMatrix(results, "p99")
+    s.printPingMatrix(results, "loss")
+
+if __name__ == '__main__':
+    main()
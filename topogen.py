@@ -0,0 +1,137 @@
+#! /usr/bin/python
+# Synthetic topology generator for TOSSIM.
+#
+# Places N nodes on a grid, uniformly at random, or in clusters, computes the
+# gain of every ordered pair with a log-distance path-loss model plus
+# log-normal shadowing, and keeps the links above a sensitivity threshold.
+# Everything is vectorized in NumPy, so a 2000-node network takes well under
+# a second to generate.
+#
+#   python2 topogen.py random 200 --seed 1 -o topo/random200.topo
+#
+#   s.generateTopo(500, "cluster", seed=3)     # TestSim, no file needed
+#
+# Gains follow the shipped .topo files: dB relative to the transmitter, so
+# -54.0 is a strong link and anything below about -90 is lost in the noise
+# floor of noise/*.txt. Routing state in LinkStateP is sized for MAX_NODES
+# nodes; larger files still exercise TOSSIM, neighbor discovery and flooding.
+
+import argparse
+import time
+
+import numpy as np
+
+LAYOUTS = ("grid", "random", "cluster")
+
+
+# Node positions in metres, one row per node
+def gridLayout(n, spacing=30.0, jitter=0.0, rng=np.random):
+    side = int(np.ceil(np.sqrt(n)))
+    index = np.arange(n)
+    pos = np.column_stack((index % side, index // side)).astype(float) * spacing
+    if jitter > 0:
+        pos += rng.uniform(-jitter, jitter, pos.shape)
+    return pos
+
+
+def randomLayout(n, area, rng=np.random):
+    return rng.uniform(0.0, area, (n, 2))
+
+
+def clusterLayout(n, area, clusters=8, spread=None, rng=np.random):
+    if spread is None:
+        spread = area / (4.0 * np.sqrt(clusters))
+    centers = rng.uniform(0.0, area, (clusters, 2))
+    members = rng.randint(0, clusters, n)
+    pos = centers[members] + rng.normal(0.0, spread, (n, 2))
+    return np.clip(pos, 0.0, area)
+
+
+# Gain in dB for every ordered pair (row = sender). The diagonal is -inf.
+# Shadowing is drawn once per pair so links are symmetric, as in the shipped files.
+def pathGains(pos, refLoss=40.0, refDistance=1.0, exponent=3.0, shadowing=4.0, rng=np.random):
+    delta = pos[:, np.newaxis, :] - pos[np.newaxis, :, :]
+    dist = np.sqrt((delta ** 2).sum(axis=2))
+    n = len(pos)
+    loss = refLoss + 10.0 * exponent * np.log10(np.maximum(dist, refDistance) / refDistance)
+    if shadowing > 0:
+        noise = np.triu(rng.normal(0.0, shadowing, (n, n)), 1)
+        loss += noise + noise.T
+    gains = -loss
+    np.fill_diagonal(gains, -np.inf)
+    return gains
+
+
+# Links above the threshold as (src, dst, gain) arrays with 1-based node IDs.
+# maxDegree is a hard cap on every node's degree, so dense layouts stay inside
+# the neighbor tables of NeighborDiscoveryP and LinkStateP (MAX_NEIGHBORS_LS = 6).
+def pruneLinks(gains, threshold=-90.0, maxDegree=None):
+    keep = gains >= threshold
+    if maxDegree is not None and maxDegree < len(gains) - 1:
+        best = np.argpartition(-gains, maxDegree - 1, axis=1)[:, :maxDegree]
+        strongest = np.zeros_like(keep)
+        strongest[np.arange(len(gains))[:, np.newaxis], best] = True
+        # A link survives only if both ends rank it among their strongest, so the
+        # result stays symmetric and no node ends up with more than maxDegree links
+        keep &= strongest & strongest.T
+    src, dst = np.nonzero(keep)
+    return src + 1, dst + 1, np.round(gains[src, dst], 1)
+
+
+def generate(n, layout="random", seed=None, area=None, spacing=30.0, clusters=8,
+             threshold=-90.0, maxDegree=None, **model):
+    rng = np.random.RandomState(seed)
+    if area is None:
+        # Keep the average degree roughly constant as n grows
+        area = spacing * np.sqrt(n)
+    if layout == "grid":
+        pos = gridLayout(n, spacing, spacing / 4.0, rng)
+    elif layout == "random":
+        pos = randomLayout(n, area, rng)
+    elif layout == "cluster":
+        pos = clusterLayout(n, area, clusters, rng=rng)
+    else:
+        raise ValueError("layout must be one of %s" % ", ".join(LAYOUTS))
+    src, dst, gain = pruneLinks(pathGains(pos, rng=rng, **model), threshold, maxDegree)
+    return pos, src, dst, gain
+
+
+def writeTopo(path, n, src, dst, gain):
+    f = open(path, "w")
+    f.write("%d\n" % n)
+    np.savetxt(f, np.column_stack((src, dst, gain)), fmt=("%d", "%d", "%.1f"))
+    f.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a TOSSIM .topo file")
+    parser.add_argument("layout", choices=LAYOUTS)
+    parser.add_argument("nodes", type=int)
+    parser.add_argument("-o", "--output", default=None, help="default topo/<layout><nodes>.topo")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--area", type=float, default=None, help="side of the square area in metres")
+    parser.add_argument("--spacing", type=float, default=30.0, help="grid spacing in metres")
+    parser.add_argument("--clusters", type=int, default=8)
+    parser.add_argument("--exponent", type=float, default=3.0, help="path-loss exponent")
+    parser.add_argument("--ref-loss", type=float, default=40.0, help="loss in dB at 1 m")
+    parser.add_argument("--shadowing", type=float, default=4.0, help="shadowing sigma in dB")
+    parser.add_argument("--threshold", type=float, default=-90.0, help="weakest gain kept, in dB")
+    parser.add_argument("--max-degree", type=int, default=None)
+    args = parser.parse_args()
+
+    start = time.time()
+    pos, src, dst, gain = generate(args.nodes, args.layout, args.seed, args.area, args.spacing,
+                                   args.clusters, args.threshold, args.max_degree,
+                                   refLoss=args.ref_loss, exponent=args.exponent,
+                                   shadowing=args.shadowing)
+    output = args.output or "topo/%s%d.topo" % (args.layout, args.nodes)
+    writeTopo(output, args.nodes, src, dst, gain)
+
+    degree = np.bincount(src, minlength=args.nodes + 1)[1:]
+    print("%s: %d nodes, %d links, degree min %d avg %.1f max %d, %d isolated (%.2f s)" %
+          (output, args.nodes, len(src), degree.min(), degree.mean(), degree.max(),
+           (degree == 0).sum(), time.time() - start))
+
+
+if __name__ == "__main__":
+    main()